@@ -1,13 +1,23 @@
 import os
 import logging
-from typing import List, Dict, Any
+from typing import List, Dict, Any, Optional, Tuple, Callable, AsyncIterator
 import re
 import time
+import hashlib
+import asyncio
+from collections import deque
 from dotenv import load_dotenv
 
-# Импорт для GitHub Models API через Azure AI Inference
+from cache import ResponseCache
+from ratelimit import ProviderRateLimiter, retry_after_from_headers
+from concurrency import SingleFlight, CancellationToken, cancellable
+from metrics import metrics
+from preprocess import preprocess_reviews
+from models import Review
+
+# Импорт для GitHub Models API через Azure AI Inference (асинхронный клиент)
 try:
-    from azure.ai.inference import ChatCompletionsClient
+    from azure.ai.inference.aio import ChatCompletionsClient
     from azure.ai.inference.models import SystemMessage, UserMessage
     from azure.core.credentials import AzureKeyCredential
     GITHUB_MODELS_AVAILABLE = True
@@ -15,7 +25,7 @@ except ImportError:
     GITHUB_MODELS_AVAILABLE = False
 
 try:
-    from groq import Groq
+    from groq import AsyncGroq
     import httpx
     GROQ_AVAILABLE = True
 except ImportError as e:
@@ -28,90 +38,765 @@ load_dotenv()
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
 logger = logging.getLogger('ReviewAnalyzer')
 
+# Разбиение текста на слова, числа и знаки препинания для оценки числа токенов
+_TOKEN_PIECE_PATTERN = re.compile(r"[^\W\d]+|\d+|[^\w\s]")
+_CYRILLIC_PATTERN = re.compile(r"[а-яА-ЯёЁ]")
+
+# Символы, которые удаляются из ответа модели (эмодзи и прочие служебные символы).
+# Проверка посимвольная, поэтому выражение одинаково работает на полном ответе и на фрагментах потока
+_UNWANTED_CHARS_PATTERN = re.compile(r'[^\w\s\,\.\-\:\;\"\'\(\)\[\]\{\}\?\!]')
+
+SYSTEM_PROMPT = "Ты - профессиональный аналитик отзывов о товарах. Твои ответы должны быть структурированными, информативными и строго придерживаться указанного формата без эмодзи."
+
+
+class LLMProviderError(Exception):
+    """Ошибка запроса к провайдеру LLM с HTTP-статусом и заголовками ответа, если они известны"""
+    
+    def __init__(self, message: str, status_code: Optional[int] = None, retry_after: Optional[float] = None,
+                 headers: Optional[Dict[str, str]] = None):
+        super().__init__(message)
+        self.status_code = status_code
+        self.retry_after = retry_after
+        self.headers = headers
+    
+    @classmethod
+    def from_exception(cls, error: Exception) -> "LLMProviderError":
+        """Оборачивает исключение клиента Groq или Azure, извлекая статус и заголовки ответа"""
+        status_code = getattr(error, "status_code", None)
+        response = getattr(error, "response", None)
+        if status_code is None and response is not None:
+            status_code = getattr(response, "status_code", None)
+        headers = getattr(response, "headers", None) if response is not None else None
+        headers = dict(headers) if headers else None
+        return cls(str(error), status_code, retry_after_from_headers(headers), headers)
+    
+    @property
+    def server_failure(self) -> bool:
+        """Ошибка сервера или сети (5xx, таймаут, обрыв), а не некорректного запроса"""
+        return self.status_code is None or self.status_code >= 500
+    
+    @property
+    def rate_limited(self) -> bool:
+        """Является ли ошибка ограничением запросов (429)"""
+        error_str = str(self).lower()
+        return self.status_code == 429 or "429" in error_str or "too many requests" in error_str
+
+
+class LLMProvider:
+    """
+    Базовый асинхронный провайдер LLM.
+    Клиент создается один раз на цикл событий и переиспользуется всеми запросами.
+    """
+    
+    name = ""
+    model_name = ""
+    max_input_tokens = 4000
+    # Минутные квоты аккаунта (0 - не ограничены); квота токенов уточняется по заголовкам ответов
+    requests_per_minute = 0
+    tokens_per_minute = 0
+    # Дольше ждать освобождения квоты не имеет смысла: запрос завершается ошибкой 429
+    max_rate_limit_wait = 60
+    # Сколько последних задержек ответа хранится и сколько нужно, чтобы по ним судить о перцентиле
+    LATENCY_HISTORY = 200
+    LATENCY_MIN_SAMPLES = 10
+    
+    def __init__(self, response_cache: Optional[ResponseCache] = None,
+                 rate_limiter: Optional[ProviderRateLimiter] = None):
+        self._client = None
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self.response_cache = response_cache
+        self.rate_limiter = rate_limiter
+        # Задержки до ответа (для потока - до первого фрагмента) отдельно для обычных и потоковых запросов
+        self._latencies: Dict[bool, deque] = {False: deque(maxlen=self.LATENCY_HISTORY),
+                                              True: deque(maxlen=self.LATENCY_HISTORY)}
+    
+    def latency_percentile(self, streaming: bool, percentile: float) -> Optional[float]:
+        """Перцентиль задержки недавних успешных ответов в секундах; None, пока ответов слишком мало"""
+        samples = sorted(self._latencies[streaming])
+        if len(samples) < self.LATENCY_MIN_SAMPLES:
+            return None
+        return samples[min(int(len(samples) * percentile / 100), len(samples) - 1)]
+    
+    @classmethod
+    def limit_key(cls) -> str:
+        """Ключ провайдера в ограничителе запросов: квоты считаются отдельно для каждой модели"""
+        return f"{cls.name}/{cls.model_name}"
+    
+    async def _create_client(self):
+        raise NotImplementedError
+    
+    async def _request(self, client, prompt: str, system_prompt: str, temperature: float, top_p: float, max_tokens: int) -> Optional[str]:
+        raise NotImplementedError
+    
+    def _stream_request(self, client, prompt: str, system_prompt: str, temperature: float, top_p: float,
+                        max_tokens: int) -> AsyncIterator[str]:
+        """Асинхронный генератор фрагментов ответа модели по мере генерации"""
+        raise NotImplementedError
+    
+    def _report_to_limiter(self, method: str, *args):
+        """Передает ограничителю сведения о запросе; ошибка базы ограничителя не прерывает запрос"""
+        if self.rate_limiter is None:
+            return None
+        try:
+            return getattr(self.rate_limiter, method)(self.limit_key(), *args)
+        except Exception as e:
+            logger.warning(f"Ошибка ограничителя запросов {self.name}: {str(e)}")
+            return None
+    
+    def _observe_headers(self, headers):
+        """Уточняет остаток квот по заголовкам успешного ответа"""
+        if headers:
+            self._report_to_limiter("observe", dict(headers))
+    
+    async def _wait_for_quota(self, tokens: int):
+        """Ждет свободной квоты запросов и токенов; слишком долгое ожидание завершается ошибкой 429"""
+        while True:
+            wait = self._report_to_limiter("try_acquire", tokens)
+            if not wait:
+                return
+            if wait > self.max_rate_limit_wait:
+                raise LLMProviderError(f"{self.name}: квота запросов исчерпана, освободится через {wait:.0f} с",
+                                       429, retry_after=wait)
+            logger.info(f"{self.name}: ждем свободной квоты запросов {wait:.1f} с")
+            await asyncio.sleep(wait)
+    
+    async def _get_client(self):
+        loop = asyncio.get_running_loop()
+        if self._client is None or self._loop is not loop:
+            self._client = await self._create_client()
+            self._loop = loop
+        return self._client
+    
+    async def complete(self, prompt: str, system_prompt: str = SYSTEM_PROMPT, temperature: float = 0.3,
+                       top_p: float = 0.8, max_tokens: int = 1500,
+                       on_chunk: Optional[Callable[[str], None]] = None,
+                       concurrency: Optional[asyncio.Semaphore] = None) -> Optional[str]:
+        """
+        Отправляет промпт модели. Возвращает текст ответа или None, если ответ пустой.
+        Ответ на тот же промпт с теми же параметрами берется из кеша без запроса к API.
+        Если задан on_chunk, ответ запрашивается потоком и каждый фрагмент передается в on_chunk
+        по мере генерации (ответ из кеша передается одним фрагментом).
+        concurrency - семафор одновременных запросов; он занимается только после ожидания квоты,
+        чтобы запрос, ждущий квоту, не держал место других запросов.
+        """
+        cache_key = None
+        if self.response_cache is not None:
+            cache_key = ResponseCache.make_key(self.model_name, system_prompt, prompt,
+                                               temperature=temperature, top_p=top_p, max_tokens=max_tokens)
+            try:
+                cached = self.response_cache.get(cache_key)
+            except Exception as e:
+                logger.warning(f"Ошибка чтения кеша ответов LLM: {str(e)}")
+                cached = None
+            if cached is not None:
+                logger.info(f"Ответ {self.name} взят из кеша")
+                metrics.inc("llm_cache_hits", provider=self.name)
+                if on_chunk is not None:
+                    on_chunk(cached)
+                return cached
+        
+        # Квота расходуется на промпт и максимальный ответ; точный остаток уточняется по заголовкам
+        with metrics.span("llm.quota_wait", {"provider": self.name}):
+            await self._wait_for_quota(ReviewAnalyzer._estimate_tokens(system_prompt + "\n" + prompt) + max_tokens)
+        if concurrency is None:
+            return await self._send(prompt, system_prompt, temperature, top_p, max_tokens, on_chunk, cache_key)
+        async with concurrency:
+            return await self._send(prompt, system_prompt, temperature, top_p, max_tokens, on_chunk, cache_key)
+    
+    async def _send(self, prompt: str, system_prompt: str, temperature: float, top_p: float, max_tokens: int,
+                    on_chunk: Optional[Callable[[str], None]], cache_key: Optional[str]) -> Optional[str]:
+        """Запрос к API после получения квоты; успешный ответ сохраняется в кеш по cache_key"""
+        client = await self._get_client()
+        started = time.monotonic()
+        with metrics.span("llm.request", {"provider": self.name}, model=self.model_name,
+                          streaming=on_chunk is not None) as span:
+            try:
+                if on_chunk is None:
+                    content = await self._request(client, prompt, system_prompt, temperature, top_p, max_tokens)
+                    self._latencies[False].append(time.monotonic() - started)
+                else:
+                    parts = []
+                    async for delta in self._stream_request(client, prompt, system_prompt, temperature, top_p, max_tokens):
+                        if not parts:
+                            self._latencies[True].append(time.monotonic() - started)
+                            metrics.observe("llm_first_chunk_seconds", time.monotonic() - started, provider=self.name)
+                            span.set(first_chunk_ms=round((time.monotonic() - started) * 1000, 1))
+                        parts.append(delta)
+                        on_chunk(delta)
+                    content = "".join(parts) or None
+                if content and cache_key is not None:
+                    try:
+                        self.response_cache.put(cache_key, content)
+                    except Exception as e:
+                        logger.warning(f"Ошибка записи в кеш ответов LLM: {str(e)}")
+                self._report_to_limiter("record_success")
+                span.set(response_chars=len(content or ""))
+                return content
+            except Exception as e:
+                error = e if isinstance(e, LLMProviderError) else LLMProviderError.from_exception(e)
+                metrics.inc("llm_errors", provider=self.name, status=error.status_code or "none")
+                if error.rate_limited:
+                    self._report_to_limiter("record_rate_limited", error.retry_after, error.headers)
+                elif error.server_failure:
+                    self._report_to_limiter("record_failure")
+                if error is e:
+                    raise
+                raise error from e
+    
+    async def aclose(self):
+        """Закрывает клиент, если он был создан в текущем цикле событий"""
+        client, loop = self._client, self._loop
+        self._client = None
+        self._loop = None
+        if client is None:
+            return
+        try:
+            if loop is asyncio.get_running_loop():
+                await client.close()
+        except Exception as e:
+            logger.warning(f"Ошибка при закрытии клиента {self.name}: {str(e)}")
+
+
+class GroqProvider(LLMProvider):
+    """Асинхронный клиент Groq API без автоматических повторов на уровне HTTP"""
+    
+    name = "Groq"
+    model_name = "meta-llama/llama-4-scout-17b-16e-instruct"
+    # Контекст модели больше, но запрос ограничен минутной квотой токенов Groq
+    max_input_tokens = 20000
+    requests_per_minute = 30
+    tokens_per_minute = 30000
+    
+    def __init__(self, api_key: str, response_cache: Optional[ResponseCache] = None,
+                 rate_limiter: Optional[ProviderRateLimiter] = None):
+        super().__init__(response_cache, rate_limiter)
+        self.api_key = api_key
+    
+    async def _create_client(self):
+        # Повторы SDK (max_retries) и транспорта отключены: повторами и паузами управляют
+        # ограничитель запросов и переключение на резервный API
+        http_client = httpx.AsyncClient(transport=httpx.AsyncHTTPTransport(retries=0))
+        return AsyncGroq(api_key=self.api_key, http_client=http_client, max_retries=0)
+    
+    async def _request(self, client, prompt, system_prompt, temperature, top_p, max_tokens):
+        raw_response = await client.chat.completions.with_raw_response.create(
+            model=self.model_name,
+            messages=[
+                {"role": "system", "content": system_prompt},
+                {"role": "user", "content": prompt}
+            ],
+            temperature=temperature,
+            max_tokens=max_tokens,
+            top_p=top_p
+        )
+        self._observe_headers(raw_response.headers)
+        response = await raw_response.parse()
+        if response and response.choices and len(response.choices) > 0:
+            return response.choices[0].message.content
+        return None
+    
+    async def _stream_request(self, client, prompt, system_prompt, temperature, top_p, max_tokens):
+        raw_response = await client.chat.completions.with_raw_response.create(
+            model=self.model_name,
+            messages=[
+                {"role": "system", "content": system_prompt},
+                {"role": "user", "content": prompt}
+            ],
+            temperature=temperature,
+            max_tokens=max_tokens,
+            top_p=top_p,
+            stream=True
+        )
+        self._observe_headers(raw_response.headers)
+        stream = await raw_response.parse()
+        async with stream:
+            async for chunk in stream:
+                if chunk.choices and chunk.choices[0].delta.content:
+                    yield chunk.choices[0].delta.content
+
+
+class GitHubModelsProvider(LLMProvider):
+    """Асинхронный клиент GitHub Models API (Azure AI Inference) без автоматических повторов на уровне HTTP"""
+    
+    name = "GitHub Models"
+    endpoint = os.environ.get("GITHUB_MODELS_ENDPOINT", "https://models.inference.ai.azure.com")
+    model_name = "DeepSeek-V3-0324"
+    # Лимит входных токенов одного запроса GitHub Models (с запасом до 8000)
+    max_input_tokens = 7000
+    # Бесплатный уровень "High": запросы ограничены, минутной квоты токенов нет
+    requests_per_minute = 10
+    
+    def __init__(self, token: str, response_cache: Optional[ResponseCache] = None,
+                 rate_limiter: Optional[ProviderRateLimiter] = None):
+        super().__init__(response_cache, rate_limiter)
+        self.token = token
+    
+    async def _create_client(self):
+        # Политика повторов azure-core по умолчанию повторяет 429 и 5xx с паузами, минуя ограничитель
+        return ChatCompletionsClient(endpoint=self.endpoint, credential=AzureKeyCredential(self.token),
+                                     retry_total=0)
+    
+    def _observe_pipeline_response(self, pipeline_response):
+        self._observe_headers(pipeline_response.http_response.headers)
+    
+    async def _request(self, client, prompt, system_prompt, temperature, top_p, max_tokens):
+        response = await client.complete(
+            messages=[
+                SystemMessage(system_prompt),
+                UserMessage(prompt),
+            ],
+            temperature=temperature,
+            top_p=top_p,
+            max_tokens=max_tokens,
+            model=self.model_name,
+            raw_response_hook=self._observe_pipeline_response
+        )
+        if response and response.choices and len(response.choices) > 0:
+            return response.choices[0].message.content
+        return None
+    
+    async def _stream_request(self, client, prompt, system_prompt, temperature, top_p, max_tokens):
+        stream = await client.complete(
+            messages=[
+                SystemMessage(system_prompt),
+                UserMessage(prompt),
+            ],
+            temperature=temperature,
+            top_p=top_p,
+            max_tokens=max_tokens,
+            model=self.model_name,
+            stream=True,
+            raw_response_hook=self._observe_pipeline_response
+        )
+        async with stream:
+            async for update in stream:
+                if update.choices and update.choices[0].delta and update.choices[0].delta.content:
+                    yield update.choices[0].delta.content
+
+
+class HedgeBudget:
+    """
+    Ограничение расходов на хеджирование: каждый запрос добавляет max_ratio кредита (не больше burst),
+    дублирующий запрос расходует один кредит. В среднем дублируется не больше доли max_ratio запросов.
+    """
+    
+    def __init__(self, max_ratio: float = 0.1, burst: float = 2.0):
+        self.max_ratio = max_ratio
+        self.burst = burst
+        self._credit = 0.0
+        self.requests = 0
+        self.hedged = 0
+    
+    def note_request(self):
+        self.requests += 1
+        self._credit = min(self.burst, self._credit + self.max_ratio)
+    
+    def try_spend(self) -> bool:
+        if self._credit < 1:
+            return False
+        self._credit -= 1
+        self.hedged += 1
+        return True
+
+
+class LLMClientPool:
+    """
+    Долгоживущие провайдеры LLM, общий кеш их ответов, общий ограничитель частоты запросов
+    и общий лимит одновременных запросов к ним.
+    Провайдер создается заново только при смене ключа API.
+    """
+    
+    PROVIDER_CLASSES = (GroqProvider, GitHubModelsProvider)
+    
+    def __init__(self, max_concurrency: int = 4, use_response_cache: bool = True, use_rate_limiter: bool = True,
+                 hedging: bool = False, hedge_percentile: float = 95, hedge_max_ratio: float = 0.1):
+        self.max_concurrency = max_concurrency
+        self.use_response_cache = use_response_cache
+        self.use_rate_limiter = use_rate_limiter
+        # Хеджирование: запрос дублируется резервному провайдеру, если основной не ответил
+        # за hedge_percentile-й перцентиль своих недавних задержек
+        self.hedging = hedging
+        self.hedge_percentile = hedge_percentile
+        self.hedge_budget = HedgeBudget(hedge_max_ratio)
+        self._providers: Dict[str, LLMProvider] = {}
+        self._semaphore: Optional[asyncio.Semaphore] = None
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._response_cache: Optional[ResponseCache] = None
+        self._rate_limiter: Optional[ProviderRateLimiter] = None
+    
+    def response_cache(self) -> Optional[ResponseCache]:
+        """Кеш ответов LLM, создается при первом обращении. None, если кеш отключен или недоступен"""
+        if not self.use_response_cache:
+            return None
+        if self._response_cache is None:
+            try:
+                self._response_cache = ResponseCache()
+            except Exception as e:
+                logger.warning(f"Кеш ответов LLM недоступен: {str(e)}")
+                self.use_response_cache = False
+                return None
+            if self._response_cache.max_entries <= 0:
+                self.use_response_cache = False
+                self._response_cache = None
+        return self._response_cache
+    
+    def rate_limiter(self) -> Optional[ProviderRateLimiter]:
+        """Ограничитель частоты запросов к провайдерам, создается при первом обращении. None, если отключен или недоступен"""
+        if not self.use_rate_limiter:
+            return None
+        if self._rate_limiter is None:
+            try:
+                self._rate_limiter = ProviderRateLimiter()
+            except Exception as e:
+                logger.warning(f"Ограничитель запросов LLM недоступен: {str(e)}")
+                self.use_rate_limiter = False
+                return None
+            for provider_class in self.PROVIDER_CLASSES:
+                self._rate_limiter.configure(provider_class.limit_key(), provider_class.requests_per_minute,
+                                             provider_class.tokens_per_minute)
+        return self._rate_limiter
+    
+    def wait_time(self, provider_class: type, tokens: int = 0) -> float:
+        """Через сколько секунд провайдер сможет принять запрос на tokens токенов (0 - сразу или без ограничителя)"""
+        limiter = self.rate_limiter()
+        if limiter is None:
+            return 0.0
+        try:
+            return limiter.wait_time(provider_class.limit_key(), tokens)
+        except Exception as e:
+            logger.warning(f"Ошибка ограничителя запросов LLM: {str(e)}")
+            return 0.0
+    
+    def semaphore(self) -> asyncio.Semaphore:
+        """Семафор текущего цикла событий, ограничивающий число одновременных запросов к LLM"""
+        loop = asyncio.get_running_loop()
+        if self._semaphore is None or self._loop is not loop:
+            self._semaphore = asyncio.Semaphore(self.max_concurrency)
+            self._loop = loop
+        return self._semaphore
+    
+    def groq(self, api_key: str) -> GroqProvider:
+        provider = self._providers.get("groq")
+        if provider is None or provider.api_key != api_key:
+            provider = GroqProvider(api_key, self.response_cache(), self.rate_limiter())
+            self._providers["groq"] = provider
+        return provider
+    
+    def github(self, token: str) -> GitHubModelsProvider:
+        provider = self._providers.get("github")
+        if provider is None or provider.token != token:
+            provider = GitHubModelsProvider(token, self.response_cache(), self.rate_limiter())
+            self._providers["github"] = provider
+        return provider
+    
+    async def aclose(self):
+        """Закрывает клиенты всех провайдеров"""
+        for provider in self._providers.values():
+            await provider.aclose()
+        self._providers.clear()
+
+
+# Общий для модуля пул клиентов LLM
+llm_pool = LLMClientPool(max_concurrency=int(os.environ.get("LLM_MAX_CONCURRENCY", 4)),
+                         use_response_cache=os.environ.get("LLM_CACHE_ENABLED", "1") != "0",
+                         use_rate_limiter=os.environ.get("LLM_RATE_LIMIT_ENABLED", "1") != "0",
+                         hedging=os.environ.get("LLM_HEDGING", "0") == "1",
+                         hedge_percentile=float(os.environ.get("LLM_HEDGE_PERCENTILE", 95)),
+                         hedge_max_ratio=float(os.environ.get("LLM_HEDGE_MAX_RATIO", 0.1)))
+
+async def shutdown():
+    """Закрывает долгоживущие клиенты LLM. Вызывается один раз при завершении работы."""
+    await llm_pool.aclose()
+
+class AnalysisStreamFormatter:
+    """
+    Инкрементальное форматирование потока анализа для показа по мере генерации.
+    Повторяет _format_analysis там, где это возможно без полного ответа: если модель не начала ответ
+    с раздела "Плюсы:", заголовок добавляется перед текстом. Итоговый текст по-прежнему дает
+    _format_analysis по полному ответу. None (сброс перед новой попыткой) передается дальше как есть.
+    """
+    
+    HEADER = "Плюсы:"
+    # Сколько символов ответа ждать заголовок, прежде чем добавить его самим
+    HEADER_LOOKAHEAD_CHARS = 200
+    
+    def __init__(self, emit: Callable[[Optional[str]], None]):
+        self._emit = emit
+        self._buffer = ""
+        self._passthrough = False
+    
+    def __call__(self, chunk: Optional[str]):
+        if chunk is None:
+            self._buffer = ""
+            self._passthrough = False
+            self._emit(None)
+            return
+        if self._passthrough:
+            self._emit(chunk)
+            return
+        self._buffer += chunk
+        if self.HEADER in self._buffer:
+            self._flush("")
+        elif len(self._buffer) >= self.HEADER_LOOKAHEAD_CHARS:
+            self._flush(self.HEADER + "\n")
+    
+    def _flush(self, prefix: str):
+        self._passthrough = True
+        text, self._buffer = prefix + self._buffer, ""
+        self._emit(text)
+
+
 class ReviewAnalyzer:
     """
     Класс для анализа отзывов с Wildberries с использованием Groq API и модели Llama-4-Scout
     """
     
     # Добавляем константы для GitHub Models API
-    GITHUB_MODELS_ENDPOINT = "https://models.inference.ai.azure.com"
-    GITHUB_MODEL_NAME = "DeepSeek-V3-0324"
+    GITHUB_MODELS_ENDPOINT = GitHubModelsProvider.endpoint
+    GITHUB_MODEL_NAME = GitHubModelsProvider.model_name
+    
+    # Бюджет токенов на одну часть отзывов и число одновременных запросов в режиме map-reduce.
+    # Часть должна помещаться в лимит любого провайдера, в том числе резервного
+    MAP_REDUCE_CHUNK_TOKENS = GitHubModelsProvider.max_input_tokens - 1000
+    MAP_REDUCE_MAX_WORKERS = 4
+    # Режим map-reduce включается явно (LLM_MAP_REDUCE=1 или map_reduce=True): каждая часть - отдельный
+    # запрос в минутную квоту провайдера. Частей не больше MAP_REDUCE_MAX_CHUNKS, чтобы анализ занимал
+    # около двух запросов по времени (параллельный map и reduce); лишние отзывы отбираются по информативности
+    MAP_REDUCE_ENABLED = os.environ.get("LLM_MAP_REDUCE", "0") == "1"
+    MAP_REDUCE_MAX_CHUNKS = int(os.environ.get("LLM_MAP_REDUCE_MAX_CHUNKS", 4))
+    # Предел промпта этапа reduce: любой запрос может перейти на резервный провайдер с наименьшим лимитом.
+    # Выжимки, не помещающиеся в один промпт, сначала объединяются группами (промежуточный reduce)
+    REDUCE_MAX_INPUT_TOKENS = GitHubModelsProvider.max_input_tokens
     
-    # Флаг, указывающий, что Groq API временно недоступен (ошибка 429)
-    _groq_api_rate_limited = False
+    # Сколько отзывов товара загружать для анализа (WB_REVIEWS_LIMIT)
+    REVIEWS_LIMIT = int(os.environ.get("WB_REVIEWS_LIMIT", 300))
     
-    # Время последней ошибки 429 от Groq API
-    _groq_api_rate_limited_time = 0
+    # Максимум токенов на один отзыв в промпте и накладные расходы на строку "Отзыв N: "
+    MAX_REVIEW_TOKENS = 400
+    REVIEW_LINE_OVERHEAD_TOKENS = 4
     
-    # Интервал для повторной проверки доступности Groq API (в секундах)
-    _groq_api_retry_interval = 60
+    # Объединение одновременных анализов одних и тех же отзывов одного товара
+    _analysis_flight = SingleFlight()
     
     @staticmethod
-    def _truncate_reviews(reviews: List[str], max_length: int = 15000) -> List[str]:
+    def _review_to_text(review: Any) -> str:
         """
-        Обрезает список отзывов, чтобы их общая длина не превышала max_length
+        Преобразует отзыв в строку для промпта.
+        Отзыв может быть записью Review из WbReview.parse, словарем с полями text/pros/cons или строкой.
         """
-        if not reviews:
-            return []
-            
-        total_length = 0
-        truncated_reviews = []
-        
-        for review in reviews:
-            # Добавляем отзыв, если общая длина не превышает максимальную
-            if total_length + len(review) <= max_length:
-                truncated_reviews.append(review)
-                total_length += len(review)
+        if isinstance(review, Review):
+            return review.to_prompt_text()
+        if isinstance(review, dict):
+            parts = []
+            text = (review.get("text") or "").strip()
+            pros = (review.get("pros") or "").strip()
+            cons = (review.get("cons") or "").strip()
+            if text:
+                parts.append(text)
+            if pros:
+                parts.append(f"Достоинства: {pros}")
+            if cons:
+                parts.append(f"Недостатки: {cons}")
+            return " | ".join(parts)
+        return str(review)
+    
+    @staticmethod
+    def _estimate_tokens(text: str) -> int:
+        """
+        Оценка числа токенов для BPE-токенизаторов Llama и DeepSeek (словарь ~128k).
+        Откалибрована с запасом: кириллическое слово - около 3 символов на токен,
+        латинское - около 4, число - около 3 цифр на токен, каждый знак препинания - отдельный токен.
+        """
+        tokens = 0
+        for piece in _TOKEN_PIECE_PATTERN.findall(text):
+            first = piece[0]
+            if first.isdigit():
+                tokens += (len(piece) + 2) // 3
+            elif first.isalpha() or first == "_":
+                chars_per_token = 3 if _CYRILLIC_PATTERN.search(piece) else 4
+                tokens += (len(piece) + chars_per_token - 1) // chars_per_token
             else:
-                # Если отзыв слишком длинный, добавляем часть до достижения max_length
-                available_length = max_length - total_length
-                if available_length > 100:  # Если осталось достаточно места, добавляем часть отзыва
-                    truncated_reviews.append(review[:available_length])
-                break
-                
-        return truncated_reviews
+                tokens += 1
+        return tokens + 1
+    
+    @classmethod
+    def _review_informativeness(cls, review: Any, tokens: int, recency: float = 0.0,
+                                content_score: Optional[float] = None) -> float:
+        """
+        Оценка информативности отзыва для отбора в промпт:
+        заполненные достоинства/недостатки и содержательная длина повышают оценку,
+        низкая оценка товара (чаще всего содержит конкретные недостатки) и свежесть отзыва дают надбавку.
+        recency - от 0 (самый старый отзыв) до 1 (самый новый).
+        content_score - оценка информативности из preprocess_reviews (от 0 до 1); если задана,
+        содержательная длина берется из нее, а не из числа токенов.
+        """
+        score = 150 * content_score if content_score is not None else float(min(tokens, 150))
+        if isinstance(review, Review):
+            pros, cons, rating = review.pros, review.cons, review.rating
+        elif isinstance(review, dict):
+            pros, cons, rating = review.get("pros") or "", review.get("cons") or "", None
+        else:
+            pros, cons, rating = "", "", None
+        if pros.strip():
+            score += 40
+        if cons.strip():
+            score += 60
+        if rating is not None and rating <= 3:
+            score += 40
+        score += 30 * recency
+        if tokens < 5:
+            score -= 50
+        return score
     
     @staticmethod
-    def _should_try_groq_api() -> bool:
+    def _recency_ranks(reviews: List[Any]) -> List[float]:
         """
-        Проверяет, следует ли пытаться использовать Groq API
-        или сразу переключиться на GitHub Models API
+        Свежесть каждого отзыва от 0 до 1 по дате публикации.
+        Без дат считается, что отзывы идут от новых к старым, как их отдает Wildberries.
         """
-        # Если Groq API не ограничен по скорости, используем его
-        if not ReviewAnalyzer._groq_api_rate_limited:
-            return True
-            
-        # Проверяем, прошло ли достаточно времени с момента последней ошибки 429
-        current_time = time.time()
-        time_since_rate_limit = current_time - ReviewAnalyzer._groq_api_rate_limited_time
-        
-        # Если прошло достаточно времени, сбрасываем флаг и пробуем Groq API снова
-        if time_since_rate_limit >= ReviewAnalyzer._groq_api_retry_interval:
-            logger.info(f"Прошло {time_since_rate_limit:.1f} секунд с момента ограничения Groq API. Пробуем снова.")
-            ReviewAnalyzer._groq_api_rate_limited = False
-            return True
+        count = len(reviews)
+        if count <= 1:
+            return [1.0] * count
+        dates = [review.date if isinstance(review, Review) else "" for review in reviews]
+        if not any(dates):
+            return [1.0 - index / (count - 1) for index in range(count)]
+        order = sorted(range(count), key=lambda index: dates[index])
+        ranks = [0.0] * count
+        for position, index in enumerate(order):
+            ranks[index] = position / (count - 1)
+        return ranks
+    
+    @classmethod
+    @metrics.timed("analysis.plan_reviews")
+    def _plan_reviews(cls, reviews: List[Any], budget_tokens: int,
+                      scores: Optional[List[float]] = None) -> Tuple[List[str], int]:
+        """
+        Подбирает отзывы в промпт так, чтобы максимально заполнить бюджет токенов.
+        Точные дубликаты удаляются, слишком длинные отзывы обрезаются до MAX_REVIEW_TOKENS.
+        Если все отзывы не помещаются, предпочтение отдается самым информативным,
+        причем поочередно из коротких, средних и длинных отзывов, чтобы выборка была разнообразной.
+        scores - оценки информативности отзывов из preprocess_reviews (в том же порядке, что и reviews).
+        
+        Returns:
+            (тексты отобранных отзывов в исходном порядке, число не поместившихся отзывов)
+        """
+        candidates = []
+        seen = set()
+        recency_ranks = cls._recency_ranks(reviews)
+        for index, review in enumerate(reviews):
+            text = " ".join(cls._review_to_text(review).split())
+            if not text:
+                continue
+            dedup_key = text.lower()
+            if dedup_key in seen:
+                continue
+            seen.add(dedup_key)
             
-        logger.info(f"Groq API все еще ограничен. Используем GitHub Models API. Повторная проверка через {ReviewAnalyzer._groq_api_retry_interval - time_since_rate_limit:.1f} секунд.")
-        return False
+            tokens = cls._estimate_tokens(text)
+            if tokens > cls.MAX_REVIEW_TOKENS:
+                text = text[:len(text) * cls.MAX_REVIEW_TOKENS // tokens] + "..."
+                tokens = cls.MAX_REVIEW_TOKENS
+            tokens += cls.REVIEW_LINE_OVERHEAD_TOKENS
+            content_score = scores[index] if scores is not None else None
+            candidates.append((cls._review_informativeness(review, tokens, recency_ranks[index], content_score),
+                               index, text, tokens))
+        
+        if sum(candidate[3] for candidate in candidates) <= budget_tokens:
+            return [candidate[2] for candidate in candidates], 0
+        
+        # Корзины по длине: короткие, средние, длинные; внутри - по убыванию информативности
+        buckets: List[List[Tuple[float, int, str, int]]] = [[], [], []]
+        for candidate in candidates:
+            tokens = candidate[3]
+            buckets[0 if tokens < 30 else (1 if tokens < 120 else 2)].append(candidate)
+        for bucket in buckets:
+            bucket.sort(key=lambda candidate: candidate[0])
+        
+        chosen = []
+        used_tokens = 0
+        while any(buckets):
+            for bucket in (buckets[2], buckets[1], buckets[0]):
+                if not bucket:
+                    continue
+                candidate = bucket.pop()
+                if used_tokens + candidate[3] <= budget_tokens:
+                    chosen.append(candidate)
+                    used_tokens += candidate[3]
+        
+        chosen.sort(key=lambda candidate: candidate[1])
+        return [candidate[2] for candidate in chosen], len(candidates) - len(chosen)
+    
+    @classmethod
+    def _prompt_template_tokens(cls, prompt_builder: Callable[..., str], *args: Any) -> int:
+        """
+        Размер шаблона промпта без отзывов в токенах. Вызывает исходную функцию построения промпта
+        в обход @metrics.timed, чтобы служебные вычисления не попадали в метрики analysis.prompt.
+        """
+        return cls._estimate_tokens(prompt_builder.__wrapped__([], *args))
+    
+    @classmethod
+    def _review_token_budget(cls, provider_class: type, product_name: str) -> int:
+        """Бюджет токенов на отзывы для провайдера: лимит входа минус шаблон промпта"""
+        template_tokens = cls._prompt_template_tokens(cls._generate_ai_prompt, product_name)
+        return max(provider_class.max_input_tokens - template_tokens, 0)
+    
+    @classmethod
+    @metrics.timed("analysis.split_chunks")
+    def _split_reviews_into_chunks(cls, reviews: List[Any], max_tokens: int) -> List[List[str]]:
+        """
+        Делит все отзывы на части так, чтобы оценка токенов каждой части не превышала max_tokens.
+        Слишком длинный отзыв обрезается до размера одной части.
+        """
+        chunks: List[List[str]] = []
+        current_chunk: List[str] = []
+        current_tokens = 0
+        max_chars = max_tokens * 3
+        
+        for review in reviews:
+            review_text = cls._review_to_text(review)
+            if not review_text:
+                continue
+            if len(review_text) > max_chars:
+                review_text = review_text[:max_chars]
+            review_tokens = cls._estimate_tokens(review_text)
+            if current_chunk and current_tokens + review_tokens > max_tokens:
+                chunks.append(current_chunk)
+                current_chunk = []
+                current_tokens = 0
+            current_chunk.append(review_text)
+            current_tokens += review_tokens
+        
+        if current_chunk:
+            chunks.append(current_chunk)
+        return chunks
     
     @staticmethod
-    def _mark_groq_api_rate_limited():
-        """Отмечает Groq API как временно недоступный из-за ограничения скорости"""
-        ReviewAnalyzer._groq_api_rate_limited = True
-        ReviewAnalyzer._groq_api_rate_limited_time = time.time()
-        logger.warning(f"Groq API помечен как ограниченный на {ReviewAnalyzer._groq_api_retry_interval} секунд")
+    def _request_tokens(prompt: str, max_tokens: int = 1500) -> int:
+        """Оценка токенов, которые запрос займет в минутной квоте: промпты и максимальный ответ"""
+        return ReviewAnalyzer._estimate_tokens(SYSTEM_PROMPT + "\n" + prompt) + max_tokens
     
     @staticmethod
+    def _should_try_groq_api(tokens: int = 0) -> bool:
+        """
+        Выбирает провайдера до запроса по состоянию ограничителя (квоты, retry-after, предохранитель):
+        Groq API, если он примет запрос сразу или освободится раньше GitHub Models API
+        """
+        groq_wait = llm_pool.wait_time(GroqProvider, tokens)
+        if groq_wait <= 0 or not GITHUB_MODELS_AVAILABLE or not ReviewAnalyzer._get_github_token():
+            return True
+        github_wait = llm_pool.wait_time(GitHubModelsProvider, tokens)
+        if github_wait < groq_wait:
+            logger.info(f"Groq API освободится через {groq_wait:.1f} с, используем GitHub Models API")
+            return False
+        return True
+    
+    @staticmethod
+    @metrics.timed("analysis.prompt", {"kind": "single"})
     def _generate_ai_prompt(reviews: List[str], product_name: str) -> str:
         """
         Генерирует промпт для отправки в модель ИИ
         """
-        if ReviewAnalyzer._groq_api_rate_limited:
-            shortened_reviews = reviews[:20]
-            reviews_text = "\n".join([f"Отзыв {i+1}: {review[:100]}..." if len(review) > 100 else f"Отзыв {i+1}: {review}"
-                                      for i, review in enumerate(shortened_reviews)])
-        else:
-            reviews_text = "\n".join([f"Отзыв {i+1}: {review}" for i, review in enumerate(reviews)])
+        reviews_text = "\n".join([f"Отзыв {i+1}: {review}" for i, review in enumerate(reviews)])
         prompt = f"""Проанализируй следующие отзывы о товаре "{product_name}".
 
 ОТЗЫВЫ:
@@ -142,6 +827,91 @@ class ReviewAnalyzer:
 """
         return prompt
     
+    @staticmethod
+    @metrics.timed("analysis.prompt", {"kind": "map"})
+    def _generate_map_prompt(reviews: List[str], product_name: str, chunk_index: int, total_chunks: int) -> str:
+        """
+        Генерирует промпт для этапа map: краткая выжимка плюсов и минусов из одной части отзывов
+        """
+        reviews_text = "\n".join([f"Отзыв {i+1}: {review}" for i, review in enumerate(reviews)])
+        return f"""Это часть {chunk_index + 1} из {total_chunks} отзывов о товаре "{product_name}".
+
+ОТЗЫВЫ:
+{reviews_text}
+
+Кратко выпиши, что покупатели в этой части отзывов отмечают как достоинства и как недостатки товара.
+Для каждого пункта укажи, насколько часто он встречается (часто, несколько раз, единично).
+
+Ответ строго в формате, без эмодзи и форматирования:
+
+Плюсы:
+- [пункт] (частота)
+
+Минусы:
+- [пункт] (частота)
+"""
+    
+    @staticmethod
+    @metrics.timed("analysis.prompt", {"kind": "merge"})
+    def _generate_merge_prompt(partial_summaries: List[str], product_name: str, group_index: int, total_groups: int) -> str:
+        """
+        Генерирует промпт промежуточного reduce: объединение группы выжимок в одну выжимку того же формата,
+        что и на этапе map, когда все выжимки не помещаются в один промпт reduce
+        """
+        summaries_text = "\n\n".join([f"--- Выжимка {i+1} ---\n{summary}" for i, summary in enumerate(partial_summaries)])
+        return f"""Это группа {group_index + 1} из {total_groups} выжимок плюсов и минусов из отзывов о товаре "{product_name}".
+
+ВЫЖИМКИ:
+{summaries_text}
+
+Объедини эти выжимки в одну. Сливай повторяющиеся пункты и пересчитывай, насколько часто они встречаются
+(часто, несколько раз, единично) с учетом всех выжимок группы.
+
+Ответ строго в формате, без эмодзи и форматирования:
+
+Плюсы:
+- [пункт] (частота)
+
+Минусы:
+- [пункт] (частота)
+"""
+    
+    @staticmethod
+    @metrics.timed("analysis.prompt", {"kind": "reduce"})
+    def _generate_reduce_prompt(partial_summaries: List[str], product_name: str, total_reviews: int) -> str:
+        """
+        Генерирует промпт для этапа reduce: объединение выжимок всех частей в итоговый анализ
+        """
+        summaries_text = "\n\n".join([f"--- Выжимка части {i+1} ---\n{summary}" for i, summary in enumerate(partial_summaries)])
+        return f"""Ниже приведены выжимки плюсов и минусов, составленные по частям из {total_reviews} отзывов о товаре "{product_name}".
+
+ВЫЖИМКИ:
+{summaries_text}
+
+Объедини их в единый анализ всех отзывов. Сливай повторяющиеся пункты, учитывай, как часто они встречаются во всех частях.
+
+Твой ответ должен быть строго в следующем формате и не должен содержать эмодзи или другие символы:
+
+Плюсы:
+- [перечисли основные положительные характеристики товара, которые часто упоминаются в отзывах. Формулируй их как общие достоинства товара.]
+
+Минусы:
+- [перечисли основные отрицательные моменты, о которых сообщают пользователи. 
+   Если проблема упоминается лишь в отдельных выжимках или единично, обязательно указывай это (например: "Некоторые пользователи отмечают..."). 
+   Избегай категоричных заявлений, если проблема не является массовой.
+   Если минусов нет, напиши "Судя по отзывам, явных или часто упоминаемых минусов не обнаружено"]
+
+Рекомендации:
+[Напиши развернутую рекомендацию, стоит ли покупать этот товар, исходя из проанализированных отзывов. Добавь информацию о том, для каких категориях покупателей этот товар подойдет лучше всего. Рекомендация должна быть подробной, минимум 3-5 предложений. Учитывай как плюсы, так и нюансы из раздела "Минусы".]
+
+Важные требования:
+1. Не используй эмодзи
+2. Используй только простой текст без форматирования
+3. Строго придерживайся указанной структуры
+4. Основывай свой анализ только на предоставленных выжимках
+5. Плюсы и минусы оформляй в виде маркированного списка с дефисами
+"""
+    
     @staticmethod
     def _get_api_key() -> str:
         """Получает API ключ Groq из переменной окружения или файла"""
@@ -173,7 +943,121 @@ class ReviewAnalyzer:
         return os.environ.get("GITHUB_TOKEN", "")
     
     @staticmethod
-    def _get_ai_response_github(prompt: str) -> str:
+    def _clean_response(content: str) -> str:
+        """Удаляет эмодзи и прочие служебные символы из ответа модели"""
+        return _UNWANTED_CHARS_PATTERN.sub('', content)
+    
+    @staticmethod
+    async def _complete_limited(provider: LLMProvider, prompt: str, on_chunk: Optional[Callable[[Optional[str]], None]] = None) -> str:
+        """
+        Запрос к провайдеру с учетом общего ограничения числа одновременных запросов.
+        С on_chunk ответ запрашивается потоком: сначала передается None (показанный текст прошлой попытки
+        нужно сбросить), затем очищенные от эмодзи фрагменты.
+        """
+        # Семафор занимается внутри complete после ожидания квоты
+        if on_chunk is None:
+            return await provider.complete(prompt, concurrency=llm_pool.semaphore())
+        on_chunk(None)
+        
+        def forward_chunk(chunk: str):
+            cleaned = ReviewAnalyzer._clean_response(chunk)
+            if cleaned:
+                on_chunk(cleaned)
+        
+        return await provider.complete(prompt, on_chunk=forward_chunk, concurrency=llm_pool.semaphore())
+    
+    @staticmethod
+    def _hedge_backup(primary: LLMProvider) -> Optional[LLMProvider]:
+        """Резервный провайдер для дублирования запроса к Groq, если он настроен и может ответить без ожидания квоты"""
+        if not isinstance(primary, GroqProvider) or not GITHUB_MODELS_AVAILABLE:
+            return None
+        token = ReviewAnalyzer._get_github_token()
+        if not token or llm_pool.wait_time(GitHubModelsProvider) > 0:
+            return None
+        return llm_pool.github(token)
+    
+    @staticmethod
+    async def _complete_hedged(primary: LLMProvider, prompt: str, backup_prompt: str,
+                               on_chunk: Optional[Callable[[Optional[str]], None]] = None) -> Optional[str]:
+        """
+        Запрос к основному провайдеру с хеджированием (llm_pool.hedging). Если основной провайдер не ответил
+        (для потока - не прислал первый фрагмент) за перцентиль своих недавних задержек, тот же промпт
+        (backup_prompt - вариант под лимит резервного провайдера) отправляется резервному и берется первый ответ;
+        второй запрос отменяется. Число дублей ограничено llm_pool.hedge_budget.
+        Ошибка одного провайдера не прерывает ожидание другого.
+        """
+        streaming = on_chunk is not None
+        delay = primary.latency_percentile(streaming, llm_pool.hedge_percentile) if llm_pool.hedging else None
+        backup = ReviewAnalyzer._hedge_backup(primary) if delay is not None else None
+        if backup is None:
+            return await ReviewAnalyzer._complete_limited(primary, prompt, on_chunk)
+        llm_pool.hedge_budget.note_request()
+        
+        tasks: Dict[asyncio.Task, LLMProvider] = {}
+        # Провайдер, чей потоковый ответ показывается; запросы остальных отменяются
+        winner: List[LLMProvider] = []
+        
+        def gate(provider: LLMProvider) -> Optional[Callable[[Optional[str]], None]]:
+            if not streaming:
+                return None
+            
+            def forward(chunk: Optional[str]):
+                if not winner:
+                    if chunk is None:
+                        return
+                    winner.append(provider)
+                    for task, task_provider in tasks.items():
+                        if task_provider is not provider:
+                            task.cancel()
+                    on_chunk(None)
+                if winner[0] is provider and chunk is not None:
+                    on_chunk(chunk)
+            return forward
+        
+        def start(provider: LLMProvider, provider_prompt: str):
+            task = asyncio.ensure_future(ReviewAnalyzer._complete_limited(provider, provider_prompt, gate(provider)))
+            tasks[task] = provider
+        
+        start(primary, prompt)
+        try:
+            await asyncio.wait(list(tasks), timeout=delay)
+            if not winner and not any(task.done() for task in tasks) and llm_pool.hedge_budget.try_spend():
+                logger.info(f"{primary.name} не ответил за {delay:.1f} с, дублируем запрос в {backup.name}")
+                metrics.inc("llm_hedges", provider=backup.name)
+                start(backup, backup_prompt)
+            
+            errors: Dict[LLMProvider, BaseException] = {}
+            pending = set(tasks)
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task.cancelled():
+                        continue
+                    if task.exception() is not None:
+                        errors[tasks[task]] = task.exception()
+                        logger.warning(f"Ошибка {tasks[task].name} при хеджированном запросе: {str(task.exception())}")
+                        continue
+                    content = task.result()
+                    if content and (not winner or winner[0] is tasks[task]):
+                        if tasks[task] is backup:
+                            logger.info(f"Первым ответил резервный провайдер {backup.name}")
+                            metrics.inc("llm_hedge_wins", provider=backup.name)
+                        return content
+            # Ошибка основного провайдера важнее: по ней решается, переключаться ли на резервный
+            error = errors.get(primary) or errors.get(backup)
+            if error is not None:
+                raise error
+            return None
+        finally:
+            for task in tasks:
+                if not task.done():
+                    task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+    
+    @staticmethod
+    @metrics.timed("llm.fallback", {"provider": "GitHub Models"})
+    async def _get_ai_response_github_async(prompt: str, cancel_token: Optional[CancellationToken] = None,
+                                            on_chunk: Optional[Callable[[Optional[str]], None]] = None) -> str:
         """
         Получает ответ от модели ИИ через GitHub Models API
         Используется как запасной вариант при ошибке 429 от Groq
@@ -185,31 +1069,15 @@ class ReviewAnalyzer:
         if not token:
             return "Ошибка: Не найден токен GitHub. Укажите GITHUB_TOKEN в файле .env"
         
+        provider = llm_pool.github(token)
         try:
-            logger.info(f"Используем GitHub Models API с моделью {ReviewAnalyzer.GITHUB_MODEL_NAME}")
-            
-            client = ChatCompletionsClient(
-                endpoint=ReviewAnalyzer.GITHUB_MODELS_ENDPOINT,
-                credential=AzureKeyCredential(token),
-            )
-            
-            response = client.complete(
-                messages=[
-                    SystemMessage("Ты - профессиональный аналитик отзывов о товарах. Твои ответы должны быть структурированными, информативными и строго придерживаться указанного формата без эмодзи."),
-                    UserMessage(prompt),
-                ],
-                temperature=0.3,
-                top_p=0.8,
-                max_tokens=1500,
-                model=ReviewAnalyzer.GITHUB_MODEL_NAME
-            )
+            logger.info(f"Используем GitHub Models API с моделью {provider.model_name}")
+            content = await cancellable(ReviewAnalyzer._complete_limited(provider, prompt, on_chunk), cancel_token)
             
-            if response and response.choices and len(response.choices) > 0:
+            if content:
                 logger.info("Успешно получен ответ от GitHub Models API")
-                content = response.choices[0].message.content
                 # Удаляем эмодзи из ответа
-                clean_response = re.sub(r'[^\w\s\,\.\-\:\;\"\'\(\)\[\]\{\}\?\!]', '', content)
-                return clean_response
+                return ReviewAnalyzer._clean_response(content)
             else:
                 return "Ошибка: Не удалось получить ответ от GitHub Models API"
                 
@@ -218,13 +1086,21 @@ class ReviewAnalyzer:
             return f"Ошибка GitHub Models API: {str(e)}"
     
     @staticmethod
-    def _get_ai_response(prompt: str, max_attempts: int = 3) -> str:
+    async def _get_ai_response_async(prompt: str, max_attempts: int = 3, fallback_prompt: Optional[str] = None,
+                                     cancel_token: Optional[CancellationToken] = None,
+                                     on_chunk: Optional[Callable[[Optional[str]], None]] = None) -> str:
         """
-        Получает ответ от модели ИИ через Groq API с несколькими попытками в случае ошибки
+        Получает ответ от модели ИИ через Groq API с несколькими попытками в случае ошибки.
+        Паузы между попытками не блокируют цикл событий, поэтому несколько анализов выполняются одновременно.
+        fallback_prompt - вариант промпта под меньший лимит резервного GitHub Models API (по умолчанию prompt).
+        При отмене cancel_token текущий запрос и паузы прерываются с asyncio.CancelledError.
+        on_chunk получает фрагменты ответа по мере генерации; None перед каждой попыткой означает,
+        что ранее переданный текст нужно сбросить.
         """
-        # Проверяем, следует ли использовать Groq API или сразу GitHub Models API
-        if not ReviewAnalyzer._should_try_groq_api():
-            return ReviewAnalyzer._get_ai_response_github(prompt)
+        # Выбираем провайдера заранее, чтобы не тратить запрос на заведомый отказ 429
+        if not ReviewAnalyzer._should_try_groq_api(ReviewAnalyzer._request_tokens(prompt)):
+            metrics.inc("llm_fallbacks", reason="quota")
+            return await ReviewAnalyzer._get_ai_response_github_async(fallback_prompt or prompt, cancel_token, on_chunk)
             
         api_key = ReviewAnalyzer._get_api_key()
         
@@ -242,82 +1118,59 @@ class ReviewAnalyzer:
         
         if not GROQ_AVAILABLE:
             logger.warning("Библиотека Groq недоступна, используем GitHub Models API")
-            return ReviewAnalyzer._get_ai_response_github(prompt)
-            
-        # Устанавливаем API ключ напрямую в переменную окружения
-        os.environ["GROQ_API_KEY"] = api_key
+            metrics.inc("llm_fallbacks", reason="groq_unavailable")
+            return await ReviewAnalyzer._get_ai_response_github_async(fallback_prompt or prompt, cancel_token, on_chunk)
         
-        model_name = "meta-llama/llama-4-scout-17b-16e-instruct"
-        try:
-            # Создаем кастомный HTTP клиент без автоматических retry
-            transport = httpx.HTTPTransport(retries=0)
-            http_client = httpx.Client(transport=transport)
-            
-            # Используем класс Groq с кастомным клиентом
-            client = Groq(api_key=api_key, http_client=http_client)
-        except Exception as e:
-            logger.error(f"Ошибка при инициализации клиента Groq: {str(e)}")
-            # Пробуем резервный API
-            return ReviewAnalyzer._get_ai_response_github(prompt)
+        provider = llm_pool.groq(api_key)
         
         for attempt in range(max_attempts):
+            if cancel_token is not None:
+                cancel_token.raise_if_cancelled()
+            # Этап попытки для журнала, если она завершится непредвиденной ошибкой
+            stage = "запрос к модели"
             try:
-                logger.info(f"Попытка {attempt+1} получить ответ от модели {model_name}")
+                logger.info(f"Попытка {attempt+1} получить ответ от модели {provider.model_name}")
                 
-                # Отправляем запрос к Groq API
-                response = client.chat.completions.create(
-                    model=model_name,
-                    messages=[
-                        {"role": "system", "content": "Ты - профессиональный аналитик отзывов о товарах. Твои ответы должны быть структурированными, информативными и строго придерживаться указанного формата без эмодзи."},
-                        {"role": "user", "content": prompt}
-                    ],
-                    temperature=0.3,
-                    max_tokens=1500,
-                    top_p=0.8
-                )
+                with metrics.span("llm.attempt", {"provider": provider.name}, attempt=attempt + 1):
+                    content = await cancellable(
+                        ReviewAnalyzer._complete_hedged(provider, prompt, fallback_prompt or prompt, on_chunk), cancel_token
+                    )
                 
-                if response and response.choices and len(response.choices) > 0:
+                if content:
                     logger.info("Успешно получен ответ от модели")
-                    content = response.choices[0].message.content
+                    stage = "обработка ответа модели"
                     # Удаляем эмодзи из ответа
-                    clean_response = re.sub(r'[^\w\s\,\.\-\:\;\"\'\(\)\[\]\{\}\?\!]', '', content)
-                    return clean_response
+                    return ReviewAnalyzer._clean_response(content)
                 
                 logger.warning("Получен пустой ответ от модели, попробуем еще раз")
-                time.sleep(2)  # Небольшая задержка перед следующей попыткой
+                stage = "пауза перед повторной попыткой"
+                await cancellable(asyncio.sleep(2), cancel_token)  # Небольшая задержка перед следующей попыткой
                 
-            except httpx.HTTPStatusError as e:
-                status_code = e.response.status_code
-                error_str = str(e)
-                logger.error(f"HTTP ошибка при получении ответа от модели: {error_str}")
+            except LLMProviderError as e:
+                logger.error(f"Ошибка при получении ответа от модели: {str(e)}")
                 
                 # Проверяем, является ли ошибка 429 (Too Many Requests)
-                if status_code == 429:
+                if e.rate_limited:
                     logger.warning("Обнаружено ограничение запросов (429). Переключаемся на GitHub Models API")
-                    # Помечаем Groq API как временно недоступный
-                    ReviewAnalyzer._mark_groq_api_rate_limited()
+                    # Пауза до retry-after уже учтена ограничителем запросов провайдера.
                     # Используем GitHub Models API как резервный вариант
-                    return ReviewAnalyzer._get_ai_response_github(prompt)
-                
-                time.sleep(3)  # Увеличиваем задержку после ошибки
-            
-            except Exception as e:
-                error_str = str(e)
-                logger.error(f"Ошибка при получении ответа от модели: {error_str}")
+                    metrics.inc("llm_fallbacks", reason="rate_limited")
+                    return await ReviewAnalyzer._get_ai_response_github_async(fallback_prompt or prompt, cancel_token, on_chunk)
                 
-                # Проверяем, является ли ошибка связана с ограничением запросов
-                if "429" in error_str or "too many requests" in error_str.lower():
-                    logger.warning("Обнаружено ограничение запросов. Переключаемся на GitHub Models API")
-                    # Помечаем Groq API как временно недоступный
-                    ReviewAnalyzer._mark_groq_api_rate_limited()
-                    # Используем GitHub Models API как резервный вариант
-                    return ReviewAnalyzer._get_ai_response_github(prompt)
+                stage = "пауза перед повторной попыткой"
+                await cancellable(asyncio.sleep(3), cancel_token)  # Увеличиваем задержку после ошибки
                 
-                time.sleep(3)  # Увеличиваем задержку после ошибки
+            except Exception as e:
+                logger.error(f"Непредвиденная ошибка {provider.name} на этапе \"{stage}\" (попытка {attempt+1}): "
+                             f"{type(e).__name__}: {str(e)}")
+                # Пробуем резервный API
+                metrics.inc("llm_fallbacks", reason="unexpected_error")
+                return await ReviewAnalyzer._get_ai_response_github_async(fallback_prompt or prompt, cancel_token, on_chunk)
                 
         # Последняя попытка - попробуем GitHub Models API
         logger.warning("Все попытки с Groq исчерпаны, пробуем GitHub Models API")
-        return ReviewAnalyzer._get_ai_response_github(prompt)
+        metrics.inc("llm_fallbacks", reason="attempts_exhausted")
+        return await ReviewAnalyzer._get_ai_response_github_async(fallback_prompt or prompt, cancel_token, on_chunk)
     
     @staticmethod
     def _format_analysis(raw_analysis: str) -> str:
@@ -372,18 +1225,155 @@ class ReviewAnalyzer:
         )
         return prompt
 
+    @staticmethod
+    def _is_error_response(response: str) -> bool:
+        """Проверяет, является ли ответ модели сообщением об ошибке"""
+        return response.startswith("Ошибка") or "tokens_limit_reached" in response
+    
+    @classmethod
+    async def analyze_reviews_map_reduce_async(cls, reviews: List[Any], product_name: str,
+                                               on_chunk: Optional[Callable[[Optional[str]], None]] = None,
+                                               scores: Optional[List[float]] = None) -> str:
+        """
+        Анализирует отзывы в режиме map-reduce: отзывы делятся на части по бюджету токенов,
+        части обобщаются параллельными запросами, затем выжимки сводятся в итоговый анализ.
+        Если частей больше MAP_REDUCE_MAX_CHUNKS, в анализ идут самые информативные отзывы
+        (scores - оценки из preprocess_reviews). Потоком (on_chunk) передается только итоговый анализ;
+        о частях и группах выжимок, которые не удалось обработать, сообщает примечание в конце анализа.
+        """
+        chunks = cls._split_reviews_into_chunks(reviews, cls.MAP_REDUCE_CHUNK_TOKENS)
+        max_chunks = max(1, cls.MAP_REDUCE_MAX_CHUNKS)
+        if len(chunks) > max_chunks:
+            # Запас на неполное заполнение частей при разбиении
+            planned_reviews, dropped_count = cls._plan_reviews(
+                reviews, int(max_chunks * cls.MAP_REDUCE_CHUNK_TOKENS * 0.9), scores)
+            chunks = cls._split_reviews_into_chunks(planned_reviews, cls.MAP_REDUCE_CHUNK_TOKENS)[:max_chunks]
+            logger.info(f"Режим map-reduce: не больше {max_chunks} частей, не вошли {dropped_count} наименее информативных отзывов")
+        if len(chunks) <= 1:
+            prompt = cls._generate_ai_prompt(chunks[0] if chunks else [], product_name)
+            return cls._format_analysis(await cls._get_ai_response_async(prompt, on_chunk=on_chunk))
+        
+        logger.info(f"Режим map-reduce: {len(reviews)} отзывов разбиты на {len(chunks)} частей для товара '{product_name}'")
+        map_prompts = [cls._generate_map_prompt(chunk, product_name, i, len(chunks)) for i, chunk in enumerate(chunks)]
+        
+        # Не более MAP_REDUCE_MAX_WORKERS частей одного товара одновременно (общий лимит задает llm_pool)
+        map_semaphore = asyncio.Semaphore(max(1, cls.MAP_REDUCE_MAX_WORKERS))
+        
+        async def summarize_chunk(map_prompt: str) -> str:
+            async with map_semaphore:
+                return await cls._get_ai_response_async(map_prompt)
+        
+        partial_responses = list(await asyncio.gather(*(summarize_chunk(map_prompt) for map_prompt in map_prompts)))
+        
+        partial_summaries = [response for response in partial_responses if not cls._is_error_response(response)]
+        if not partial_summaries:
+            logger.error("Не удалось получить ни одной выжимки на этапе map")
+            return partial_responses[0]
+        notes = []
+        failed_chunks = len(partial_responses) - len(partial_summaries)
+        if failed_chunks:
+            logger.warning(f"Получено {len(partial_summaries)} из {len(partial_responses)} выжимок, продолжаем с имеющимися")
+            notes.append(f"не удалось обработать {failed_chunks} из {len(partial_responses)} частей отзывов")
+        
+        reduce_prompt = cls._generate_reduce_prompt(partial_summaries, product_name, len(reviews))
+        while len(partial_summaries) > 1 and cls._estimate_tokens(reduce_prompt) > cls.REDUCE_MAX_INPUT_TOKENS:
+            merged, failed_groups, total_groups = await cls._merge_summaries(partial_summaries, product_name, map_semaphore)
+            if failed_groups:
+                notes.append(f"не удалось объединить {failed_groups} из {total_groups} групп выжимок")
+            if merged is None:
+                break
+            partial_summaries = merged
+            reduce_prompt = cls._generate_reduce_prompt(partial_summaries, product_name, len(reviews))
+        
+        raw_analysis = await cls._get_ai_response_async(reduce_prompt, on_chunk=on_chunk)
+        formatted_analysis = cls._format_analysis(raw_analysis)
+        if notes and not cls._is_error_response(raw_analysis):
+            note = f"\n\nПримечание: {'; '.join(notes)}, анализ составлен по остальным отзывам."
+            formatted_analysis += note
+            if on_chunk is not None:
+                on_chunk(note)
+        return formatted_analysis
+    
+    @classmethod
+    async def _merge_summaries(cls, partial_summaries: List[str], product_name: str,
+                               semaphore: asyncio.Semaphore) -> Tuple[Optional[List[str]], int, int]:
+        """
+        Один уровень промежуточного reduce: выжимки делятся на группы, помещающиеся в REDUCE_MAX_INPUT_TOKENS,
+        и каждая группа объединяется в одну выжимку.
+        
+        Returns:
+            (новые выжимки или None, если ни одна группа не объединилась; число неудачных групп; число групп)
+        """
+        template_tokens = cls._prompt_template_tokens(cls._generate_merge_prompt, product_name, 0, 1)
+        # Запас на заголовки "--- Выжимка N ---" перед каждой выжимкой
+        headers_tokens = 2 * cls.REVIEW_LINE_OVERHEAD_TOKENS * len(partial_summaries)
+        groups = cls._split_reviews_into_chunks(partial_summaries,
+                                                max(cls.REDUCE_MAX_INPUT_TOKENS - template_tokens - headers_tokens, 1))
+        if len(groups) >= len(partial_summaries):
+            # Каждая выжимка заняла целую группу: объединяем попарно, иначе число выжимок не уменьшится
+            groups = [partial_summaries[i:i + 2] for i in range(0, len(partial_summaries), 2)]
+        logger.info(f"Выжимки не помещаются в один промпт reduce: объединяем {len(partial_summaries)} выжимок в {len(groups)} групп")
+        
+        async def merge_group(index: int, group: List[str]) -> str:
+            if len(group) == 1:
+                return group[0]
+            async with semaphore:
+                return await cls._get_ai_response_async(cls._generate_merge_prompt(group, product_name, index, len(groups)))
+        
+        merged = list(await asyncio.gather(*(merge_group(i, group) for i, group in enumerate(groups))))
+        successful = [summary for summary in merged if not cls._is_error_response(summary)]
+        failed_groups = len(merged) - len(successful)
+        if not successful:
+            logger.error("Не удалось объединить ни одной группы выжимок, выполняем reduce по имеющимся")
+            return None, failed_groups, len(groups)
+        if failed_groups:
+            logger.warning(f"Объединено {len(successful)} из {len(merged)} групп выжимок, продолжаем с имеющимися")
+        return successful, failed_groups, len(groups)
+    
+    @classmethod
+    def _analysis_key(cls, reviews: List[Any], product_name: str, map_reduce: Optional[bool]) -> str:
+        """Ключ анализа для объединения одновременных вызовов: хеш названия товара, режима и текстов отзывов"""
+        digest = hashlib.sha256(f"{product_name}\x00{map_reduce}".encode("utf-8"))
+        for review in reviews:
+            digest.update(b"\x00")
+            digest.update(cls._review_to_text(review).encode("utf-8"))
+        return digest.hexdigest()
+    
     @classmethod
-    def analyze_reviews(cls, reviews: List[str], product_name: str) -> str:
+    async def analyze_reviews_async(cls, reviews: List[Review], product_name: str, map_reduce: Optional[bool] = None,
+                                    cancel_token: Optional[CancellationToken] = None,
+                                    on_chunk: Optional[Callable[[Optional[str]], None]] = None) -> str:
         """
-        Анализирует отзывы с помощью модели Llama-4-Scout через Groq API
+        Анализирует отзывы с помощью модели Llama-4-Scout через Groq API.
+        Одновременные вызовы с теми же отзывами и названием товара разделяют один анализ.
+        При отмене cancel_token вызывающий сразу получает asyncio.CancelledError; общий анализ
+        прерывается, только если его больше никто не ждет.
         
         Args:
-            reviews: Список строк с отзывами
+            reviews: Список отзывов (записи Review из WbReview.parse; поддерживаются также строки и словари)
             product_name: Название товара
+            map_reduce: Использовать режим map-reduce: все отзывы анализируются по частям
+                (не больше MAP_REDUCE_MAX_CHUNKS). По умолчанию - MAP_REDUCE_ENABLED (LLM_MAP_REDUCE=1)
+            cancel_token: Токен отмены анализа
+            on_chunk: Получает текст анализа по мере генерации (см. AnalysisStreamFormatter);
+                при объединении одновременных вызовов поток получает только первый из них
             
         Returns:
             Строка с отформатированным анализом отзывов
         """
+        key = cls._analysis_key(reviews, product_name, map_reduce)
+        return await cancellable(
+            cls._analysis_flight.do(key, lambda: cls._analyze_reviews(reviews, product_name, map_reduce, on_chunk)),
+            cancel_token
+        )
+    
+    @classmethod
+    @metrics.timed("analysis.total", attrs=lambda cls, reviews, product_name, *args, **kwargs: {
+        "product": product_name, "reviews": len(reviews)})
+    async def _analyze_reviews(cls, reviews: List[Any], product_name: str, map_reduce: Optional[bool],
+                               on_chunk: Optional[Callable[[Optional[str]], None]] = None) -> str:
+        if on_chunk is not None:
+            on_chunk = AnalysisStreamFormatter(on_chunk)
         try:
             logger.info(f"Начинаем анализ {len(reviews)} отзывов для товара '{product_name}'")
             
@@ -392,21 +1382,46 @@ class ReviewAnalyzer:
 
 Для товара "{product_name}" не найдено отзывов."""
             
-            # Ограничиваем количество и объем отзывов (слишком много отзывов может превысить контекст модели)
-            max_reviews = min(len(reviews), 100)  # Не более 100 отзывов
-            truncated_reviews = cls._truncate_reviews(reviews[:max_reviews])
+            # Убираем пустые, повторяющиеся и малоинформативные отзывы, чтобы не тратить на них бюджет промпта
+            with metrics.span("analysis.preprocess", reviews=len(reviews)) as span:
+                reviews, review_scores, preprocess_stats = preprocess_reviews(reviews)
+                span.set(kept=preprocess_stats["kept"])
+            logger.info(
+                f"Предобработка отзывов: из {preprocess_stats['total']} осталось {preprocess_stats['kept']} "
+                f"(пустых {preprocess_stats['empty']}, дубликатов {preprocess_stats['exact_duplicates']}, "
+                f"почти-дубликатов {preprocess_stats['near_duplicates']}, малоинформативных {preprocess_stats['low_information']}) "
+                f"за {preprocess_stats['elapsed_ms']} мс"
+            )
+            
+            if map_reduce is None:
+                map_reduce = cls.MAP_REDUCE_ENABLED
             
-            # Если осталось слишком мало отзывов после обрезки
-            if len(truncated_reviews) < 3 and len(reviews) >= 3:
-                # Берем только первые 200 символов из каждого отзыва
-                shortened_reviews = [review[:200] + ("..." if len(review) > 200 else "") for review in reviews[:30]]
-                truncated_reviews = shortened_reviews
+            if map_reduce:
+                formatted_analysis = await cls.analyze_reviews_map_reduce_async(reviews, product_name, on_chunk,
+                                                                                review_scores)
+                logger.info(f"Анализ для товара '{product_name}' (map-reduce) завершен")
+                return formatted_analysis
+            
+            # Подбираем отзывы под бюджет токенов провайдера, который будет отвечать
+            primary_provider = GroqProvider if cls._should_try_groq_api() else GitHubModelsProvider
+            planned_reviews, dropped_count = cls._plan_reviews(reviews, cls._review_token_budget(primary_provider, product_name),
+                                                               review_scores)
+            if dropped_count > 0:
+                logger.info(f"В промпт вошли {len(planned_reviews)} отзывов, не поместились {dropped_count}")
             
             # Генерируем промпт для ИИ
-            prompt = cls._generate_ai_prompt(truncated_reviews, product_name)
+            prompt = cls._generate_ai_prompt(planned_reviews, product_name)
+            
+            # Отдельный промпт под меньший лимит резервного API на случай переключения
+            fallback_prompt = None
+            if primary_provider is not GitHubModelsProvider:
+                fallback_reviews, _ = cls._plan_reviews(reviews, cls._review_token_budget(GitHubModelsProvider, product_name),
+                                                        review_scores)
+                if len(fallback_reviews) < len(planned_reviews):
+                    fallback_prompt = cls._generate_ai_prompt(fallback_reviews, product_name)
             
             # Получаем ответ от ИИ
-            raw_analysis = cls._get_ai_response(prompt)
+            raw_analysis = await cls._get_ai_response_async(prompt, fallback_prompt=fallback_prompt, on_chunk=on_chunk)
             
             # Форматируем ответ
             formatted_analysis = cls._format_analysis(raw_analysis)
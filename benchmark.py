@@ -0,0 +1,378 @@
+# -*- coding: utf-8 -*-
+"""
+Нагрузочный прогон WB Analyzer против локального заменителя Wildberries и LLM (mock_server.py) без сети.
+
+    python benchmark.py --workloads single,compare,batch --iterations 20 --batch-size 50 --json bench.json
+
+Для каждого сценария печатается задержка этапов (p50/p95/p99), число операций и HTTP-запросов
+к заменителю в секунду, ошибки и ответы 429 заменителя и пиковый RSS процесса во время сценария.
+Задержки и ошибки заменителя задаются теми же параметрами, что и у mock_server.py serve.
+Кеши отзывов и ответов LLM, а также ограничитель частоты запросов на время прогона отключены.
+
+Сценарий preprocess не использует заменитель: он замеряет предобработку отзывов (preprocess.py) на
+детерминированных наборах из --preprocess-reviews отзывов и завершает прогон с кодом 1, если медиана
+превышает --preprocess-budget-ms:
+
+    python benchmark.py --workloads preprocess --iterations 20
+"""
+import os
+import sys
+import json
+import time
+import random
+import socket
+import asyncio
+import argparse
+import tempfile
+import contextlib
+import multiprocessing
+import urllib.request
+from typing import Any, Dict, List, Optional, Tuple
+
+from mock_server import MockBackend, add_backend_arguments, backend_from_args, serve
+
+WORKLOADS = ("single", "compare", "batch", "preprocess")
+# Непересекающиеся диапазоны артикулов, чтобы сценарии не объединяли запросы и не попадали в кеши друг друга
+SKU_BASES = {"single": 10000000, "compare": 20000000, "batch": 30000000}
+# Наборы отзывов сценария preprocess: название -> размер словаря (маленький словарь - много похожих отзывов)
+PREPROCESS_DATASETS = {"mixed": 3000, "small_vocab": 60}
+_SHORT_REVIEWS = ["Отлично", "Супер!", "Все ок", "Рекомендую", "Норм", "👍"]
+
+
+def percentile(samples: List[float], q: float) -> float:
+    """Перцентиль методом ближайшего ранга."""
+    if not samples:
+        return 0.0
+    ordered = sorted(samples)
+    rank = max(1, min(len(ordered), int(round(q / 100 * len(ordered) + 0.5))))
+    return ordered[rank - 1]
+
+
+def current_rss_bytes() -> int:
+    """Текущий RSS процесса: psutil, /proc или (в крайнем случае) пиковый RSS из getrusage."""
+    try:
+        import psutil
+        return psutil.Process().memory_info().rss
+    except ImportError:
+        pass
+    try:
+        with open("/proc/self/statm", "r") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, AttributeError):
+        pass
+    try:
+        import resource
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return peak if sys.platform == "darwin" else peak * 1024
+    except ImportError:
+        return 0
+
+
+class StageTimings:
+    """Задержки этапов сценария и пиковый RSS, который снимается фоновой задачей."""
+
+    def __init__(self):
+        self.stages: Dict[str, List[float]] = {}
+        self.peak_rss = current_rss_bytes()
+
+    def add(self, stage: str, seconds: float):
+        self.stages.setdefault(stage, []).append(seconds)
+
+    @contextlib.asynccontextmanager
+    async def stage(self, name: str):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add(name, time.perf_counter() - started)
+
+    async def sample_rss(self, interval: float = 0.05):
+        while True:
+            self.peak_rss = max(self.peak_rss, current_rss_bytes())
+            await asyncio.sleep(interval)
+
+
+def synthetic_reviews(count: int, vocabulary_size: int, seed: int = 0) -> List[Any]:
+    """
+    Детерминированный набор отзывов для замера предобработки: около 10% точных копий, 10% копий
+    с одним замененным словом, 15% однословных отзывов, 10% отзывов только с достоинствами и недостатками,
+    остальные - от 2 до 150 слов из словаря заданного размера.
+    """
+    from models import Review
+
+    rng = random.Random(seed)
+    syllables = ["ка", "ро", "ва", "ни", "то", "ле", "ми", "су", "да", "по", "ре", "ло", "ти", "на", "се", "го"]
+    vocabulary = ["".join(rng.choice(syllables) for _ in range(rng.randint(2, 4))) for _ in range(vocabulary_size)]
+
+    def phrase(max_words: int) -> str:
+        return " ".join(rng.choice(vocabulary) for _ in range(rng.randint(max_words // 2, max_words)))
+
+    reviews = []
+    for _ in range(count):
+        kind = rng.random()
+        if reviews and kind < 0.1:
+            source = rng.choice(reviews)
+            reviews.append(Review(source.text, source.pros, source.cons, source.rating))
+        elif reviews and kind < 0.2:
+            source = rng.choice(reviews)
+            words = source.text.split()
+            if words:
+                words[rng.randrange(len(words))] = rng.choice(vocabulary)
+            reviews.append(Review(" ".join(words), source.pros, source.cons, source.rating))
+        elif kind < 0.35:
+            reviews.append(Review(rng.choice(_SHORT_REVIEWS), rating=5))
+        else:
+            text = phrase(rng.choice([5, 10, 20, 30, 50, 80, 150])) + "." if kind >= 0.45 else ""
+            reviews.append(Review(text, phrase(6), phrase(6), rng.randint(1, 5)))
+    return reviews
+
+
+def _free_port() -> int:
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def _mock_stats(base_url: str) -> Dict[str, Dict[str, int]]:
+    with urllib.request.urlopen(f"{base_url}/__stats", timeout=5) as response:
+        return json.loads(response.read().decode("utf-8"))
+
+
+def start_mock(backend: MockBackend) -> Tuple[multiprocessing.Process, str]:
+    """Запускает заменитель в отдельном процессе, чтобы он не делил цикл событий и память с измеряемым кодом."""
+    port = _free_port()
+    process = multiprocessing.Process(target=serve, args=(backend, "127.0.0.1", port), daemon=True)
+    process.start()
+    base_url = f"http://127.0.0.1:{port}"
+    deadline = time.monotonic() + 15
+    while True:
+        try:
+            _mock_stats(base_url)
+            return process, base_url
+        except OSError:
+            if time.monotonic() > deadline or not process.is_alive():
+                process.terminate()
+                raise RuntimeError("Заменитель не запустился")
+            time.sleep(0.1)
+
+
+def point_to_mock(base_url: str, data_dir: str):
+    """Направляет wb.py и ai.py на заменитель. Вызывается до импорта этих модулей."""
+    os.environ.update({
+        "WB_BASE_URL": base_url,
+        "GROQ_BASE_URL": base_url,
+        "GROQ_API_KEY": "mock",
+        "GITHUB_MODELS_ENDPOINT": base_url,
+        "GITHUB_TOKEN": "mock",
+        "LLM_CACHE_ENABLED": "0",
+        "LLM_RATE_LIMIT_ENABLED": "0",
+        # Кеш отзывов пакетного режима пишется во временный каталог
+        "HOME": data_dir,
+        "USERPROFILE": data_dir,
+    })
+
+
+async def run_single(timings: StageTimings, iterations: int, limit: int, stream: bool):
+    from wb import WbReview
+    from ai import ReviewAnalyzer
+
+    for index in range(iterations):
+        sku = str(SKU_BASES["single"] + index * 10)
+        async with timings.stage("total"):
+            wb_review = WbReview(sku)
+            async with timings.stage("wb.product_info"):
+                await wb_review._init_product_info()
+            async with timings.stage("wb.parse"):
+                reviews = await wb_review.parse(only_this_variation=True, limit=limit, use_cache=False)
+            on_chunk = (lambda chunk: None) if stream else None
+            async with timings.stage("llm.analyze"):
+                await ReviewAnalyzer.analyze_reviews_async(reviews, wb_review.product_name, on_chunk=on_chunk)
+
+
+async def run_compare(timings: StageTimings, iterations: int, limit: int, products: int = 4):
+    from wb import WbReview
+    from ai import ReviewAnalyzer
+
+    async def analyze(result: Dict[str, Any]) -> Dict[str, Any]:
+        started = time.perf_counter()
+        analysis = await ReviewAnalyzer.analyze_reviews_async(result["reviews"], result["instance"].product_name)
+        timings.add("llm.analyze", time.perf_counter() - started)
+        return {"product_name": result["instance"].product_name, "analysis": analysis}
+
+    for index in range(iterations):
+        base = SKU_BASES["compare"] + index * 100
+        skus = [str(base + product * 10) for product in range(products)]
+        async with timings.stage("total"):
+            async with timings.stage("wb.fetch_many"):
+                results = await WbReview.fetch_many(skus, only_this_variation=True, limit=limit, concurrency=products)
+            analyses = await asyncio.gather(*(analyze(result) for result in results if result["instance"] is not None))
+            async with timings.stage("llm.compare"):
+                await ReviewAnalyzer._get_ai_response_async(ReviewAnalyzer._generate_comparison_prompt(list(analyses)))
+
+
+async def run_batch_workload(timings: StageTimings, batch_size: int, limit: int, data_dir: str,
+                             fetch_concurrency: int, llm_concurrency: int):
+    from cli import run_batch
+
+    skus = [str(SKU_BASES["batch"] + index * 10) for index in range(batch_size)]
+    out_path = os.path.join(data_dir, "batch_results.jsonl")
+    async with timings.stage("total"):
+        await run_batch(skus, out_path, fetch_concurrency, llm_concurrency, limit)
+    with open(out_path, "r", encoding="utf-8") as f:
+        for line in f:
+            timings.add("item", json.loads(line)["elapsed_sec"])
+
+
+def run_preprocess(timings: StageTimings, iterations: int, count: int):
+    from preprocess import preprocess_reviews
+
+    for dataset, vocabulary_size in PREPROCESS_DATASETS.items():
+        reviews = synthetic_reviews(count, vocabulary_size)
+        for _ in range(iterations):
+            started = time.perf_counter()
+            preprocess_reviews(reviews)
+            timings.add(f"preprocess.{dataset}", time.perf_counter() - started)
+
+
+async def run_workload(name: str, args: argparse.Namespace, data_dir: str) -> StageTimings:
+    timings = StageTimings()
+    sampler = asyncio.ensure_future(timings.sample_rss())
+    try:
+        if name == "single":
+            await run_single(timings, args.iterations, args.limit, args.stream)
+        elif name == "compare":
+            await run_compare(timings, args.iterations, args.limit)
+        elif name == "preprocess":
+            run_preprocess(timings, args.iterations, args.preprocess_reviews)
+        else:
+            await run_batch_workload(timings, args.batch_size, args.limit, data_dir,
+                                     args.fetch_concurrency, args.llm_concurrency)
+    finally:
+        sampler.cancel()
+    timings.peak_rss = max(timings.peak_rss, current_rss_bytes())
+    return timings
+
+
+def summarize(name: str, timings: StageTimings, elapsed: float, operations: int,
+              stats_before: Dict[str, Dict[str, int]], stats_after: Dict[str, Dict[str, int]]) -> Dict[str, Any]:
+    routes = {}
+    for route, counters in stats_after.items():
+        before = stats_before.get(route, {})
+        routes[route] = {key: value - before.get(key, 0) for key, value in counters.items()}
+    http_requests = sum(counters["requests"] for counters in routes.values())
+    return {
+        "workload": name,
+        "operations": operations,
+        "elapsed_sec": round(elapsed, 3),
+        "operations_per_sec": round(operations / elapsed, 3) if elapsed else 0.0,
+        "http_requests_per_sec": round(http_requests / elapsed, 2) if elapsed else 0.0,
+        "mock_routes": routes,
+        "peak_rss_mb": round(timings.peak_rss / (1024 * 1024), 1),
+        "stages": {
+            stage: {
+                "count": len(samples),
+                "p50_ms": round(percentile(samples, 50) * 1000, 1),
+                "p95_ms": round(percentile(samples, 95) * 1000, 1),
+                "p99_ms": round(percentile(samples, 99) * 1000, 1),
+            }
+            for stage, samples in timings.stages.items()
+        },
+    }
+
+
+def print_report(report: Dict[str, Any]):
+    print(f"\n== {report['workload']}: {report['operations']} операций за {report['elapsed_sec']} с, "
+          f"{report['operations_per_sec']} оп/с, {report['http_requests_per_sec']} HTTP-запросов/с, "
+          f"пиковый RSS {report['peak_rss_mb']} МБ")
+    width = max([18] + [len(stage) + 2 for stage in report["stages"]])
+    print(f"{'этап':<{width}}{'n':>6}{'p50, мс':>12}{'p95, мс':>12}{'p99, мс':>12}")
+    for stage, values in report["stages"].items():
+        print(f"{stage:<{width}}{values['count']:>6}{values['p50_ms']:>12}{values['p95_ms']:>12}{values['p99_ms']:>12}")
+    for route, counters in sorted(report["mock_routes"].items()):
+        if counters["requests"]:
+            print(f"  {route}: запросов {counters['requests']}, ошибок {counters['errors']}, 429: {counters['rate_limited']}")
+
+
+async def run_all(args: argparse.Namespace, base_url: Optional[str], data_dir: str) -> List[Dict[str, Any]]:
+    reports = []
+    try:
+        for name in args.workloads:
+            operations = {"single": args.iterations, "compare": args.iterations, "batch": args.batch_size,
+                          "preprocess": args.iterations * len(PREPROCESS_DATASETS)}[name]
+            # Сценарий preprocess не обращается к заменителю
+            stats_before = _mock_stats(base_url) if base_url else {}
+            started = time.perf_counter()
+            timings = await run_workload(name, args, data_dir)
+            elapsed = time.perf_counter() - started
+            report = summarize(name, timings, elapsed, operations, stats_before,
+                               _mock_stats(base_url) if base_url else {})
+            print_report(report)
+            reports.append(report)
+    finally:
+        if base_url:
+            from wb import shutdown as wb_shutdown
+            from ai import shutdown as ai_shutdown
+            await asyncio.gather(wb_shutdown(), ai_shutdown())
+    return reports
+
+
+def check_preprocess_budget(reports: List[Dict[str, Any]], budget_ms: float) -> bool:
+    """Проверяет, что медиана предобработки каждого набора отзывов укладывается в бюджет."""
+    within_budget = True
+    for report in reports:
+        for stage, values in report["stages"].items():
+            if stage.startswith("preprocess.") and values["p50_ms"] > budget_ms:
+                print(f"BENCHMARK: {stage}: медиана {values['p50_ms']} мс превышает бюджет {budget_ms:g} мс",
+                      file=sys.stderr)
+                within_budget = False
+    return within_budget
+
+
+def build_parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(prog="benchmark.py", description="Нагрузочный прогон против mock_server.py")
+    parser.add_argument("--workloads", default=",".join(WORKLOADS),
+                        help="сценарии через запятую: single, compare, batch, preprocess")
+    parser.add_argument("--iterations", type=int, default=20, help="повторов сценариев single и compare")
+    parser.add_argument("--batch-size", type=int, default=50, help="товаров в сценарии batch")
+    parser.add_argument("--limit", type=int, default=300, help="максимум отзывов на товар")
+    parser.add_argument("--stream", action="store_true", help="запрашивать анализ потоком в сценарии single")
+    parser.add_argument("--fetch-concurrency", type=int, default=8, help="одновременных загрузок в сценарии batch")
+    parser.add_argument("--llm-concurrency", type=int, default=4, help="одновременных запросов к LLM в сценарии batch")
+    parser.add_argument("--preprocess-reviews", type=int, default=5000, help="отзывов в наборах сценария preprocess")
+    parser.add_argument("--preprocess-budget-ms", type=float, default=50.0,
+                        help="допустимая медиана предобработки одного набора отзывов, мс")
+    parser.add_argument("--json", default=None, help="сохранить отчет в JSON")
+    add_backend_arguments(parser)
+    return parser
+
+
+def main(argv=None) -> int:
+    args = build_parser().parse_args(argv)
+    args.workloads = [name.strip() for name in args.workloads.split(",") if name.strip()]
+    unknown = [name for name in args.workloads if name not in WORKLOADS]
+    if unknown:
+        print(f"BENCHMARK: неизвестные сценарии: {', '.join(unknown)}", file=sys.stderr)
+        return 2
+
+    # Заменитель нужен только сценариям, которые обращаются к Wildberries и LLM
+    process, base_url = None, None
+    if any(name != "preprocess" for name in args.workloads):
+        process, base_url = start_mock(backend_from_args(args))
+    try:
+        with tempfile.TemporaryDirectory(prefix="wb-bench-") as data_dir:
+            if base_url:
+                point_to_mock(base_url, data_dir)
+            reports = asyncio.run(run_all(args, base_url, data_dir))
+    finally:
+        if process is not None:
+            process.terminate()
+            process.join(5)
+
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump(reports, f, ensure_ascii=False, indent=2)
+    return 0 if check_preprocess_budget(reports, args.preprocess_budget_ms) else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,356 @@
+import os
+import json
+import hashlib
+import time
+import sqlite3
+from contextlib import contextmanager
+from typing import List, Dict, Optional, Any
+
+from metrics import metrics
+
+
+def get_app_data_dir() -> str:
+    """
+    Возвращает директорию данных приложения (та же, что и для истории анализов):
+    ~/Documents/WB-Analyzer или ~/WB-Analyzer, если папки "Документы" нет.
+    """
+    home_path = os.path.expanduser("~")
+    documents_path = os.path.join(home_path, "Documents")
+    base_dir = documents_path if os.path.isdir(documents_path) else home_path
+    app_dir = os.path.join(base_dir, "WB-Analyzer")
+    os.makedirs(app_dir, exist_ok=True)
+    return app_dir
+
+
+class SqliteStore:
+    """Базовый класс хранилищ на SQLite: одно короткое соединение на операцию, безопасно между процессами."""
+
+    def __init__(self, db_path: str):
+        self.db_path = db_path
+        self._init_db()
+
+    @contextmanager
+    def _connect(self):
+        """Открывает соединение с базой, фиксирует транзакцию и закрывает соединение."""
+        conn = sqlite3.connect(self.db_path, timeout=10)
+        try:
+            with conn:
+                yield conn
+        finally:
+            conn.close()
+
+    def _init_db(self):
+        raise NotImplementedError
+
+
+class ReviewCache(SqliteStore):
+    """
+    Локальное хранилище отзывов Wildberries в SQLite, ключ - imtId (root_id) товара.
+
+    Пока запись свежая (моложе ttl секунд), отзывы отдаются из кеша без сетевых запросов.
+    После истечения ttl подгружаются только отзывы новее самого нового сохраненного.
+    Счетчики попаданий/промахов хранятся в той же базе и накапливаются между процессами.
+    """
+
+    DEFAULT_TTL = 6 * 60 * 60
+
+    def __init__(self, db_path: Optional[str] = None, ttl: Optional[float] = None):
+        if db_path is None:
+            db_path = os.path.join(get_app_data_dir(), "reviews_cache.sqlite3")
+        if ttl is None:
+            ttl = float(os.environ.get("WB_REVIEW_CACHE_TTL", self.DEFAULT_TTL))
+        self.ttl = ttl
+        super().__init__(db_path)
+
+    def _init_db(self):
+        with self._connect() as conn:
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS products (
+                    root_id TEXT PRIMARY KEY,
+                    fetched_at REAL NOT NULL,
+                    newest_date TEXT NOT NULL DEFAULT '',
+                    complete INTEGER NOT NULL DEFAULT 0
+                )""")
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS feedbacks (
+                    root_id TEXT NOT NULL,
+                    feedback_id TEXT NOT NULL,
+                    created_date TEXT NOT NULL DEFAULT '',
+                    data TEXT NOT NULL,
+                    PRIMARY KEY (root_id, feedback_id)
+                )""")
+            conn.execute("CREATE INDEX IF NOT EXISTS idx_feedbacks_date ON feedbacks (root_id, created_date DESC)")
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS stats (
+                    key TEXT PRIMARY KEY,
+                    value INTEGER NOT NULL DEFAULT 0
+                )""")
+
+    @staticmethod
+    def _feedback_key(feedback: Dict[str, Any]) -> str:
+        """Идентификатор отзыва; для отзывов без id используется дата и nmId."""
+        feedback_id = feedback.get("id")
+        if feedback_id:
+            return str(feedback_id)
+        text_hash = hashlib.md5(str(feedback.get("text", "")).encode("utf-8")).hexdigest()
+        return f"{feedback.get('createdDate', '')}:{feedback.get('nmId', '')}:{text_hash}"
+
+    def get_state(self, root_id: str) -> Optional[Dict[str, Any]]:
+        """
+        Возвращает {"fetched_at", "newest_date", "complete", "fresh"} для товара или None, если товара нет в кеше.
+        complete означает, что в кеше лежат все отзывы товара, а не только первые страницы.
+        """
+        with self._connect() as conn:
+            row = conn.execute("SELECT fetched_at, newest_date, complete FROM products WHERE root_id = ?", (str(root_id),)).fetchone()
+        if row is None:
+            return None
+        fetched_at, newest_date, complete = row
+        return {
+            "fetched_at": fetched_at,
+            "newest_date": newest_date,
+            "complete": bool(complete),
+            "fresh": (time.time() - fetched_at) < self.ttl,
+        }
+
+    def load(self, root_id: str) -> List[Dict[str, Any]]:
+        """Загружает сохраненные отзывы товара, от новых к старым."""
+        with self._connect() as conn:
+            rows = conn.execute(
+                "SELECT data FROM feedbacks WHERE root_id = ? ORDER BY created_date DESC",
+                (str(root_id),)
+            ).fetchall()
+        return [json.loads(row[0]) for row in rows]
+
+    def known_ids(self, root_id: str) -> set:
+        """Множество идентификаторов уже сохраненных отзывов товара."""
+        with self._connect() as conn:
+            rows = conn.execute("SELECT feedback_id FROM feedbacks WHERE root_id = ?", (str(root_id),)).fetchall()
+        return {row[0] for row in rows}
+
+    def store(self, root_id: str, feedbacks: List[Dict[str, Any]], replace: bool = False):
+        """
+        Сохраняет отзывы товара и обновляет время последней загрузки.
+        replace=True полностью заменяет сохраненные отзывы (полная загрузка),
+        иначе новые отзывы добавляются к уже сохраненным (инкрементальное обновление).
+        """
+        root_id = str(root_id)
+        rows = []
+        for feedback in feedbacks:
+            if not isinstance(feedback, dict):
+                continue
+            rows.append((root_id, self._feedback_key(feedback), str(feedback.get("createdDate") or ""),
+                         json.dumps(feedback, ensure_ascii=False)))
+
+        with self._connect() as conn:
+            if replace:
+                conn.execute("DELETE FROM feedbacks WHERE root_id = ?", (root_id,))
+            conn.executemany(
+                "INSERT OR REPLACE INTO feedbacks (root_id, feedback_id, created_date, data) VALUES (?, ?, ?, ?)",
+                rows
+            )
+            newest = conn.execute("SELECT MAX(created_date) FROM feedbacks WHERE root_id = ?", (root_id,)).fetchone()[0]
+            conn.execute(
+                "INSERT INTO products (root_id, fetched_at, newest_date) VALUES (?, ?, ?) "
+                "ON CONFLICT(root_id) DO UPDATE SET fetched_at = excluded.fetched_at, newest_date = excluded.newest_date"
+                + (", complete = 0" if replace else ""),
+                (root_id, time.time(), newest or "")
+            )
+
+    def mark_complete(self, root_id: str, complete: bool):
+        """Отмечает, сохранены ли в кеше все отзывы товара."""
+        with self._connect() as conn:
+            conn.execute("UPDATE products SET complete = ? WHERE root_id = ?", (int(complete), str(root_id)))
+
+    def record(self, **counters: int):
+        """
+        Увеличивает накопительные счетчики (hits, misses, refreshes, served_from_cache, downloaded).
+        Счетчики текущего процесса дублируются в metrics (wb_analyzer_review_cache_total{event=...}).
+        """
+        for key, value in counters.items():
+            metrics.inc("review_cache", value, event=key)
+        with self._connect() as conn:
+            for key, value in counters.items():
+                conn.execute(
+                    "INSERT INTO stats (key, value) VALUES (?, ?) ON CONFLICT(key) DO UPDATE SET value = value + excluded.value",
+                    (key, int(value))
+                )
+
+    def stats(self) -> Dict[str, int]:
+        """Возвращает накопленные счетчики кеша."""
+        with self._connect() as conn:
+            rows = conn.execute("SELECT key, value FROM stats").fetchall()
+        result = {"hits": 0, "misses": 0, "refreshes": 0, "served_from_cache": 0, "downloaded": 0}
+        result.update({key: value for key, value in rows})
+        return result
+
+    def summary(self) -> str:
+        """Накопленные счетчики одной строкой для журнала."""
+        stats = self.stats()
+        lookups = stats["hits"] + stats["misses"] + stats["refreshes"]
+        hit_rate = (stats["hits"] + stats["refreshes"]) / lookups * 100 if lookups else 0.0
+        return (f"попаданий {stats['hits']}, обновлений {stats['refreshes']}, промахов {stats['misses']} "
+                f"(из кеша {hit_rate:.0f}%); отзывов из кеша {stats['served_from_cache']}, загружено {stats['downloaded']}")
+
+
+class ResponseCache(SqliteStore):
+    """
+    Кеш ответов LLM с адресацией по содержимому: ключ - хеш модели, системного промпта,
+    промпта и параметров генерации. Размер ограничен max_entries (вытесняются давно не использованные
+    записи), ttl в секундах необязателен (0 - без срока жизни).
+    """
+
+    DEFAULT_MAX_ENTRIES = 1000
+
+    def __init__(self, db_path: Optional[str] = None, max_entries: Optional[int] = None, ttl: Optional[float] = None):
+        if db_path is None:
+            db_path = os.path.join(get_app_data_dir(), "llm_cache.sqlite3")
+        if max_entries is None:
+            max_entries = int(os.environ.get("LLM_CACHE_MAX_ENTRIES", self.DEFAULT_MAX_ENTRIES))
+        if ttl is None:
+            ttl = float(os.environ.get("LLM_CACHE_TTL", 0))
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        super().__init__(db_path)
+
+    def _init_db(self):
+        with self._connect() as conn:
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS responses (
+                    key TEXT PRIMARY KEY,
+                    response TEXT NOT NULL,
+                    created_at REAL NOT NULL,
+                    last_access REAL NOT NULL
+                )""")
+            conn.execute("CREATE INDEX IF NOT EXISTS idx_responses_access ON responses (last_access)")
+
+    @staticmethod
+    def make_key(model: str, system_prompt: str, prompt: str, **params: Any) -> str:
+        """Строит ключ кеша из модели, промптов и параметров генерации."""
+        payload = json.dumps([model, system_prompt, prompt, params], ensure_ascii=False, sort_keys=True)
+        return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+    def get(self, key: str) -> Optional[str]:
+        """Возвращает сохраненный ответ или None. Просроченная запись удаляется."""
+        now = time.time()
+        with self._connect() as conn:
+            row = conn.execute("SELECT response, created_at FROM responses WHERE key = ?", (key,)).fetchone()
+            if row is not None and self.ttl > 0 and now - row[1] >= self.ttl:
+                conn.execute("DELETE FROM responses WHERE key = ?", (key,))
+                row = None
+            if row is not None:
+                conn.execute("UPDATE responses SET last_access = ? WHERE key = ?", (now, key))
+        if row is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return row[0]
+
+    def put(self, key: str, response: str):
+        """Сохраняет ответ и вытесняет давно не использованные записи сверх max_entries."""
+        now = time.time()
+        with self._connect() as conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO responses (key, response, created_at, last_access) VALUES (?, ?, ?, ?)",
+                (key, response, now, now)
+            )
+            conn.execute(
+                "DELETE FROM responses WHERE key IN ("
+                "SELECT key FROM responses ORDER BY last_access DESC LIMIT -1 OFFSET ?)",
+                (max(self.max_entries, 0),)
+            )
+
+
+class ProductInfoCache(SqliteStore):
+    """
+    Кеш информации о товарах Wildberries: SKU -> root_id, название, бренд, цвет.
+
+    Информация о товаре почти не меняется, поэтому срок жизни записи долгий (ttl, по умолчанию неделя).
+    Отсутствующие товары тоже запоминаются (отрицательное кеширование) на короткий срок negative_ttl.
+    Таблица без rowid с SKU в первичном ключе: поиск - одно обращение к B-дереву даже при сотнях тысяч записей.
+    """
+
+    DEFAULT_TTL = 7 * 24 * 60 * 60
+    DEFAULT_NEGATIVE_TTL = 60 * 60
+    # Ограничение числа параметров одного запроса SQLite в get_many
+    MAX_QUERY_PARAMS = 500
+
+    def __init__(self, db_path: Optional[str] = None, ttl: Optional[float] = None, negative_ttl: Optional[float] = None):
+        if db_path is None:
+            db_path = os.path.join(get_app_data_dir(), "product_info.sqlite3")
+        if ttl is None:
+            ttl = float(os.environ.get("WB_PRODUCT_INFO_TTL", self.DEFAULT_TTL))
+        if negative_ttl is None:
+            negative_ttl = float(os.environ.get("WB_PRODUCT_INFO_NEGATIVE_TTL", self.DEFAULT_NEGATIVE_TTL))
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        super().__init__(db_path)
+
+    def _init_db(self):
+        with self._connect() as conn:
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS product_info (
+                    sku TEXT PRIMARY KEY,
+                    found INTEGER NOT NULL,
+                    root_id TEXT NOT NULL DEFAULT '',
+                    name TEXT NOT NULL DEFAULT '',
+                    brand TEXT NOT NULL DEFAULT '',
+                    color TEXT NOT NULL DEFAULT '',
+                    fetched_at REAL NOT NULL
+                ) WITHOUT ROWID""")
+
+    def _to_entry(self, row: tuple, now: float) -> Optional[Dict[str, Any]]:
+        found, root_id, name, brand, color, fetched_at = row
+        if now - fetched_at >= (self.ttl if found else self.negative_ttl):
+            return None
+        return {"found": bool(found), "root_id": root_id, "product_name": name, "brand": brand, "color": color}
+
+    def get(self, sku: str) -> Optional[Dict[str, Any]]:
+        """
+        Возвращает {"found", "root_id", "product_name", "brand", "color"} или None, если записи нет или она устарела.
+        found=False - товар не найден на Wildberries (отрицательная запись).
+        """
+        with self._connect() as conn:
+            row = conn.execute(
+                "SELECT found, root_id, name, brand, color, fetched_at FROM product_info WHERE sku = ?", (str(sku),)
+            ).fetchone()
+        return self._to_entry(row, time.time()) if row is not None else None
+
+    def get_many(self, skus: List[str]) -> Dict[str, Dict[str, Any]]:
+        """Свежие записи для нескольких SKU (см. get); отсутствующие и устаревшие SKU в ответ не попадают."""
+        skus = [str(sku) for sku in skus]
+        result: Dict[str, Dict[str, Any]] = {}
+        now = time.time()
+        with self._connect() as conn:
+            for start in range(0, len(skus), self.MAX_QUERY_PARAMS):
+                chunk = skus[start:start + self.MAX_QUERY_PARAMS]
+                rows = conn.execute(
+                    "SELECT sku, found, root_id, name, brand, color, fetched_at FROM product_info "
+                    f"WHERE sku IN ({', '.join('?' * len(chunk))})", chunk
+                ).fetchall()
+                for row in rows:
+                    entry = self._to_entry(row[1:], now)
+                    if entry is not None:
+                        result[row[0]] = entry
+        return result
+
+    def put(self, sku: str, root_id: str, product_name: str, brand: str = "", color: str = ""):
+        """Сохраняет информацию о найденном товаре."""
+        with self._connect() as conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO product_info (sku, found, root_id, name, brand, color, fetched_at) "
+                "VALUES (?, 1, ?, ?, ?, ?, ?)",
+                (str(sku), str(root_id), product_name or "", brand or "", color or "", time.time())
+            )
+
+    def put_missing(self, sku: str):
+        """Запоминает, что товара нет на Wildberries (на negative_ttl секунд)."""
+        with self._connect() as conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO product_info (sku, found, fetched_at) VALUES (?, 0, ?)",
+                (str(sku), time.time())
+            )
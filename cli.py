@@ -0,0 +1,214 @@
+# -*- coding: utf-8 -*-
+"""
+Консольный режим WB Analyzer без графического интерфейса.
+
+Пакетный анализ списка товаров с записью результатов в JSON Lines:
+    python cli.py batch skus.txt --out results.jsonl
+
+Локальный HTTP-сервис (см. server.py):
+    python cli.py serve --port 8080
+
+Файл со списком содержит по одному артикулу или URL Wildberries в строке
+(пустые строки и строки, начинающиеся с #, пропускаются). Выходной файл служит
+контрольной точкой: при повторном запуске уже обработанные товары пропускаются,
+а товары с ошибками обрабатываются заново.
+"""
+import os
+import sys
+import json
+import time
+import asyncio
+import argparse
+import datetime
+import traceback
+from typing import List, Dict, Any, Optional, Set
+
+from wb import WbReview, shutdown as wb_shutdown
+from ai import ReviewAnalyzer, llm_pool, shutdown as ai_shutdown
+
+# Статусы, при которых товар считается обработанным и не повторяется при возобновлении
+FINAL_STATUSES = ("ok", "no_reviews")
+
+
+def read_skus(path: str) -> List[str]:
+    """Читает список артикулов/URL из файла, сохраняя порядок и убирая повторы."""
+    skus = []
+    seen = set()
+    with open(path, "r", encoding="utf-8") as f:
+        for line in f:
+            line = line.strip()
+            if not line or line.startswith("#"):
+                continue
+            if line not in seen:
+                seen.add(line)
+                skus.append(line)
+    return skus
+
+
+def read_checkpoint(path: str) -> Set[str]:
+    """Возвращает входные строки товаров, уже успешно обработанных в предыдущих запусках."""
+    done = set()
+    if not os.path.exists(path):
+        return done
+    with open(path, "r", encoding="utf-8") as f:
+        for line in f:
+            try:
+                record = json.loads(line)
+            except json.JSONDecodeError:
+                # Последняя строка могла оборваться при аварийном завершении
+                continue
+            if record.get("status") in FINAL_STATUSES and record.get("input"):
+                done.add(record["input"])
+    return done
+
+
+async def analyze_sku(sku_input: str, fetch_semaphore: asyncio.Semaphore, reviews_limit: int,
+                      wb_review: Optional[WbReview] = None) -> Dict[str, Any]:
+    """
+    Получает отзывы и анализ одного товара. Возвращает запись статуса для JSONL.
+    wb_review - экземпляр с заранее полученной информацией о товаре (см. run_batch).
+    """
+    started = time.monotonic()
+    record: Dict[str, Any] = {"input": sku_input, "sku": None, "status": "error", "product_name": None,
+                              "root_id": None, "color": None, "review_count": 0, "analysis": None, "error": None}
+    try:
+        wb_review = wb_review or WbReview(sku_input)
+        record["sku"] = wb_review.sku
+        async with fetch_semaphore:
+            await wb_review._init_product_info()
+            reviews = await wb_review.parse(only_this_variation=True, limit=reviews_limit) if wb_review.root_id else []
+        record.update(product_name=wb_review.product_name, root_id=wb_review.root_id,
+                      color=wb_review.color, review_count=len(reviews))
+
+        if wb_review.root_id is None:
+            record["error"] = "Не удалось получить информацию о товаре (root_id)"
+        elif not reviews:
+            record["status"] = "no_reviews"
+        else:
+            analysis = await ReviewAnalyzer.analyze_reviews_async(reviews, wb_review.product_name)
+            record["analysis"] = analysis
+            if ReviewAnalyzer._is_error_response(analysis):
+                record["error"] = analysis
+            else:
+                record["status"] = "ok"
+    except ValueError as e:
+        record["error"] = str(e)
+    except Exception as e:
+        record["error"] = f"{type(e).__name__}: {e}"
+        traceback.print_exc()
+
+    record["elapsed_sec"] = round(time.monotonic() - started, 3)
+    record["finished_at"] = datetime.datetime.now().isoformat(timespec="seconds")
+    return record
+
+
+async def run_batch(skus: List[str], out_path: str, fetch_concurrency: int, llm_concurrency: int,
+                    reviews_limit: int) -> Dict[str, int]:
+    """
+    Обрабатывает товары конвейером: не более fetch_concurrency одновременных загрузок с Wildberries
+    и не более llm_concurrency одновременных запросов к LLM. Каждая запись дописывается в out_path
+    сразу после обработки товара. Информация о товарах запрашивается заранее пакетами
+    по WbReview.CARD_BATCH_SIZE артикулов, по мере того как рабочие разбирают очередь.
+    """
+    llm_pool.max_concurrency = max(1, llm_concurrency)
+    fetch_semaphore = asyncio.Semaphore(max(1, fetch_concurrency))
+    batch_size = WbReview.CARD_BATCH_SIZE
+    queue: asyncio.Queue = asyncio.Queue(maxsize=batch_size)
+
+    counters = {"ok": 0, "no_reviews": 0, "error": 0}
+    total = len(skus)
+    # Рабочих столько, чтобы загрузка и анализ шли внахлест, но отзывы в памяти держались ограниченно
+    workers_count = max(1, min(total, fetch_concurrency + llm_concurrency))
+
+    with open(out_path, "a", encoding="utf-8") as out_file:
+        async def produce():
+            for start in range(0, total, batch_size):
+                window = []
+                for sku_input in skus[start:start + batch_size]:
+                    try:
+                        window.append((sku_input, WbReview(sku_input)))
+                    except ValueError:
+                        # Ошибка артикула попадет в запись товара в analyze_sku
+                        window.append((sku_input, None))
+                await WbReview.init_product_info_many([wb_review for _, wb_review in window if wb_review])
+                for item in window:
+                    await queue.put(item)
+            for _ in range(workers_count):
+                await queue.put(None)
+
+        async def worker():
+            while True:
+                item = await queue.get()
+                if item is None:
+                    return
+                sku_input, wb_review = item
+                record = await analyze_sku(sku_input, fetch_semaphore, reviews_limit, wb_review)
+                out_file.write(json.dumps(record, ensure_ascii=False) + "\n")
+                out_file.flush()
+                counters[record["status"]] += 1
+                processed = sum(counters.values())
+                print(f"CLI: [{processed}/{total}] {sku_input}: {record['status']}"
+                      + (f" ({record['error'][:100]})" if record["error"] else ""), file=sys.stderr)
+
+        try:
+            await asyncio.gather(produce(), *(worker() for _ in range(workers_count)))
+        finally:
+            await asyncio.gather(wb_shutdown(), ai_shutdown())
+
+    return counters
+
+
+def command_batch(args: argparse.Namespace) -> int:
+    skus = read_skus(args.skus_file)
+    done = read_checkpoint(args.out) if not args.restart else set()
+    if args.restart and os.path.exists(args.out):
+        os.remove(args.out)
+    pending = [sku for sku in skus if sku not in done]
+    print(f"CLI: всего товаров {len(skus)}, уже обработано {len(skus) - len(pending)}, к обработке {len(pending)}", file=sys.stderr)
+    if not pending:
+        return 0
+
+    started = time.monotonic()
+    counters = asyncio.run(run_batch(pending, args.out, args.fetch_concurrency, args.llm_concurrency, args.limit))
+    elapsed = time.monotonic() - started
+    print(f"CLI: готово за {elapsed:.1f} с: успешно {counters['ok']}, без отзывов {counters['no_reviews']}, "
+          f"с ошибками {counters['error']}", file=sys.stderr)
+    return 1 if counters["error"] else 0
+
+
+def command_serve(args: argparse.Namespace) -> int:
+    # Импорт здесь, чтобы пакетный режим не зависел от aiohttp.web
+    from server import run
+    run(host=args.host, port=args.port, workers=args.workers)
+    return 0
+
+
+def build_parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(prog="cli.py", description="WB Analyzer без графического интерфейса")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    batch = subparsers.add_parser("batch", help="пакетный анализ списка товаров в JSON Lines")
+    batch.add_argument("skus_file", help="файл с артикулами или URL, по одному в строке")
+    batch.add_argument("--out", default="results.jsonl", help="выходной файл JSONL, он же контрольная точка")
+    batch.add_argument("--fetch-concurrency", type=int, default=8, help="одновременных загрузок с Wildberries")
+    batch.add_argument("--llm-concurrency", type=int, default=4, help="одновременных запросов к LLM")
+    batch.add_argument("--limit", type=int, default=ReviewAnalyzer.REVIEWS_LIMIT,
+                       help="максимум отзывов на товар (по умолчанию WB_REVIEWS_LIMIT или 300)")
+    batch.add_argument("--restart", action="store_true", help="начать заново, удалив выходной файл")
+    batch.set_defaults(handler=command_batch)
+
+    serve = subparsers.add_parser("serve", help="локальный HTTP-сервис анализа (POST /analyze, POST /compare)")
+    serve.add_argument("--host", default="127.0.0.1", help="адрес для прослушивания")
+    serve.add_argument("--port", type=int, default=8080, help="порт для прослушивания")
+    serve.add_argument("--workers", type=int, default=4, help="одновременно выполняемых задач")
+    serve.set_defaults(handler=command_serve)
+    return parser
+
+
+def main(argv=None) -> int:
+    args = build_parser().parse_args(argv)
+    return args.handler(args)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
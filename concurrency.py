@@ -0,0 +1,136 @@
+import asyncio
+import functools
+import threading
+from typing import Any, Awaitable, Callable, Dict, Hashable, List, Optional, Tuple, TypeVar
+
+T = TypeVar("T")
+
+
+class _Call:
+    """Выполняющийся вызов и число ожидающих его результата."""
+
+    __slots__ = ("task", "waiters")
+
+    def __init__(self, task: asyncio.Task):
+        self.task = task
+        self.waiters = 0
+
+
+class SingleFlight:
+    """
+    Объединение одновременных вызовов (single-flight): пока вызов с ключом key выполняется,
+    остальные вызовы с тем же ключом не запускают работу повторно, а ждут общий результат или исключение.
+    После завершения ключ освобождается, поэтому это не кеш, а защита от дублирующихся запросов в полете.
+
+    Отмена одного из ожидающих не прерывает общую работу; работа отменяется, только когда
+    отменены все ожидающие. Вызовы из разных циклов событий не объединяются.
+    """
+
+    def __init__(self):
+        self._calls: Dict[Hashable, _Call] = {}
+        # Сколько вызовов получили результат, вычисленный для другого вызывающего
+        self.shared = 0
+
+    def in_flight(self, key: Hashable) -> bool:
+        """Выполняется ли сейчас вызов с этим ключом в текущем цикле событий."""
+        call = self._calls.get(key)
+        return call is not None and not call.task.done() and call.task.get_loop() is asyncio.get_running_loop()
+
+    async def do(self, key: Hashable, func: Callable[[], Awaitable[T]]) -> T:
+        """Выполняет func() или присоединяется к уже выполняющемуся вызову с тем же ключом."""
+        loop = asyncio.get_running_loop()
+        call = self._calls.get(key)
+        if call is None or call.task.done() or call.task.get_loop() is not loop:
+            call = _Call(loop.create_task(func()))
+            self._calls[key] = call
+            call.task.add_done_callback(functools.partial(self._forget, key, call))
+        else:
+            self.shared += 1
+
+        call.waiters += 1
+        try:
+            return await asyncio.shield(call.task)
+        except asyncio.CancelledError:
+            if call.waiters == 1 and not call.task.done():
+                call.task.cancel()
+            raise
+        finally:
+            call.waiters -= 1
+
+    def _forget(self, key: Hashable, call: _Call, task: Any):
+        if self._calls.get(key) is call:
+            del self._calls[key]
+
+
+class CancellationToken:
+    """
+    Токен отмены операции. cancel() можно вызвать из любого потока; ожидания, запущенные через run(),
+    прерываются сразу (внутренняя задача отменяется, соединения освобождаются), а вызывающий получает
+    asyncio.CancelledError. Между шагами долгих операций проверяется raise_if_cancelled().
+    """
+
+    def __init__(self):
+        self._cancelled = False
+        self._lock = threading.Lock()
+        self._waiters: List[Tuple[asyncio.AbstractEventLoop, asyncio.Future]] = []
+
+    @property
+    def cancelled(self) -> bool:
+        return self._cancelled
+
+    def cancel(self):
+        with self._lock:
+            if self._cancelled:
+                return
+            self._cancelled = True
+            waiters, self._waiters = self._waiters, []
+        for loop, future in waiters:
+            if not loop.is_closed():
+                loop.call_soon_threadsafe(_resolve, future)
+
+    def raise_if_cancelled(self):
+        if self._cancelled:
+            raise asyncio.CancelledError()
+
+    async def wait(self):
+        """Ждет отмены токена."""
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        with self._lock:
+            if self._cancelled:
+                return
+            self._waiters.append((loop, future))
+        try:
+            await future
+        finally:
+            with self._lock:
+                if (loop, future) in self._waiters:
+                    self._waiters.remove((loop, future))
+
+    async def run(self, aw: Awaitable[T]) -> T:
+        """Выполняет aw до завершения или до отмены токена (тогда aw отменяется и поднимается CancelledError)."""
+        self.raise_if_cancelled()
+        task = asyncio.ensure_future(aw)
+        waiter = asyncio.ensure_future(self.wait())
+        try:
+            await asyncio.wait((task, waiter), return_when=asyncio.FIRST_COMPLETED)
+        finally:
+            waiter.cancel()
+            if not task.done():
+                task.cancel()
+                await asyncio.gather(task, return_exceptions=True)
+        if task.cancelled():
+            raise asyncio.CancelledError()
+        return task.result()
+
+
+def _resolve(future: asyncio.Future):
+    if not future.done():
+        future.set_result(None)
+
+
+async def cancellable(aw: Awaitable[T], cancel_token: Optional[CancellationToken]) -> T:
+    """Ожидает aw с учетом токена отмены; без токена - обычное ожидание."""
+    if cancel_token is None:
+        return await aw
+    return await cancel_token.run(aw)
@@ -9,13 +9,16 @@ from dotenv import load_dotenv
 import traceback 
 import datetime 
 import json
-import queue
+import threading
+import time
 import asyncio # ДОБАВЛЕНО для запуска async функций из wb.py
 
 # --- Проверка зависимостей ---
 try:
-    from wb import WbReview
-    from ai import ReviewAnalyzer
+    from wb import WbReview, shutdown as wb_shutdown
+    from ai import ReviewAnalyzer, shutdown as ai_shutdown
+    from concurrency import CancellationToken, cancellable
+    from metrics import metrics
 except ImportError as e:
     root = tk.Tk()
     root.withdraw()
@@ -35,6 +38,8 @@ CARD_COLOR = "#2c2c2e"
 INPUT_BG = "#39393d"
 TEXT_COLOR = "#ffffff"
 SECONDARY_TEXT = "#86868b"
+# Как часто во время выполнения задачи проверять, что рабочий процесс жив (мс)
+WORKER_WATCHDOG_MS = 1000
 
 # --- Пользовательские виджеты ---
 class CustomEntry(ctk.CTkEntry):
@@ -120,6 +125,149 @@ class CustomEntry(ctk.CTkEntry):
             return 'break'
         return None
 
+# --- Пул рабочих процессов анализа ---
+class _JobResultQueue:
+    """
+    Очередь результатов одной задачи: добавляет к сообщениям идентификатор задачи и время отправки
+    (time.time(), по нему интерфейс измеряет задержку доставки).
+    """
+    def __init__(self, result_queue, job_id):
+        self._result_queue = result_queue
+        self._job_id = job_id
+
+    def put(self, message):
+        message_type, data = message
+        self._result_queue.put((self._job_id, message_type, data, time.time()))
+
+
+class _ResultDispatcher:
+    """
+    Доставка сообщений рабочих процессов в цикл Tk без опроса очереди.
+    Фоновый поток блокируется на result_queue.get() и складывает сообщения в буфер. На первое сообщение
+    пачки он генерирует виртуальное событие EVENT; обработчик забирает через drain() все накопившиеся
+    сообщения и обновляет интерфейс один раз. Пока сообщений нет, ни поток, ни цикл Tk не просыпаются.
+    """
+    EVENT = "<<AnalysisResults>>"
+
+    def __init__(self, widget, result_queue):
+        self._widget = widget
+        self._result_queue = result_queue
+        self._lock = threading.Lock()
+        self._messages = []
+        # Событие уже сгенерировано, но обработчик еще не забрал сообщения
+        self._notified = False
+        self._thread = threading.Thread(target=self._run, name="analysis-results", daemon=True)
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        """Останавливает поток: None в очереди - признак завершения."""
+        self._result_queue.put(None)
+
+    def drain(self):
+        """Возвращает и очищает накопленные сообщения. Вызывается в потоке Tk."""
+        with self._lock:
+            messages, self._messages = self._messages, []
+            self._notified = False
+        return messages
+
+    def _run(self):
+        while True:
+            try:
+                message = self._result_queue.get()
+            except (EOFError, OSError):
+                return
+            if message is None:
+                return
+            with self._lock:
+                self._messages.append(message)
+                if self._notified:
+                    continue
+                self._notified = True
+            try:
+                self._widget.event_generate(self.EVENT, when="tail")
+            except (tk.TclError, RuntimeError):
+                # Окно уже закрыто
+                return
+
+
+class AnalysisWorkerPool:
+    """
+    Долгоживущие рабочие процессы анализа.
+    Процессы запускаются один раз и между задачами сохраняют цикл событий, пул соединений wb.py
+    и клиенты LLM, поэтому новый анализ не тратит время на запуск процесса и импорт модулей.
+    Сообщения всех задач приходят в общую очередь result_queue в виде (job_id, тип, данные, время отправки);
+    после завершения задачи (в том числе отмененной) приходит сообщение "job_done".
+    """
+    def __init__(self, target, size=1):
+        self._target = target
+        self.size = max(1, size)
+        self.result_queue = None
+        self._workers = [] # [(процесс, очередь задач)]
+        self._job_workers = {} # job_id -> индекс рабочего процесса
+        self._last_job_id = 0
+
+    def start(self):
+        """Запускает недостающие или упавшие рабочие процессы."""
+        if self.result_queue is None:
+            self.result_queue = multiprocessing.Queue()
+        for index in range(self.size):
+            if index < len(self._workers) and self._workers[index][0].is_alive():
+                continue
+            task_queue = multiprocessing.Queue()
+            process = multiprocessing.Process(target=self._target, args=(task_queue, self.result_queue))
+            process.daemon = True
+            process.start()
+            if index < len(self._workers):
+                # Задачи упавшего процесса уже не завершатся
+                self._job_workers = {job_id: i for job_id, i in self._job_workers.items() if i != index}
+                self._workers[index] = (process, task_queue)
+            else:
+                self._workers.append((process, task_queue))
+
+    def submit(self, kind, args):
+        """Отправляет задачу ("single" или "multi") наименее загруженному процессу. Возвращает job_id."""
+        self.start()
+        self._last_job_id += 1
+        job_id = self._last_job_id
+        loads = [0] * len(self._workers)
+        for index in self._job_workers.values():
+            loads[index] += 1
+        index = loads.index(min(loads))
+        self._job_workers[job_id] = index
+        self._workers[index][1].put(("run", job_id, kind, args))
+        return job_id
+
+    def cancel(self, job_id):
+        """Просит рабочий процесс отменить задачу, если она еще выполняется."""
+        index = self._job_workers.get(job_id)
+        if index is not None:
+            self._workers[index][1].put(("cancel", job_id))
+
+    def job_finished(self, job_id):
+        self._job_workers.pop(job_id, None)
+
+    def is_job_running(self, job_id):
+        return job_id in self._job_workers
+
+    def is_job_alive(self, job_id):
+        """False, если процесс, выполнявший задачу, неожиданно завершился."""
+        index = self._job_workers.get(job_id)
+        return index is None or self._workers[index][0].is_alive()
+
+    def shutdown(self, timeout=2.0):
+        """Останавливает рабочие процессы, давая им закрыть сетевые ресурсы."""
+        for process, task_queue in self._workers:
+            if process.is_alive():
+                task_queue.put(None)
+        for process, _ in self._workers:
+            process.join(timeout)
+            if process.is_alive():
+                process.terminate()
+        self._workers = []
+        self._job_workers = {}
+
 # --- Основной класс приложения ---
 class ReviewAnalyzerApp(ctk.CTk):
     def __init__(self):
@@ -133,8 +281,15 @@ class ReviewAnalyzerApp(ctk.CTk):
         self.loading_overlay_frame = None 
         self.loading_overlay_label = None 
         self.loading_progress_bar = None 
-        self.result_queue = None
         self.mode_var = ctk.StringVar(value="single")
+
+        # Долгоживущий рабочий процесс анализа и идентификатор текущей задачи
+        self.worker_pool = AnalysisWorkerPool(ReviewAnalyzerApp.worker_process_main)
+        self.result_dispatcher = None
+        self.current_job_id = None
+        self._watchdog_after_id = None
+        # Показывается ли уже анализ текущей задачи по мере генерации
+        self.stream_started = False
         
         # Переменные для отдельных полей ввода товаров при сравнении
         self.product_entries = []
@@ -174,10 +329,36 @@ class ReviewAnalyzerApp(ctk.CTk):
         self.bind("<Button-1>", self._defocus)
         self.mode_var.trace_add("write", self._update_input_mode)
         self.bind("<F11>", self._toggle_fullscreen) 
+        self.protocol("WM_DELETE_WINDOW", self._on_close)
+        self.bind(_ResultDispatcher.EVENT, self.check_analysis_results)
 
         # Показать основной фрейм при запуске
         self.main_frame.pack(expand=True, fill="both") 
 
+        # Эндпоинт метрик интерфейса (WB_METRICS_PORT + 1); порт WB_METRICS_PORT занимает рабочий процесс
+        metrics.start_exporter_from_env(port_offset=1)
+
+        # Рабочий процесс запускается заранее, чтобы первый анализ не ждал импорта модулей
+        self.after(200, self._start_worker_pool)
+
+    def _start_worker_pool(self):
+        """Запускает рабочие процессы и поток доставки их сообщений в интерфейс."""
+        self.worker_pool.start()
+        if self.result_dispatcher is None:
+            self.result_dispatcher = _ResultDispatcher(self, self.worker_pool.result_queue)
+            self.result_dispatcher.start()
+
+    def _on_close(self):
+        """Останавливает рабочие процессы и закрывает окно."""
+        try:
+            if self.result_dispatcher is not None:
+                self.result_dispatcher.stop()
+                self.result_dispatcher = None
+            self.worker_pool.shutdown()
+        except Exception as e:
+            print(f"MAIN.PY: Ошибка при остановке рабочих процессов: {e}")
+        self.destroy()
+
     # --- Основные методы настройки ---
 
     def _setup_frames(self):
@@ -208,6 +389,12 @@ class ReviewAnalyzerApp(ctk.CTk):
         self.loading_progress_bar.pack(pady=(5, 20), padx=50, fill="x")
         # --- КОНЕЦ ДОБАВЛЕНИЯ ПРОГРЕСС-БАРА ---
 
+        ctk.CTkButton(
+            center_frame, text="Отменить", font=self.fonts["back_button"], command=self.cancel_analysis,
+            width=120, height=32, corner_radius=16, fg_color="#3a3a3c",
+            text_color=TEXT_COLOR, hover_color="#4a4a4c"
+        ).pack()
+
     def _setup_main_widgets(self):
         """Создает все виджеты для главного экрана."""
         # Заголовок
@@ -543,6 +730,8 @@ class ReviewAnalyzerApp(ctk.CTk):
 
     def go_back(self):
         """Возвращается на основной экран или на экран истории."""
+        # Уход с экрана, на котором еще генерируется анализ, отменяет задачу
+        self._release_current_job()
         if self.state() == 'zoomed': 
             self.state('normal')
         
@@ -644,8 +833,6 @@ class ReviewAnalyzerApp(ctk.CTk):
         self._show_loading_overlay(loading_message)
 
         try:
-            self.result_queue = multiprocessing.Queue()
-            
             # Определяем режим анализа
             mode = self.mode_var.get()
             
@@ -663,12 +850,7 @@ class ReviewAnalyzerApp(ctk.CTk):
                 
                 # Запускаем процесс анализа
                 self._show_loading_overlay(f"Анализируем: {product_id_input[:30]}...") 
-                process = multiprocessing.Process(
-                    target=self.perform_analysis_process,
-                    args=(product_id, self.result_queue)
-                )
-                process.daemon = True
-                process.start()
+                self._submit_job("single", (product_id,))
                 
             else: # Режим "multi" (сравнение)
                 product_ids_inputs = [] 
@@ -701,13 +883,7 @@ class ReviewAnalyzerApp(ctk.CTk):
                             self.url_input.insert(0, id_to_analyze_single)
                             # Снова показываем оверлей, так как сейчас начнется анализ
                             self._show_loading_overlay(f"Анализируем: {actual_input_for_dialog[:30]}...")
-                            process = multiprocessing.Process(
-                                target=self.perform_analysis_process,
-                                args=(id_to_analyze_single, self.result_queue)
-                            )
-                            process.daemon = True
-                            process.start()
-                            self.after(100, lambda: self.check_analysis_results())
+                            self._submit_job("single", (id_to_analyze_single,))
                             return 
                         else: 
                             # main_frame уже восстановлен, просто выходим
@@ -727,15 +903,7 @@ class ReviewAnalyzerApp(ctk.CTk):
                 # Обновим текст для ясности, что именно происходит
                 self.loading_overlay_label.configure(text=f"Анализируем {len(product_ids_processed)} товаров для сравнения...")
 
-                process = multiprocessing.Process(
-                    target=self.perform_multiple_analysis_process,
-                    args=(product_ids_processed, self.result_queue) 
-                )
-                process.daemon = True
-                process.start()
-            
-            # После запуска процесса планируем проверку очереди результатов
-            self.after(100, lambda: self.check_analysis_results())
+                self._submit_job("multi", (product_ids_processed,))
             
         except Exception as e:
             self._hide_loading_overlay() 
@@ -743,85 +911,211 @@ class ReviewAnalyzerApp(ctk.CTk):
             print(f"Ошибка запуска процесса анализа: {e}\n{detailed_error}")
             messagebox.showerror("Ошибка", f"Не удалось запустить процесс анализа:\n{e}")
 
+    def _submit_job(self, kind, args):
+        """Отправляет задачу в рабочий процесс; результаты предыдущей задачи больше не показываются."""
+        self._release_current_job()
+        self._start_worker_pool()
+        self.current_job_id = self.worker_pool.submit(kind, args)
+        self.stream_started = False
+        # Результаты приходят событием от _ResultDispatcher; таймер нужен только чтобы заметить падение процесса
+        if self._watchdog_after_id is not None:
+            self.after_cancel(self._watchdog_after_id)
+        self._watchdog_after_id = self.after(WORKER_WATCHDOG_MS, self._watch_current_job)
+
+    def cancel_analysis(self):
+        """Отменяет текущий анализ: рабочий процесс прерывает запросы к WB и LLM, интерфейс возвращается на главный экран."""
+        self._release_current_job()
+        self._hide_loading_overlay()
+        self.main_frame.pack(expand=True, fill="both")
+
+    def _release_current_job(self):
+        """Отменяет текущую задачу, если она еще выполняется, и перестает ждать ее результаты."""
+        if self.current_job_id is not None and self.worker_pool.is_job_running(self.current_job_id):
+            self.worker_pool.cancel(self.current_job_id)
+        self.current_job_id = None
+
     # --- Целевые функции мультипроцессинга (статические методы) ---
 
-    @staticmethod
-    def _fetch_product_data(product_id, result_queue):
-        """Получает название и отзывы для одного товара. Выполняется в рабочем процессе."""
-        
-        async def async_fetch_data(): # Оборачиваем в async функцию
-            wb_review = None # Инициализируем wb_review здесь
-            try:
-                # result_queue.put(("status_update", (0.1, f"Создание экземпляра WbReview для {product_id}...")))
-                wb_review = WbReview(product_id)
-                
-                # Обновление статуса перед долгим парсингом/инициализацией
-                # _init_product_info теперь вызывается лениво внутри parse или при прямом доступе
-                # result_queue.put(("status_update", (0.15, f"Инициализация данных для {product_id}...")))
-                # await wb_review._init_product_info() # Явная инициализация для получения product_name
-
-                # product_name теперь получается после _init_product_info, которое может быть вызвано в parse
-                # Для UI лучше получить имя заранее, если возможно, или использовать ID
-                # Попробуем инициализировать, чтобы получить имя для UI пораньше
-                await wb_review._init_product_info()
-                product_name_for_ui = wb_review.product_name if wb_review.product_name else f"Товар {product_id}"
-
-                result_queue.put(("status_update", (0.1, f"Получаем отзывы для {product_name_for_ui}...")))
-                
-                reviews = await wb_review.parse(only_this_variation=True) 
-                
-                # После parse product_name должен быть точно установлен
-                product_name_final = wb_review.product_name if wb_review.product_name else f"Товар {product_id}"
+    # Цикл событий рабочего процесса. Общий пул соединений wb.py и клиенты LLM привязаны к нему,
+    # поэтому все асинхронные вызовы процесса выполняются в одном цикле.
+    _worker_loop = None
 
-                return {
-                    "product_id": product_id, # Исходный ID, как был введен/извлечен
-                    "product_name": product_name_final, # Имя после всех попыток получения
-                    "reviews": reviews or [], 
-                    "review_count": len(reviews) if reviews else 0,
-                    "wb_review_instance": wb_review # Передаем инстанс для дальнейшего закрытия сессии
-                }
-            except ValueError as ve: # Ошибка при создании WbReview (неверный SKU)
-                error_msg = f"Ошибка входных данных для товара (возможно, неверный артикул '{product_id}'): {ve}"
-                print(f"MAIN.PY: _fetch_product_data ValueError: {error_msg}")
-                result_queue.put(("error_critical_fetch", error_msg)) # Используем новый тип ошибки
-                # Если wb_review был создан до ошибки, пытаемся закрыть сессию
-                if wb_review:
-                    await wb_review.close_session()
-                return None
-            except Exception as e:
-                error_msg = f"Ошибка при получении данных для товара {product_id}: {type(e).__name__} - {e}"
-                print(f"MAIN.PY: _fetch_product_data Exception: {error_msg}")
-                detailed_error = traceback.format_exc()
-                print(detailed_error)
-                result_queue.put(("error_critical_fetch", error_msg)) # Используем новый тип ошибки
-                if wb_review: # Если инстанс был создан до ошибки
-                    await wb_review.close_session()
-                return None
-            # finally: # close_session должен вызываться только если он был создан
-            #     if wb_review: # wb_review может быть не определен, если WbReview(product_id) упал
-            #        await wb_review.close_session() # Закрываем сессию после использования
-
-        # Запускаем async функцию в текущем процессе (который сам по себе Process)
-        # Loop можно создавать один раз на процесс, если бы было много вызовов,
-        # но для одного вызова asyncio.run() достаточно и он управляет своим циклом.
-        try:
-            # return asyncio.run(async_fetch_data()) # Python 3.7+
-            # Для совместимости, если где-то будет старый Python (хотя uv ставит свежие)
+    @staticmethod
+    def _run_async(coro):
+        """Выполняет корутину в постоянном цикле событий рабочего процесса."""
+        loop = ReviewAnalyzerApp._worker_loop
+        if loop is None or loop.is_closed():
             loop = asyncio.new_event_loop()
             asyncio.set_event_loop(loop)
-            result = loop.run_until_complete(async_fetch_data())
+            ReviewAnalyzerApp._worker_loop = loop
+        return loop.run_until_complete(coro)
+
+    @staticmethod
+    def _shutdown_worker():
+        """Закрывает общий пул соединений wb.py, клиенты LLM и цикл событий рабочего процесса."""
+        loop = ReviewAnalyzerApp._worker_loop
+        if loop is None or loop.is_closed():
+            return
+        try:
+            loop.run_until_complete(asyncio.gather(wb_shutdown(), ai_shutdown()))
+        except Exception as e_close:
+            print(f"MAIN.PY: Ошибка при закрытии сетевых ресурсов рабочего процесса: {e_close}")
+        finally:
             loop.close()
-            return result
+            ReviewAnalyzerApp._worker_loop = None
+
+    @staticmethod
+    def worker_process_main(task_queue, result_queue):
+        """
+        Точка входа долгоживущего рабочего процесса (AnalysisWorkerPool).
+        Выполняет задачи из task_queue в одном цикле событий до получения None.
+        """
+        metrics.start_exporter_from_env()
+        try:
+            ReviewAnalyzerApp._run_async(ReviewAnalyzerApp._serve_worker_jobs(task_queue, result_queue))
+        finally:
+            ReviewAnalyzerApp._shutdown_worker()
+
+    @staticmethod
+    async def _serve_worker_jobs(task_queue, result_queue):
+        """Принимает команды ("run", job_id, kind, args), ("cancel", job_id) и None (остановка)."""
+        loop = asyncio.get_running_loop()
+        jobs = {} # job_id -> (задача, токен отмены)
+        while True:
+            # Очередь задач читается в потоке, чтобы цикл событий продолжал выполнять текущие задачи
+            message = await loop.run_in_executor(None, task_queue.get)
+            if message is None:
+                break
+            command, job_id = message[0], message[1]
+            if command == "cancel":
+                job = jobs.get(job_id)
+                if job is not None:
+                    # Токен прерывает текущие запросы к WB и LLM, отмена задачи - все остальное
+                    task, cancel_token = job
+                    cancel_token.cancel()
+                    task.cancel()
+            elif command == "run":
+                kind, args = message[2], message[3]
+                job_queue = _JobResultQueue(result_queue, job_id)
+                cancel_token = CancellationToken()
+                if kind == "single":
+                    coro = ReviewAnalyzerApp._perform_analysis_async(*args, job_queue, cancel_token)
+                else:
+                    coro = ReviewAnalyzerApp._perform_multiple_analysis_async(*args, job_queue, cancel_token)
+                task = loop.create_task(ReviewAnalyzerApp._run_worker_job(coro, job_queue, kind))
+                jobs[job_id] = (task, cancel_token)
+                task.add_done_callback(lambda _task, job_id=job_id: jobs.pop(job_id, None))
+
+        for task, cancel_token in jobs.values():
+            cancel_token.cancel()
+            task.cancel()
+        await asyncio.gather(*(task for task, _ in jobs.values()), return_exceptions=True)
+
+    @staticmethod
+    async def _run_worker_job(coro, job_queue, kind="single"):
+        try:
+            with metrics.span("job", {"kind": kind}):
+                await coro
+        except asyncio.CancelledError:
+            print("MAIN.PY: Задача анализа отменена")
+        finally:
+            job_queue.put(("job_done", None))
+
+    @staticmethod
+    async def _fetch_product_data_async(product_id, result_queue, cancel_token=None):
+        """
+        Получает название и отзывы для одного товара в цикле событий рабочего процесса.
+        При отмене cancel_token текущие запросы прерываются и поднимается asyncio.CancelledError.
+        """
+        try:
+            wb_review = WbReview(product_id)
+            # Инициализируем информацию о товаре заранее, чтобы показать в интерфейсе название
+            await cancellable(wb_review._init_product_info(), cancel_token)
+            product_name_for_ui = wb_review.product_name if wb_review.product_name else f"Товар {product_id}"
+
+            result_queue.put(("status_update", (0.1, f"Получаем отзывы для {product_name_for_ui}...")))
+            
+            reviews = await cancellable(wb_review.parse(only_this_variation=True, limit=ReviewAnalyzer.REVIEWS_LIMIT), cancel_token)
+            
+            # После parse product_name должен быть точно установлен
+            product_name_final = wb_review.product_name if wb_review.product_name else f"Товар {product_id}"
+
+            return {
+                "product_id": product_id, # Исходный ID, как был введен/извлечен
+                "product_name": product_name_final, # Имя после всех попыток получения
+                "reviews": reviews or [], 
+                "review_count": len(reviews) if reviews else 0,
+                "wb_review_instance": wb_review
+            }
+        except ValueError as ve: # Ошибка при создании WbReview (неверный SKU)
+            error_msg = f"Ошибка входных данных для товара (возможно, неверный артикул '{product_id}'): {ve}"
+            print(f"MAIN.PY: _fetch_product_data_async ValueError: {error_msg}")
+            result_queue.put(("error_critical_fetch", error_msg)) # Используем новый тип ошибки
+            return None
+        except Exception as e:
+            error_msg = f"Ошибка при получении данных для товара {product_id}: {type(e).__name__} - {e}"
+            print(f"MAIN.PY: _fetch_product_data_async Exception: {error_msg}")
+            detailed_error = traceback.format_exc()
+            print(detailed_error)
+            result_queue.put(("error_critical_fetch", error_msg)) # Используем новый тип ошибки
+            return None
+
+    @staticmethod
+    async def _fetch_many_products_data_async(product_ids, result_queue, cancel_token=None):
+        """
+        Получает названия и отзывы сразу для нескольких товаров в одном цикле событий.
+        Возвращает словарь {product_id: product_data} только для успешно обработанных товаров.
+        """
+        total = len(product_ids)
+        finished = [0]
+
+        def on_product_done(item):
+            finished[0] += 1
+            pid = item["sku"]
+            if item["error"] is not None:
+                error = item["error"]
+                if isinstance(error, ValueError):
+                    error_msg = f"Ошибка входных данных для товара (возможно, неверный артикул '{pid}'): {error}"
+                else:
+                    error_msg = f"Ошибка при получении данных для товара {pid}: {type(error).__name__} - {error}"
+                print(f"MAIN.PY: _fetch_many_products_data_async: {error_msg}")
+                result_queue.put(("error_critical_fetch", error_msg))
+                return
+            wb_review = item["instance"]
+            product_name = wb_review.product_name if wb_review.product_name else f"Товар {pid}"
+            result_queue.put(("status_update", (finished[0] / total * 0.6, f"Получены отзывы для {product_name} ({finished[0]}/{total})...")))
+
+        try:
+            results = await WbReview.fetch_many(product_ids, only_this_variation=True, limit=ReviewAnalyzer.REVIEWS_LIMIT,
+                                                on_done=on_product_done, cancel_token=cancel_token)
         except Exception as e_run:
-            # Эта ошибка будет очень общей, если что-то не так с запуском asyncio
-            error_msg = f"Критическая ошибка запуска async обработки для {product_id}: {e_run}"
-            print(f"MAIN.PY: _fetch_product_data asyncio.run Exception: {error_msg}")
+            error_msg = f"Критическая ошибка запуска async обработки для товаров {', '.join(product_ids)}: {e_run}"
+            print(f"MAIN.PY: _fetch_many_products_data_async Exception: {error_msg}")
             result_queue.put(("error_critical_fetch", error_msg))
-            return None
+            return {}
+
+        products_data_map = {}
+        for item in results:
+            if item["error"] is not None:
+                continue
+            pid = item["sku"]
+            wb_review = item["instance"]
+            reviews = item["reviews"]
+            products_data_map[pid] = {
+                "product_id": pid,
+                "product_name": wb_review.product_name if wb_review.product_name else f"Товар {pid}",
+                "reviews": reviews or [],
+                "review_count": len(reviews) if reviews else 0,
+                "wb_review_instance": wb_review
+            }
+        return products_data_map
 
     @staticmethod
-    def _get_single_analysis(product_data, result_queue):
-        """Выполняет ИИ-анализ отзывов одного товара."""
+    async def _get_single_analysis_async(product_data, result_queue, cancel_token=None, stream=False):
+        """
+        Выполняет ИИ-анализ отзывов одного товара.
+        При stream=True текст анализа по мере генерации отправляется сообщениями "analysis_chunk".
+        """
         product_id = product_data["product_id"]
         product_name = product_data["product_name"]
         reviews = product_data["reviews"]
@@ -830,11 +1124,13 @@ class ReviewAnalyzerApp(ctk.CTk):
             return f"На текущий момент для товара «{product_name}» (арт. {product_id}) не найдено отзывов. К сожалению, без них анализ провести невозможно. Попробуйте проверить позже, возможно, они появятся!"
 
         try:
-            if not hasattr(ReviewAnalyzer, 'analyze_reviews'):
-                 raise AttributeError("Метод 'analyze_reviews' не найден в ReviewAnalyzer.")
             # Сообщить UI, что начинается анализ для этого товара
             result_queue.put(("status_update", (0.8, f"Анализируем отзывы для '{product_name}' ({len(reviews)} шт.)...")))
-            analysis = ReviewAnalyzer.analyze_reviews(reviews, product_name)
+            on_chunk = None
+            if stream:
+                on_chunk = lambda chunk: result_queue.put(("analysis_chunk", (product_name, chunk)))
+            analysis = await ReviewAnalyzer.analyze_reviews_async(reviews, product_name, cancel_token=cancel_token,
+                                                                  on_chunk=on_chunk)
             
             # Проверка на наличие ошибки в тексте анализа
             if analysis.startswith("Ошибка GitHub Models API:") or "tokens_limit_reached" in analysis:
@@ -854,27 +1150,25 @@ class ReviewAnalyzerApp(ctk.CTk):
             return f"Не удалось выполнить анализ для товара '{product_name}': Ошибка ({type(e).__name__})."
 
     @staticmethod
-    def perform_analysis_process(product_id, result_queue):
-        """Функция рабочего процесса для анализа ОДНОГО товара."""
-        wb_instance_to_close = None
+    async def _perform_analysis_async(product_id, result_queue, cancel_token=None):
+        """Анализ ОДНОГО товара в цикле событий рабочего процесса."""
         try:
             # 1. Получение данных
             result_queue.put(("status_update", (0.05, f"Запрос данных для товара {product_id}...")))
-            product_data = ReviewAnalyzerApp._fetch_product_data(product_id, result_queue)
+            product_data = await ReviewAnalyzerApp._fetch_product_data_async(product_id, result_queue, cancel_token)
             
-            if not product_data: # Ошибка уже должна была быть отправлена из _fetch_product_data
+            if not product_data: # Ошибка уже отправлена из _fetch_product_data_async
                 # result_queue.put(("error", f"Не удалось получить данные для товара {product_id}.")) # Это лишнее
                 return 
 
-            wb_instance_to_close = product_data.get("wb_review_instance")
-
             # 2. Выполнение анализа
             # product_data["reviews"] уже содержит отзывы
             result_queue.put(("status_update", (0.7, f"Анализируем отзывы для '{product_data['product_name']}'...")))
-            analysis_result = ReviewAnalyzerApp._get_single_analysis(product_data, result_queue)
+            analysis_result = await ReviewAnalyzerApp._get_single_analysis_async(product_data, result_queue, cancel_token,
+                                                                                 stream=True)
 
             # 3. Отправка финального результата
-            # result_type = "result" if product_data["reviews"] else "no_reviews" # no_reviews обрабатывается в _get_single_analysis
+            # result_type = "result" if product_data["reviews"] else "no_reviews" # no_reviews обрабатывается в _get_single_analysis_async
             result_queue.put(("status_update", (1.0, "Завершение анализа...")))
             # product_data['product_name'] может быть пустым, если _init_product_info не отработал
             display_product_name = product_data.get('product_name', f"Товар {product_id}")
@@ -883,48 +1177,22 @@ class ReviewAnalyzerApp(ctk.CTk):
         except Exception as e:
             # Перехват всех неожиданных ошибок в одиночном процессе
             error_details = traceback.format_exc()
-            error_msg = f"Критическая ошибка в perform_analysis_process для {product_id}:\n{type(e).__name__}: {e}"
+            error_msg = f"Критическая ошибка в _perform_analysis_async для {product_id}:\n{type(e).__name__}: {e}"
             print(f"MAIN.PY: {error_msg}\nTraceback:\n{error_details}")
             result_queue.put(("error", error_msg)) # Общая ошибка процесса
-        finally:
-            if wb_instance_to_close:
-                # print(f"MAIN.PY: Закрытие сессии для {product_id} в perform_analysis_process")
-                # asyncio.run(wb_instance_to_close.close_session())
-                loop = asyncio.new_event_loop()
-                asyncio.set_event_loop(loop)
-                loop.run_until_complete(wb_instance_to_close.close_session())
-                loop.close()
 
     @staticmethod
-    def perform_multiple_analysis_process(product_ids, result_queue):
-        """Функция рабочего процесса для анализа и СРАВНЕНИЯ нескольких товаров."""
-        # Список для хранения экземпляров WbReview, чтобы закрыть их сессии в конце
-        wb_instances_to_close = []
+    async def _perform_multiple_analysis_async(product_ids, result_queue, cancel_token=None):
+        """Анализ и СРАВНЕНИЕ нескольких товаров в цикле событий рабочего процесса."""
         try:
-            # 1. Получение данных для всех товаров
-            products_data_map = {} # Используем map для сохранения исходных product_id
-            processed_ok_count = 0
-
-            for i, pid in enumerate(product_ids):
-                 # Обновляем прогресс-бар для каждого товара перед его обработкой
-                 # Например, 0.05 для первого, 0.1 для второго и т.д. до 0.5 (если 10 товаров)
-                 # Это очень грубая оценка, т.к. каждый товар может занять разное время.
-                 # Лучше обновлять внутри _fetch_product_data, но это усложнит логику прогресса.
-                 # Пока оставим просто общий статус.
-                 current_progress_estimate = (i + 1) / (len(product_ids) * 2) # *2 т.к. еще анализ
-                 result_queue.put(("status_update", (current_progress_estimate * 0.6, f"Обработка товара {pid} ({i+1}/{len(product_ids)})..."))) # 0.6 - доля сбора данных
-                 
-                 data = ReviewAnalyzerApp._fetch_product_data(pid, result_queue)
-                 if data: 
-                     products_data_map[pid] = data
-                     if data.get("wb_review_instance"):
-                        wb_instances_to_close.append(data["wb_review_instance"])
-                     processed_ok_count +=1
-                 # Если получение данных не удалось, ошибка уже отправлена через очередь
-                 # и product_data будет None, он не попадет в карту.
+            # 1. Получение данных для всех товаров одновременно (один цикл событий, ограниченная конкурентность)
+            result_queue.put(("status_update", (0.05, f"Запрос данных для {len(product_ids)} товаров...")))
+            # Если получение данных не удалось, ошибка уже отправлена через очередь,
+            # и товар не попадет в карту.
+            products_data_map = await ReviewAnalyzerApp._fetch_many_products_data_async(product_ids, result_queue, cancel_token)
 
             if not products_data_map: # Если ни один товар не удалось обработать
-                 # Ошибка уже должна была быть отправлена для каждого из _fetch_product_data
+                 # Ошибка уже отправлена для каждого товара из _fetch_many_products_data_async
                  # result_queue.put(("error", "Не удалось получить данные ни для одного из указанных товаров."))
                  return
             
@@ -947,27 +1215,28 @@ class ReviewAnalyzerApp(ctk.CTk):
                  result_queue.put(("error", error_message_comparison))
                  return
 
-            # 2. Выполнение индивидуальных анализов
-            individual_analyses_list = [] # Теперь это будет список словарей для _generate_comparison_prompt
-            
+            # 2. Выполнение индивидуальных анализов одновременно (общий лимит запросов задает пул клиентов LLM)
             # Общий прогресс после сбора данных, перед анализами
             base_progress_for_analysis = 0.6 
             num_valid_products = len(valid_products_for_analysis)
-
-            for idx, p_data in enumerate(valid_products_for_analysis):
-                # Обновляем прогресс для каждого анализа
-                analysis_progress = base_progress_for_analysis + ((idx + 1) / num_valid_products) * 0.3 # 0.3 - доля всех анализов
-                result_queue.put(("status_update", (analysis_progress, f"Анализ для '{p_data['product_name']}' ({idx+1}/{num_valid_products})...")))
-                
-                analysis_text = ReviewAnalyzerApp._get_single_analysis(p_data, result_queue) 
-                
-                # product_name уже должен быть корректным из _fetch_product_data
-                individual_analyses_list.append({
+            finished_analyses = [0]
+            result_queue.put(("status_update", (base_progress_for_analysis, f"Анализ отзывов для {num_valid_products} товаров...")))
+
+            async def analyze_product(p_data):
+                analysis_text = await ReviewAnalyzerApp._get_single_analysis_async(p_data, result_queue, cancel_token)
+                finished_analyses[0] += 1
+                analysis_progress = base_progress_for_analysis + (finished_analyses[0] / num_valid_products) * 0.3 # 0.3 - доля всех анализов
+                result_queue.put(("status_update", (analysis_progress, f"Готов анализ для '{p_data['product_name']}' ({finished_analyses[0]}/{num_valid_products})...")))
+                # product_name уже должен быть корректным из _fetch_many_products_data_async
+                return {
                     "product_id": p_data["product_id"], 
                     "product_name": p_data["product_name"],
                     "analysis": analysis_text, 
                     "review_count": p_data["review_count"]
-                })
+                }
+
+            # Список словарей для _generate_comparison_prompt, в исходном порядке товаров
+            individual_analyses_list = list(await asyncio.gather(*(analyze_product(p_data) for p_data in valid_products_for_analysis)))
             
             # Проверим, сколько анализов реально удалось получить (не содержат явных ошибок)
             successful_analyses_list = [
@@ -1028,7 +1297,7 @@ class ReviewAnalyzerApp(ctk.CTk):
                  result_queue.put(("error", f"Ошибка при подготовке сравнения: {error_msg_prompt}"))
                  return
 
-            overall_recommendation_analysis = ReviewAnalyzer._get_ai_response(comparison_prompt) # Это синхронный вызов AI
+            overall_recommendation_analysis = await ReviewAnalyzer._get_ai_response_async(comparison_prompt, cancel_token=cancel_token)
             
             # Формируем заголовок из всех товаров, которые изначально пошли на анализ (даже если анализ упал)
             product_names_for_title = [d["product_name"] for d in individual_analyses_list] 
@@ -1042,34 +1311,39 @@ class ReviewAnalyzerApp(ctk.CTk):
             error_msg = f"Критическая ошибка при сравнении товаров:\n{type(e).__name__}: {e}"
             print(f"MAIN.PY: {error_msg}\nTraceback:\n{error_details}")
             result_queue.put(("error", error_msg))
-        finally:
-            # Закрываем все сессии, которые были открыты
-            # print(f"MAIN.PY: Закрытие {len(wb_instances_to_close)} сессий в perform_multiple_analysis_process")
-            loop = asyncio.new_event_loop() # Создаем новый цикл для finally блока
-            asyncio.set_event_loop(loop)
-            try:
-                for instance in wb_instances_to_close:
-                    if instance: # Дополнительная проверка
-                        # print(f"MAIN.PY: Закрываю сессию для SKU {instance.sku}")
-                        loop.run_until_complete(instance.close_session())
-            except Exception as e_close:
-                 print(f"MAIN.PY: Ошибка при закрытии сессий в perform_multiple_analysis_process: {e_close}")
-            finally:
-                 loop.close()
 
     # --- Обработка результатов (Проверка очереди из основного потока) ---
 
-    def check_analysis_results(self):
-        """Периодически проверяет очередь результатов из процесса анализа."""
+    def check_analysis_results(self, event=None):
+        """
+        Обрабатывает пачку сообщений рабочих процессов, доставленную событием _ResultDispatcher.EVENT.
+        Подряд идущие фрагменты анализа склеиваются, интерфейс обновляется один раз на пачку.
+        """
+        if self.result_dispatcher is None:
+            return
+        messages = self.result_dispatcher.drain()
+        started = time.time()
+        for _, message_type, _, sent_at in messages:
+            metrics.observe("ui_delivery_seconds", max(started - sent_at, 0.0), type=message_type)
+        metrics.inc("ui_batches")
+        metrics.inc("ui_messages", len(messages))
         try:
-            while not self.result_queue.empty():
-                message_type, data = self.result_queue.get_nowait()
+            for job_id, message_type, data, _ in self._merge_analysis_chunks(messages):
+                if message_type == "job_done":
+                    self.worker_pool.job_finished(job_id)
+                    continue
+                if job_id != self.current_job_id:
+                    # Сообщение отмененной или уже показанной задачи
+                    continue
 
                 if message_type == "status_update":
                     progress_value, status_text = data
                     self.loading_overlay_label.configure(text=status_text)
                     if self.loading_progress_bar:
                         self.loading_progress_bar.set(float(progress_value)) 
+                elif message_type == "analysis_chunk":
+                    product_name, chunk = data
+                    self._append_analysis_chunk(product_name, chunk)
                 elif message_type == "result":
                     self._hide_loading_overlay()
                     product_name, analysis = data
@@ -1081,7 +1355,7 @@ class ReviewAnalyzerApp(ctk.CTk):
                     self.show_comparison_results(title, individual_results, recommendation, from_history=False)
                 elif message_type == "no_reviews":
                     self._hide_loading_overlay()
-                    # product_name = data # data теперь содержит (product_name, message) из _get_single_analysis
+                    # product_name = data # data теперь содержит (product_name, message) из _get_single_analysis_async
                     # Вместо этого, no_reviews теперь часть обычного "result"
                     # Если все же придет, обработаем как ошибку или проигнорируем
                     print(f"MAIN.PY: Получено устаревшее сообщение no_reviews: {data}")
@@ -1103,17 +1377,47 @@ class ReviewAnalyzerApp(ctk.CTk):
                      # Эта ошибка обычно уже отформатирована для показа
                      self.show_error_on_main_screen(f"Ошибка анализатором ИИ: {error_message}")
 
-                self.update_idletasks() 
-        except queue.Empty:
-            pass 
+                if message_type not in ("status_update", "analysis_chunk"):
+                    # Финальное сообщение или ошибка: дальнейшие сообщения задачи не нужны
+                    self._release_current_job()
+
+            self.update_idletasks() 
+            metrics.observe("ui_batch_render_seconds", time.time() - started)
         except Exception as e:
             print(f"Ошибка в check_analysis_results: {e}")
             self._hide_loading_overlay()
             self.show_error_on_main_screen(f"Внутренняя ошибка обработки результатов: {e}")
-        finally:
-            # Продолжаем проверять очередь каждые 100 мс, если оверлей загрузки все еще виден
-            if self.loading_overlay_frame.winfo_ismapped():
-                self.after(100, self.check_analysis_results)
+
+    @staticmethod
+    def _merge_analysis_chunks(messages):
+        """
+        Склеивает подряд идущие фрагменты анализа одной задачи, чтобы вставить текст одним вызовом.
+        Склеенное сообщение сохраняет время отправки первого фрагмента.
+        """
+        merged = []
+        for message in messages:
+            job_id, message_type, data, _ = message
+            if message_type == "analysis_chunk" and data[1] is not None and merged:
+                last_job_id, last_type, last_data, last_sent_at = merged[-1]
+                if last_job_id == job_id and last_type == "analysis_chunk" and last_data[1] is not None:
+                    merged[-1] = (job_id, message_type, (last_data[0], last_data[1] + data[1]), last_sent_at)
+                    continue
+            merged.append(message)
+        return merged
+
+    def _watch_current_job(self):
+        """Пока задача выполняется, проверяет, что ее рабочий процесс не завершился аварийно."""
+        self._watchdog_after_id = None
+        job_id = self.current_job_id
+        if job_id is None:
+            return
+        if not self.worker_pool.is_job_alive(job_id):
+            self.worker_pool.job_finished(job_id)
+            self.current_job_id = None
+            self._hide_loading_overlay()
+            self.show_error_on_main_screen("Рабочий процесс анализа неожиданно завершился. Попробуйте еще раз.")
+            return
+        self._watchdog_after_id = self.after(WORKER_WATCHDOG_MS, self._watch_current_job)
 
     # --- Отображение финальных результатов/ошибок ---
 
@@ -1132,6 +1436,14 @@ class ReviewAnalyzerApp(ctk.CTk):
                 self.analysis_history.pop(0) 
             self._save_history_to_file() 
 
+        self._show_single_result_view(product_name)
+        self._set_result_text(analysis)
+        self.update_idletasks()
+        self._update_title_wraplength() 
+        self.after(150, self._resize_window_based_on_content) 
+
+    def _show_single_result_view(self, product_name):
+        """Показывает экран результата ОДНОГО товара с заголовком product_name."""
         if self.state() == 'zoomed': 
             self.state('normal')
         
@@ -1146,10 +1458,26 @@ class ReviewAnalyzerApp(ctk.CTk):
              self.result_card.pack(fill=tk.BOTH, expand=True, padx=20, pady=(0, 15))
 
         self.product_title_label.configure(text=product_name)
-        self._set_result_text(analysis)
-        self.update_idletasks()
-        self._update_title_wraplength() 
-        self.after(150, self._resize_window_based_on_content) 
+
+    def _append_analysis_chunk(self, product_name, chunk):
+        """
+        Дописывает фрагмент генерируемого анализа. Первый фрагмент открывает экран результата,
+        None (модель начала новую попытку) очищает уже показанный текст.
+        Итоговый текст задает show_results по сообщению "result".
+        """
+        if chunk is None:
+            if self.stream_started:
+                self._set_result_text("")
+            return
+        if not self.stream_started:
+            self.stream_started = True
+            self._hide_loading_overlay()
+            self._show_single_result_view(product_name)
+            self._set_result_text("")
+            self._update_title_wraplength()
+        self.result_text.configure(state=tk.NORMAL)
+        self.result_text.insert(tk.END, chunk)
+        self.result_text.configure(state=tk.DISABLED)
 
     def show_no_reviews(self, product_name):
         """Отображает сообщение о том, что отзывы не найдены (для одиночного товара)."""
@@ -0,0 +1,242 @@
+"""
+Легковесная инструментовка: интервалы (span) и счетчики.
+
+Интервалы попадают в гистограмму длительностей {prefix}_span_seconds с метками span, status и
+дополнительными метками (например, provider), счетчики - в {prefix}_<имя>_total. Экспорт:
+    - текстовый формат Prometheus: render_prometheus(), HTTP-эндпоинт /metrics (start_exporter)
+      или маршрут /metrics сервиса server.py;
+    - файл трассировки JSON Lines: строка на каждый завершенный интервал с длительностью, родительским
+      интервалом и атрибутами, дописывается всеми процессами (колонка pid).
+
+Переменные окружения:
+    WB_TRACE_FILE   - путь к файлу трассировки (по умолчанию трассировка выключена)
+    WB_METRICS_PORT - порт эндпоинта Prometheus; рабочий процесс анализа слушает этот порт,
+                      процесс интерфейса - следующий
+"""
+import os
+import json
+import time
+import asyncio
+import threading
+import functools
+import contextvars
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+LabelsKey = Tuple[Tuple[str, str], ...]
+
+# Текущий интервал: вложенные интервалы (в том числе в дочерних задачах asyncio) ссылаются на него как на родителя
+_current_span: contextvars.ContextVar = contextvars.ContextVar("current_span", default=None)
+
+
+def _labels_key(labels: Optional[Dict[str, Any]]) -> LabelsKey:
+    return tuple(sorted((str(key), str(value)) for key, value in (labels or {}).items()))
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+
+
+def _format_labels(labels: LabelsKey, extra: Optional[Tuple[str, str]] = None) -> str:
+    pairs = list(labels) + ([extra] if extra else [])
+    if not pairs:
+        return ""
+    return "{" + ",".join(f'{key}="{_escape(value)}"' for key, value in pairs) + "}"
+
+
+class Span:
+    """Интервал: длительность, статус (ok, error, cancelled) и атрибуты для трассировки."""
+
+    __slots__ = ("metrics", "name", "labels", "attrs", "span_id", "parent_id", "trace_id",
+                 "_started", "_started_wall", "_token")
+
+    def __init__(self, metrics: "Metrics", name: str, labels: Optional[Dict[str, Any]], attrs: Dict[str, Any]):
+        self.metrics = metrics
+        self.name = name
+        self.labels = labels or {}
+        self.attrs = attrs
+        self.span_id = os.urandom(8).hex()
+        self.parent_id: Optional[str] = None
+        self.trace_id: Optional[str] = None
+        self._started = 0.0
+        self._started_wall = 0.0
+        self._token = None
+
+    def set(self, **attrs: Any):
+        """Добавляет атрибуты интервала (попадают только в трассировку)."""
+        self.attrs.update(attrs)
+
+    def __enter__(self) -> "Span":
+        parent = _current_span.get()
+        self.parent_id = parent.span_id if parent is not None else None
+        self.trace_id = parent.trace_id if parent is not None else self.span_id
+        self._token = _current_span.set(self)
+        self._started_wall = time.time()
+        self._started = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        duration = time.perf_counter() - self._started
+        try:
+            _current_span.reset(self._token)
+        except ValueError:
+            # Интервал закрыт в другом контексте (например, в другом потоке)
+            pass
+        if exc_type is None:
+            status = "ok"
+        elif issubclass(exc_type, asyncio.CancelledError):
+            status = "cancelled"
+        else:
+            status = "error"
+            self.attrs.setdefault("error", f"{exc_type.__name__}: {exc}"[:300])
+        self.metrics._finish_span(self, duration, status)
+        return False
+
+
+class Metrics:
+    """Реестр счетчиков и гистограмм с экспортом в Prometheus и трассировкой в JSONL. Потокобезопасен."""
+
+    BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0)
+
+    def __init__(self, prefix: str = "wb_analyzer", trace_path: Optional[str] = None):
+        self.prefix = prefix
+        self.trace_path = trace_path
+        self._lock = threading.Lock()
+        self._counters: Dict[str, Dict[LabelsKey, float]] = {}
+        # имя -> метки -> [счетчики корзин, сумма, количество]
+        self._histograms: Dict[str, Dict[LabelsKey, List[Any]]] = {}
+        self._trace_file = None
+        self._server: Optional[ThreadingHTTPServer] = None
+
+    def inc(self, name: str, value: float = 1.0, **labels: Any):
+        """Увеличивает счетчик {prefix}_<name>_total."""
+        key = _labels_key(labels)
+        with self._lock:
+            series = self._counters.setdefault(name, {})
+            series[key] = series.get(key, 0.0) + value
+
+    def observe(self, name: str, value: float, **labels: Any):
+        """Добавляет наблюдение в гистограмму {prefix}_<name>."""
+        key = _labels_key(labels)
+        with self._lock:
+            series = self._histograms.setdefault(name, {})
+            histogram = series.get(key)
+            if histogram is None:
+                histogram = series[key] = [[0] * len(self.BUCKETS), 0.0, 0]
+            for index, bound in enumerate(self.BUCKETS):
+                if value <= bound:
+                    histogram[0][index] += 1
+            histogram[1] += value
+            histogram[2] += 1
+
+    def span(self, name: str, labels: Optional[Dict[str, Any]] = None, **attrs: Any) -> Span:
+        """
+        Интервал для with: длительность попадает в {prefix}_span_seconds с метками span, status и labels
+        (только значения с небольшим числом вариантов), attrs - только в трассировку.
+        """
+        return Span(self, name, labels, attrs)
+
+    def timed(self, name: str, labels: Optional[Dict[str, Any]] = None,
+              attrs: Optional[Callable[..., Dict[str, Any]]] = None):
+        """Декоратор: вызов функции (обычной или async) - интервал; attrs(*args, **kwargs) дает атрибуты."""
+        def decorator(func):
+            if asyncio.iscoroutinefunction(func):
+                @functools.wraps(func)
+                async def async_wrapper(*args, **kwargs):
+                    with self.span(name, labels, **(attrs(*args, **kwargs) if attrs else {})):
+                        return await func(*args, **kwargs)
+                return async_wrapper
+
+            @functools.wraps(func)
+            def wrapper(*args, **kwargs):
+                with self.span(name, labels, **(attrs(*args, **kwargs) if attrs else {})):
+                    return func(*args, **kwargs)
+            return wrapper
+        return decorator
+
+    def _finish_span(self, span: Span, duration: float, status: str):
+        self.observe("span_seconds", duration, span=span.name, status=status, **span.labels)
+        if not self.trace_path:
+            return
+        record = {
+            "ts": round(span._started_wall, 6),
+            "name": span.name,
+            "duration_ms": round(duration * 1000, 3),
+            "status": status,
+            "trace_id": span.trace_id,
+            "span_id": span.span_id,
+            "parent_id": span.parent_id,
+            "pid": os.getpid(),
+            "labels": span.labels,
+            "attrs": span.attrs,
+        }
+        line = json.dumps(record, ensure_ascii=False, default=str) + "\n"
+        with self._lock:
+            try:
+                if self._trace_file is None:
+                    self._trace_file = open(self.trace_path, "a", encoding="utf-8")
+                self._trace_file.write(line)
+                self._trace_file.flush()
+            except OSError as e:
+                print(f"METRICS: Не удалось записать трассировку в {self.trace_path}: {e}")
+                self.trace_path = None
+
+    def render_prometheus(self) -> str:
+        """Все метрики в текстовом формате Prometheus."""
+        lines = []
+        with self._lock:
+            for name, series in sorted(self._counters.items()):
+                metric = f"{self.prefix}_{name}_total"
+                lines.append(f"# TYPE {metric} counter")
+                for labels, value in sorted(series.items()):
+                    lines.append(f"{metric}{_format_labels(labels)} {value:g}")
+            for name, series in sorted(self._histograms.items()):
+                metric = f"{self.prefix}_{name}"
+                lines.append(f"# TYPE {metric} histogram")
+                for labels, (buckets, total, count) in sorted(series.items()):
+                    for bound, bucket_count in zip(self.BUCKETS, buckets):
+                        lines.append(f"{metric}_bucket{_format_labels(labels, ('le', f'{bound:g}'))} {bucket_count}")
+                    lines.append(f"{metric}_bucket{_format_labels(labels, ('le', '+Inf'))} {count}")
+                    lines.append(f"{metric}_sum{_format_labels(labels)} {total:.6f}")
+                    lines.append(f"{metric}_count{_format_labels(labels)} {count}")
+        return "\n".join(lines) + "\n"
+
+    def start_exporter(self, port: int, host: str = "127.0.0.1"):
+        """Запускает в фоновом потоке HTTP-эндпоинт /metrics. Повторный вызов ничего не делает."""
+        if self._server is not None:
+            return
+        registry = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split("?")[0] != "/metrics":
+                    self.send_error(404)
+                    return
+                body = registry.render_prometheus().encode("utf-8")
+                self.send_response(200)
+                self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        try:
+            self._server = ThreadingHTTPServer((host, port), Handler)
+        except OSError as e:
+            print(f"METRICS: Не удалось открыть эндпоинт метрик на {host}:{port}: {e}")
+            return
+        self._server.daemon_threads = True
+        threading.Thread(target=self._server.serve_forever, name="metrics-exporter", daemon=True).start()
+        print(f"METRICS: Метрики Prometheus доступны на http://{host}:{port}/metrics")
+
+    def start_exporter_from_env(self, port_offset: int = 0):
+        """Запускает эндпоинт, если задан WB_METRICS_PORT; port_offset разводит процессы приложения по портам."""
+        port = os.environ.get("WB_METRICS_PORT")
+        if port and port.isdigit():
+            self.start_exporter(int(port) + port_offset)
+
+
+# Общий для процесса реестр метрик
+metrics = Metrics(trace_path=os.environ.get("WB_TRACE_FILE") or None)
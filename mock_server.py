@@ -0,0 +1,334 @@
+# -*- coding: utf-8 -*-
+"""
+Локальный заменитель Wildberries и LLM для измерения производительности без сети (см. benchmark.py).
+
+Запуск:
+    python mock_server.py serve --port 8800 --fixtures fixtures/ --wb-latency-ms 80 --llm-rate-limit-rate 0.05
+
+Сервер отдает те же пути, что и настоящие сервисы:
+    /catalog/<sku>/detail.aspx          - страница товара (www.wildberries.ru)
+    /cards/v2/detail?nm=<sku>           - API карточки (card.wb.ru)
+    /api/v1/feedbacks?imtId=&take=&skip= - API отзывов (feedbacks.wildberries.ru)
+    /openai/v1/chat/completions         - OpenAI-совместимый API (Groq), в том числе потоковый
+    /chat/completions                   - тот же обработчик для GitHub Models (Azure AI Inference)
+    /__stats                            - счетчики запросов, ошибок и ответов 429 по маршрутам
+
+Приложение направляется на заменитель переменными окружения:
+    WB_BASE_URL=http://127.0.0.1:8800 GROQ_BASE_URL=http://127.0.0.1:8800 GROQ_API_KEY=mock \\
+    GITHUB_MODELS_ENDPOINT=http://127.0.0.1:8800 GITHUB_TOKEN=mock python cli.py batch skus.txt
+
+Ответы берутся из каталога записей (--fixtures), а для товаров без записи генерируются детерминированно
+по артикулу. Записать настоящие ответы Wildberries:
+    python mock_server.py record skus.txt --fixtures fixtures/
+"""
+import os
+import sys
+import json
+import time
+import random
+import asyncio
+import argparse
+from typing import Any, Dict, List, Optional
+
+from aiohttp import web
+
+# Ответ модели в формате, который ожидает ReviewAnalyzer
+MOCK_ANALYSIS = """Плюсы:
+- Качество материалов соответствует цене
+- Товар соответствует описанию и фотографиям
+- Быстрая доставка и аккуратная упаковка
+
+Минусы:
+- Некоторые пользователи отмечают, что размер маломерит
+- Для части покупателей запах после распаковки показался сильным
+
+Рекомендации:
+Судя по отзывам, товар стоит своих денег и подойдет большинству покупателей. Перед покупкой стоит свериться с таблицей размеров. Товар хорошо подходит для повседневного использования. Покупатели, чувствительные к запахам, могут проветрить вещь после получения."""
+
+MOCK_COMPARISON = """Лучший выбор: Товар 1
+
+Обоснование: По отзывам у него меньше жалоб на размер и выше качество материалов."""
+
+_REVIEW_TEXTS = [
+    "Отличный товар, качество на высоте, рекомендую",
+    "Размер немного маломерит, пришлось обменять",
+    "Пришло быстро, упаковка целая, все как на фото",
+    "Сильный запах после распаковки, но выветрился за пару дней",
+    "За свои деньги отличный вариант, ношу каждый день",
+    "Цвет немного отличается от фото, в остальном все хорошо",
+    "Швы ровные, ткань приятная, буду заказывать еще",
+    "Через месяц появились катышки, ожидал большего",
+]
+
+
+class FaultConfig:
+    """Задержка ответа и доля искусственных ошибок 500 и ответов 429 для группы маршрутов."""
+
+    def __init__(self, latency_ms: float = 0.0, jitter_ms: float = 0.0, error_rate: float = 0.0,
+                 rate_limit_rate: float = 0.0, retry_after: float = 1.0):
+        self.latency_ms = latency_ms
+        self.jitter_ms = jitter_ms
+        self.error_rate = error_rate
+        self.rate_limit_rate = rate_limit_rate
+        self.retry_after = retry_after
+
+    async def apply(self, stats: Dict[str, int]) -> Optional[web.Response]:
+        """Выдерживает задержку; возвращает ошибочный ответ, если выпала ошибка, иначе None."""
+        delay = self.latency_ms + random.uniform(-self.jitter_ms, self.jitter_ms)
+        if delay > 0:
+            await asyncio.sleep(delay / 1000)
+        roll = random.random()
+        if roll < self.rate_limit_rate:
+            stats["rate_limited"] += 1
+            return web.json_response({"error": {"message": "Rate limit reached", "type": "rate_limit"}}, status=429,
+                                     headers={"Retry-After": str(self.retry_after)})
+        if roll < self.rate_limit_rate + self.error_rate:
+            stats["errors"] += 1
+            return web.json_response({"error": {"message": "Internal server error"}}, status=500)
+        return None
+
+
+class MockBackend:
+    """Обработчики заменителя Wildberries и LLM со счетчиками запросов по маршрутам."""
+
+    def __init__(self, fixtures_dir: Optional[str] = None, reviews_per_product: int = 300,
+                 wb_faults: Optional[FaultConfig] = None, llm_faults: Optional[FaultConfig] = None,
+                 llm_tokens_per_sec: float = 200.0):
+        self.fixtures_dir = fixtures_dir
+        self.reviews_per_product = reviews_per_product
+        self.wb_faults = wb_faults or FaultConfig()
+        self.llm_faults = llm_faults or FaultConfig()
+        self.llm_tokens_per_sec = llm_tokens_per_sec
+        self.stats: Dict[str, Dict[str, int]] = {}
+        self._feedbacks_cache: Dict[str, List[Dict[str, Any]]] = {}
+
+    def _route_stats(self, route: str) -> Dict[str, int]:
+        stats = self.stats.get(route)
+        if stats is None:
+            stats = self.stats[route] = {"requests": 0, "errors": 0, "rate_limited": 0}
+        stats["requests"] += 1
+        return stats
+
+    def _fixture(self, name: str) -> Optional[str]:
+        if not self.fixtures_dir:
+            return None
+        path = os.path.join(self.fixtures_dir, name)
+        if not os.path.exists(path):
+            return None
+        with open(path, "r", encoding="utf-8") as f:
+            return f.read()
+
+    @staticmethod
+    def synthetic_card(sku: str) -> Dict[str, Any]:
+        """Ответ API карточки: root_id (imtId) выводится из артикула, у товара две вариации цвета."""
+        return {"data": {"products": [{
+            "id": int(sku),
+            "root": int(sku) // 10,
+            "name": f"Тестовый товар {sku}",
+            "brand": "MockBrand",
+            "colors": [{"id": int(sku), "name": "черный"}, {"id": int(sku) + 1, "name": "белый"}],
+        }]}}
+
+    def synthetic_feedbacks(self, root_id: str) -> List[Dict[str, Any]]:
+        """Детерминированные отзывы товара: половина относится к вариации с nmId == root_id."""
+        feedbacks = self._feedbacks_cache.get(root_id)
+        if feedbacks is not None:
+            return feedbacks
+        rng = random.Random(root_id)
+        feedbacks = []
+        for index in range(self.reviews_per_product):
+            text = rng.choice(_REVIEW_TEXTS)
+            feedbacks.append({
+                "id": f"{root_id}-{index}",
+                "nmId": int(root_id) + (index % 2),
+                "text": f"{text}. Отзыв номер {index}",
+                "pros": rng.choice(["Качество", "Цена", "Доставка", ""]),
+                "cons": rng.choice(["Размер", "Запах", ""]),
+                "productValuation": rng.randint(1, 5),
+                "createdDate": f"2025-{12 - index % 12:02d}-{28 - index % 28:02d}T10:00:00Z",
+                "color": "черный" if index % 2 == 0 else "белый",
+                "size": "0",
+            })
+        self._feedbacks_cache[root_id] = feedbacks
+        return feedbacks
+
+    async def product_page(self, request: web.Request) -> web.Response:
+        stats = self._route_stats("page")
+        fault = await self.wb_faults.apply(stats)
+        if fault is not None:
+            return fault
+        sku = request.match_info["sku"]
+        html = self._fixture(f"page_{sku}.html")
+        if html is None:
+            html = (f'<html><body><h1 class="product-page__title">Тестовый товар {sku}</h1>'
+                    f'</body></html>')
+        return web.Response(text=html, content_type="text/html")
+
+    async def card(self, request: web.Request) -> web.Response:
+        stats = self._route_stats("card")
+        fault = await self.wb_faults.apply(stats)
+        if fault is not None:
+            return fault
+        # nm может содержать несколько артикулов через ";" (пакетный запрос)
+        products = []
+        for sku in request.query.get("nm", "").split(";"):
+            recorded = self._fixture(f"card_{sku}.json")
+            if recorded is not None:
+                products.extend((json.loads(recorded).get("data") or {}).get("products") or [])
+            elif sku.isdigit():
+                products.extend(self.synthetic_card(sku)["data"]["products"])
+        return web.json_response({"data": {"products": products}})
+
+    async def feedbacks(self, request: web.Request) -> web.Response:
+        stats = self._route_stats("feedbacks")
+        fault = await self.wb_faults.apply(stats)
+        if fault is not None:
+            return fault
+        root_id = request.query.get("imtId", "")
+        take = int(request.query.get("take", 100))
+        skip = int(request.query.get("skip", 0))
+        recorded = self._fixture(f"feedbacks_{root_id}.json")
+        if recorded is not None:
+            data = json.loads(recorded)
+            feedbacks = (data.get("feedbacks") or []) if isinstance(data, dict) else data
+        elif root_id.isdigit():
+            feedbacks = self.synthetic_feedbacks(root_id)
+        else:
+            feedbacks = []
+        return web.json_response({"feedbacks": feedbacks[skip:skip + take]})
+
+    async def chat_completions(self, request: web.Request) -> web.StreamResponse:
+        stats = self._route_stats("llm")
+        fault = await self.llm_faults.apply(stats)
+        if fault is not None:
+            return fault
+        payload = await request.json()
+        prompt = str(payload.get("messages", [{}])[-1].get("content", ""))
+        content = MOCK_COMPARISON if "Лучший выбор" in prompt else MOCK_ANALYSIS
+        model = payload.get("model", "mock")
+        created = int(time.time())
+        if not payload.get("stream"):
+            # Время генерации всего ответа
+            await asyncio.sleep(len(content.split()) / self.llm_tokens_per_sec)
+            return web.json_response({
+                "id": f"mock-{created}", "object": "chat.completion", "created": created, "model": model,
+                "choices": [{"index": 0, "message": {"role": "assistant", "content": content}, "finish_reason": "stop"}],
+                "usage": {"prompt_tokens": len(prompt) // 3, "completion_tokens": len(content) // 3,
+                          "total_tokens": (len(prompt) + len(content)) // 3},
+            })
+
+        response = web.StreamResponse(headers={"Content-Type": "text/event-stream", "Cache-Control": "no-cache"})
+        await response.prepare(request)
+        for word in content.split(" "):
+            await asyncio.sleep(1 / self.llm_tokens_per_sec)
+            chunk = {"id": f"mock-{created}", "object": "chat.completion.chunk", "created": created, "model": model,
+                     "choices": [{"index": 0, "delta": {"content": word + " "}, "finish_reason": None}]}
+            await response.write(f"data: {json.dumps(chunk, ensure_ascii=False)}\n\n".encode("utf-8"))
+        final = {"id": f"mock-{created}", "object": "chat.completion.chunk", "created": created, "model": model,
+                 "choices": [{"index": 0, "delta": {}, "finish_reason": "stop"}]}
+        await response.write(f"data: {json.dumps(final)}\n\ndata: [DONE]\n\n".encode("utf-8"))
+        await response.write_eof()
+        return response
+
+    async def stats_handler(self, request: web.Request) -> web.Response:
+        return web.json_response(self.stats)
+
+
+def create_app(backend: MockBackend) -> web.Application:
+    app = web.Application()
+    app.router.add_get("/catalog/{sku}/detail.aspx", backend.product_page)
+    app.router.add_get("/cards/v2/detail", backend.card)
+    app.router.add_get("/api/v1/feedbacks", backend.feedbacks)
+    app.router.add_post("/openai/v1/chat/completions", backend.chat_completions)
+    app.router.add_post("/chat/completions", backend.chat_completions)
+    app.router.add_get("/__stats", backend.stats_handler)
+    return app
+
+
+def backend_from_args(args: argparse.Namespace) -> MockBackend:
+    return MockBackend(
+        fixtures_dir=args.fixtures,
+        reviews_per_product=args.reviews,
+        wb_faults=FaultConfig(args.wb_latency_ms, args.wb_jitter_ms, args.wb_error_rate, args.wb_rate_limit_rate),
+        llm_faults=FaultConfig(args.llm_latency_ms, args.llm_jitter_ms, args.llm_error_rate, args.llm_rate_limit_rate),
+        llm_tokens_per_sec=args.llm_tokens_per_sec,
+    )
+
+
+def add_backend_arguments(parser: argparse.ArgumentParser):
+    """Параметры заменителя; используются и в benchmark.py."""
+    parser.add_argument("--fixtures", default=None, help="каталог записанных ответов (см. команду record)")
+    parser.add_argument("--reviews", type=int, default=300, help="отзывов у синтетического товара")
+    parser.add_argument("--wb-latency-ms", type=float, default=50.0, help="задержка ответов Wildberries")
+    parser.add_argument("--wb-jitter-ms", type=float, default=20.0, help="разброс задержки Wildberries")
+    parser.add_argument("--wb-error-rate", type=float, default=0.0, help="доля ответов 500 от Wildberries")
+    parser.add_argument("--wb-rate-limit-rate", type=float, default=0.0, help="доля ответов 429 от Wildberries")
+    parser.add_argument("--llm-latency-ms", type=float, default=300.0, help="задержка до начала ответа LLM")
+    parser.add_argument("--llm-jitter-ms", type=float, default=100.0, help="разброс задержки LLM")
+    parser.add_argument("--llm-error-rate", type=float, default=0.0, help="доля ответов 500 от LLM")
+    parser.add_argument("--llm-rate-limit-rate", type=float, default=0.0, help="доля ответов 429 от LLM")
+    parser.add_argument("--llm-tokens-per-sec", type=float, default=200.0, help="скорость генерации LLM")
+
+
+def serve(backend: MockBackend, host: str, port: int):
+    print(f"MOCK: заменитель Wildberries и LLM на http://{host}:{port}", file=sys.stderr)
+    web.run_app(create_app(backend), host=host, port=port, print=None)
+
+
+async def record(skus: List[str], fixtures_dir: str):
+    """Сохраняет настоящие ответы Wildberries для товаров skus в fixtures_dir."""
+    from wb import WbReview, session_manager, shutdown
+
+    os.makedirs(fixtures_dir, exist_ok=True)
+    try:
+        for sku_input in skus:
+            sku = WbReview.get_sku(sku_input)
+            page = await session_manager.request("GET", WbReview.PRODUCT_PAGE_URL.format(sku=sku))
+            if page.status == 200:
+                with open(os.path.join(fixtures_dir, f"page_{sku}.html"), "w", encoding="utf-8") as f:
+                    f.write(await page.text())
+            card = await session_manager.request("GET", WbReview.CARD_API_URL.format(sku=sku))
+            if card.status != 200:
+                print(f"MOCK: карточка {sku} вернула статус {card.status}, товар пропущен", file=sys.stderr)
+                continue
+            card_text = await card.text()
+            with open(os.path.join(fixtures_dir, f"card_{sku}.json"), "w", encoding="utf-8") as f:
+                f.write(card_text)
+            products = (json.loads(card_text).get("data") or {}).get("products") or []
+            root_id = str(products[0].get("id", sku)) if products else sku
+            feedbacks = await session_manager.request("GET", WbReview.FEEDBACKS_URL.format(root_id=root_id, take=5000, skip=0))
+            if feedbacks.status == 200:
+                with open(os.path.join(fixtures_dir, f"feedbacks_{root_id}.json"), "w", encoding="utf-8") as f:
+                    f.write(await feedbacks.text())
+            print(f"MOCK: записаны ответы для {sku} (root_id {root_id})", file=sys.stderr)
+    finally:
+        await shutdown()
+
+
+def build_parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(prog="mock_server.py", description="Локальный заменитель Wildberries и LLM")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    serve_parser = subparsers.add_parser("serve", help="запустить заменитель")
+    serve_parser.add_argument("--host", default="127.0.0.1", help="адрес для прослушивания")
+    serve_parser.add_argument("--port", type=int, default=8800, help="порт для прослушивания")
+    add_backend_arguments(serve_parser)
+
+    record_parser = subparsers.add_parser("record", help="записать настоящие ответы Wildberries")
+    record_parser.add_argument("skus_file", help="файл с артикулами или URL, по одному в строке")
+    record_parser.add_argument("--fixtures", required=True, help="каталог для записей")
+    return parser
+
+
+def main(argv=None) -> int:
+    args = build_parser().parse_args(argv)
+    if args.command == "serve":
+        serve(backend_from_args(args), args.host, args.port)
+    else:
+        from cli import read_skus
+        asyncio.run(record(read_skus(args.skus_file), args.fixtures))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
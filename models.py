@@ -0,0 +1,71 @@
+from typing import Dict, Any, Optional
+
+
+class Review:
+    """
+    Отзыв о товаре Wildberries со всеми полями, нужными для анализа.
+    Компактная запись со __slots__: тысячи отзывов не тянут за собой словари с сырым JSON.
+    """
+
+    __slots__ = ("text", "pros", "cons", "rating", "date", "nm_id", "variant")
+
+    def __init__(self, text: str = "", pros: str = "", cons: str = "", rating: Optional[int] = None,
+                 date: str = "", nm_id: Optional[str] = None, variant: str = ""):
+        self.text = text
+        self.pros = pros
+        self.cons = cons
+        self.rating = rating
+        self.date = date
+        self.nm_id = nm_id
+        self.variant = variant
+
+    @classmethod
+    def from_feedback(cls, feedback_item: Dict[str, Any]) -> "Review":
+        """Создает запись из элемента ответа feedbacks.wildberries.ru."""
+        rating = feedback_item.get("productValuation")
+        try:
+            rating = int(rating) if rating is not None else None
+        except (TypeError, ValueError):
+            rating = None
+
+        variant_parts = []
+        color = (feedback_item.get("color") or "").strip()
+        size = str(feedback_item.get("size") or "").strip()
+        if color:
+            variant_parts.append(color)
+        if size and size != "0":
+            variant_parts.append(size)
+
+        nm_id = feedback_item.get("nmId")
+        return cls(
+            text=(feedback_item.get("text") or "").strip(),
+            pros=(feedback_item.get("pros") or "").strip(),
+            cons=(feedback_item.get("cons") or "").strip(),
+            rating=rating,
+            date=str(feedback_item.get("createdDate") or ""),
+            nm_id=str(nm_id) if nm_id is not None else None,
+            variant=", ".join(variant_parts),
+        )
+
+    def to_prompt_text(self) -> str:
+        """Текст отзыва для промпта: оценка, текст, достоинства и недостатки."""
+        parts = []
+        if self.text:
+            parts.append(self.text)
+        if self.pros:
+            parts.append(f"Достоинства: {self.pros}")
+        if self.cons:
+            parts.append(f"Недостатки: {self.cons}")
+        if not parts:
+            return ""
+        text = " | ".join(parts)
+        if self.rating is not None:
+            text = f"(оценка {self.rating}/5) {text}"
+        return text
+
+    def to_dict(self) -> Dict[str, Any]:
+        """Словарь со всеми полями отзыва (для JSON)."""
+        return {slot: getattr(self, slot) for slot in self.__slots__}
+
+    def __repr__(self) -> str:
+        return f"Review(rating={self.rating}, date={self.date!r}, nm_id={self.nm_id!r}, text={self.text[:40]!r})"
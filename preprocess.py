@@ -0,0 +1,220 @@
+import re
+import time
+import string
+from collections import Counter
+from itertools import compress, repeat
+from operator import itemgetter, ne
+from typing import List, Dict, Any, FrozenSet, Iterable, Tuple
+from zlib import crc32
+
+from models import Review
+
+# Знаки препинания и редкие пробельные символы, которые при нормализации заменяются пробелом
+_SEPARATOR_CHARS = string.punctuation + "«»„“”‘’—–…№•·\n\r\t\xa0"
+_SEPARATOR_PATTERN = re.compile("[" + re.escape(_SEPARATOR_CHARS) + "]")
+# Нормализация всех отзывов идет над байтами cp1251 одним вызовом bytes.translate: в однобайтовой
+# кодировке перевод в нижний регистр, замена ё на е и знаков на пробел - одна таблица, что в несколько раз
+# быстрее str.lower и регулярного выражения. Символы вне cp1251 (эмодзи, казахские буквы) кодируются
+# escape-последовательностью, обратная косая черта становится пробелом, а код символа остается в тексте
+_NORMALIZE_ENCODING = "cp1251"
+_NORMALIZE_TABLE = bytes.maketrans(
+    (string.ascii_uppercase + "АБВГДЕЖЗИЙКЛМНОПРСТУФХЦЧШЩЪЫЬЭЮЯЁё" + _SEPARATOR_CHARS).encode(_NORMALIZE_ENCODING),
+    (string.ascii_lowercase + "абвгдежзийклмнопрстуфхцчшщъыьэюяее" + " " * len(_SEPARATOR_CHARS)).encode(_NORMALIZE_ENCODING),
+)
+# Разделитель отзывов при нормализации всех текстов одним вызовом
+_BATCH_SEPARATOR = "\x00"
+_BATCH_SEPARATOR_BYTES = _BATCH_SEPARATOR.encode(_NORMALIZE_ENCODING)
+
+# Поиск почти-дубликатов - MinHash с LSH по биграммам слов. Набросок отзыва - первые и последние
+# NEAR_DUPLICATE_SKETCH_WORDS слов (короткий текст целиком): хеширование всех слов 5000 отзывов
+# не укладывается в бюджет предобработки, а правки в середине текста набросок не меняют. Сигнатура -
+# _MINHASH_ROWS наименьших и столько же наибольших хешей биграмм наброска, разбитые на полосы по два значения.
+# Кандидаты - отзывы с совпавшей полосой, дубликатом кандидат считается при сходстве Жаккара по всем словам
+# не ниже порога. Тексты короче NEAR_DUPLICATE_MIN_CHARS букв сравниваются только на точное совпадение
+NEAR_DUPLICATE_MIN_CHARS = 40
+NEAR_DUPLICATE_SKETCH_WORDS = 6
+NEAR_DUPLICATE_THRESHOLD = 0.8
+_MINHASH_ROWS = 4
+_MINHASH_SIGNATURE = itemgetter(*range(_MINHASH_ROWS), *range(-_MINHASH_ROWS, 0))
+_MINHASH_BANDS = tuple(itemgetter(row, row + 1) for row in range(0, 2 * _MINHASH_ROWS, 2))
+
+# Отзыв с меньшим числом различных содержательных слов (длиннее 2 букв) считается малоинформативным
+MIN_INFORMATIVE_WORDS = 3
+# Три различных содержательных слова в нормализованном тексте (байты cp1251, слова разделены пробелами).
+# Поиск идет в начале текста, чтобы длинные повторы одного слова не вызывали долгий перебор; если там слов
+# не нашлось, слова длинного текста считаются целиком
+_INFORMATIVE_PATTERN = re.compile(
+    rb"(?<!\S)(\S{3,})(?!\S)"
+    rb".*?(?<!\S)(?!\1(?!\S))(\S{3,})(?!\S)"
+    rb".*?(?<!\S)(?!\1(?!\S)|\2(?!\S))\S{3,}(?!\S)"
+)
+_INFORMATIVE_SEARCH_CHARS = 200
+# Оценка информативности растет с числом букв отзыва и достигает 1 на этой длине
+INFORMATIVENESS_SATURATION_CHARS = 400
+
+
+def normalize_words(text: str) -> List[str]:
+    """Разбивает текст на слова в нижнем регистре без знаков препинания, ё заменяется на е."""
+    return _SEPARATOR_PATTERN.sub(" ", text.lower().replace("ё", "е")).split()
+
+
+def _review_parts(review: Any) -> Tuple[str, str, str]:
+    if isinstance(review, Review):
+        return (review.text, review.pros, review.cons)
+    if isinstance(review, dict):
+        return (review.get("text") or "", review.get("pros") or "", review.get("cons") or "")
+    return (str(review), "", "")
+
+
+def _normalize_text(text: str) -> bytes:
+    return text.encode(_NORMALIZE_ENCODING, "backslashreplace").translate(_NORMALIZE_TABLE)
+
+
+def _normalize_batch(raw_texts: List[str]) -> Tuple[List[bytes], List[bytes]]:
+    """
+    Нормализует все тексты одним вызовом bytes.translate (нижний регистр, ё -> е, знаки -> пробел,
+    как normalize_words, но в байтах cp1251 и без разбиения на слова).
+    Возвращает (нормализованные тексты, те же тексты без пробелов - ключи точных дубликатов).
+    """
+    batch = _normalize_text(_BATCH_SEPARATOR.join(raw_texts))
+    normalized_texts = batch.split(_BATCH_SEPARATOR_BYTES)
+    if len(normalized_texts) == len(raw_texts):
+        return normalized_texts, batch.translate(None, b" ").split(_BATCH_SEPARATOR_BYTES)
+    # Разделитель встретился в самом отзыве: нормализуем тексты по одному
+    normalized_texts = [_normalize_text(text) for text in raw_texts]
+    return normalized_texts, [text.translate(None, b" ") for text in normalized_texts]
+
+
+def _minhash_signatures(texts: List[bytes]) -> List[Tuple[int, ...]]:
+    """
+    MinHash-сигнатуры текстов (см. _MINHASH_SIGNATURE). Все тексты обрабатываются встроенными функциями
+    над списками: вызов функции Python на каждый отзыв обходится дороже самого хеширования.
+    """
+    size = NEAR_DUPLICATE_SKETCH_WORDS
+    sketches = [words if len(words) <= 2 * size else words[:size] + text.rsplit(None, size)[-size:]
+                for words, text in zip(map(bytes.split, texts, repeat(None), repeat(2 * size)), texts)]
+    # Хеш биграммы - crc32 второго слова, продолженный от crc32 первого, то есть crc32 их склейки.
+    # У однословного наброска единственный хеш - само слово; повтор списка дает сигнатуру полной длины
+    # и наброску, в котором хешей меньше 2 * _MINHASH_ROWS
+    hashes = [(sorted(map(crc32, words[1:], map(crc32, words))) or [crc32(words[0])]) * _MINHASH_ROWS
+              for words in sketches]
+    return list(map(_MINHASH_SIGNATURE, hashes))
+
+
+def _find_near_duplicates(texts: List[bytes], letters: List[int]) -> List[bool]:
+    """
+    Отмечает тексты, у которых есть более ранний почти-дубликат. Кандидат - первый текст с той же полосой
+    MinHash-сигнатуры, дубликатом он считается при сходстве Жаккара по словам не ниже NEAR_DUPLICATE_THRESHOLD.
+    """
+    signatures = _minhash_signatures(texts)
+    positions = range(len(texts))
+    candidates = set()
+    for band in _MINHASH_BANDS:
+        first_in_band: Dict[Tuple[int, int], int] = {}
+        earlier = list(map(first_in_band.setdefault, map(band, signatures), positions))
+        candidates.update(compress(zip(positions, earlier), map(ne, positions, earlier)))
+
+    duplicates = [False] * len(texts)
+    words: Dict[int, FrozenSet[bytes]] = {}
+    for position, other in sorted(candidates):
+        # При сходстве Жаккара не ниже порога длины текстов почти никогда не различаются сильно
+        if duplicates[position] or not (letters[position] * NEAR_DUPLICATE_THRESHOLD * 0.75 <= letters[other]
+                                         <= letters[position] / (NEAR_DUPLICATE_THRESHOLD * 0.75)):
+            continue
+        text_words = words.get(position)
+        if text_words is None:
+            text_words = words[position] = frozenset(texts[position].split())
+        other_words = words.get(other)
+        if other_words is None:
+            other_words = words[other] = frozenset(texts[other].split())
+        common = len(text_words & other_words)
+        duplicates[position] = common >= NEAR_DUPLICATE_THRESHOLD * (len(text_words) + len(other_words) - common)
+    return duplicates
+
+
+def _count_content_words(words: Iterable[bytes]) -> int:
+    """Считает различные содержательные слова (длиннее 2 букв), останавливаясь на MIN_INFORMATIVE_WORDS."""
+    found: List[bytes] = []
+    for word in words:
+        if len(word) > 2 and word not in found:
+            found.append(word)
+            if len(found) >= MIN_INFORMATIVE_WORDS:
+                break
+    return len(found)
+
+
+def _informative_flags(texts: List[bytes]) -> List[bool]:
+    """Есть ли в каждом нормализованном тексте MIN_INFORMATIVE_WORDS различных содержательных слов."""
+    # Окно поиска заканчивается на границе слова, чтобы обрезанное слово не сошло за новое
+    window_ends = [len(text) if len(text) <= _INFORMATIVE_SEARCH_CHARS
+                   else max(text.rfind(b" ", 0, _INFORMATIVE_SEARCH_CHARS), 0) for text in texts]
+    flags = [match is not None for match in map(_INFORMATIVE_PATTERN.search, texts, repeat(0), window_ends)]
+    for index, (text, window_end) in enumerate(zip(texts, window_ends)):
+        if not flags[index] and window_end < len(text):
+            flags[index] = _count_content_words(text.split()) >= MIN_INFORMATIVE_WORDS
+    return flags
+
+
+def informativeness_score(letters: int, informative: bool = True) -> float:
+    """
+    Оценка информативности отзыва от 0 до 1 по числу букв нормализованного текста;
+    у малоинформативного отзыва (меньше MIN_INFORMATIVE_WORDS содержательных слов) оценка вдвое ниже.
+    """
+    score = min(letters, INFORMATIVENESS_SATURATION_CHARS) / INFORMATIVENESS_SATURATION_CHARS
+    return score if informative else score / 2
+
+
+def preprocess_reviews(reviews: List[Any]) -> Tuple[List[Any], List[float], Dict[str, int]]:
+    """
+    Очищает отзывы перед анализом ИИ.
+
+    Сначала отбрасываются точные копии исходного текста, затем все оставшиеся тексты нормализуются одним
+    вызовом bytes.translate. Удаляются пустые отзывы, точные дубликаты после нормализации и
+    почти-дубликаты (кандидаты по полосам MinHash с проверкой сходства Жаккара по словам), а также
+    отзывы без содержательных слов вроде одиночного "Отлично". Малоинформативные отзывы остаются, только
+    если других нет. Порядок оставшихся отзывов сохраняется.
+
+    Returns:
+        (очищенный список отзывов, оценки информативности этих отзывов от 0 до 1 (см. informativeness_score),
+         счетчики: total, empty, exact_duplicates, near_duplicates, low_information, kept, elapsed_ms)
+    """
+    started = time.perf_counter()
+    stats = {"total": len(reviews), "empty": 0, "exact_duplicates": 0, "near_duplicates": 0,
+             "low_information": 0, "kept": 0, "elapsed_ms": 0}
+
+    # Точные копии исходного текста: число копий и первый отзыв с таким текстом. Здесь и дальше словари
+    # и списки строятся встроенными функциями: цикл Python по 5000 отзывов сам по себе съедает бюджет
+    raw_texts = [" ".join(_review_parts(review)) for review in reviews]
+    copies = Counter(raw_texts)
+    first_review = dict(zip(reversed(raw_texts), reversed(reviews)))
+    unique_texts = list(copies)
+    normalized_texts, keys = _normalize_batch(unique_texts) if unique_texts else ([], [])
+
+    # Ключ точного дубликата - текст без пробелов: разная расстановка пробелов и знаков не мешает
+    first_with_key: Dict[bytes, int] = {}
+    positions = range(len(keys))
+    distinct = [position for position, first in zip(positions, map(first_with_key.setdefault, keys, positions))
+                if position == first and keys[position]]
+    stats["empty"] = sum(copies[text] for text, key in zip(unique_texts, keys) if not key)
+    stats["exact_duplicates"] = len(reviews) - stats["empty"] - len(distinct)
+
+    long_positions = [position for position in distinct if len(keys[position]) >= NEAR_DUPLICATE_MIN_CHARS]
+    near_duplicates = set(compress(long_positions, _find_near_duplicates(
+        [normalized_texts[position] for position in long_positions],
+        [len(keys[position]) for position in long_positions])))
+    stats["near_duplicates"] = len(near_duplicates)
+
+    remaining = [position for position in distinct if position not in near_duplicates]
+    informative_flags = _informative_flags([normalized_texts[position] for position in remaining])
+    informative = list(compress(remaining, informative_flags))
+    if informative:
+        stats["low_information"] = len(remaining) - len(informative)
+        chosen = informative
+    else:
+        chosen = remaining
+    result = [first_review[unique_texts[position]] for position in chosen]
+    scores = [informativeness_score(len(keys[position]), bool(informative)) for position in chosen]
+
+    stats["kept"] = len(result)
+    stats["elapsed_ms"] = int((time.perf_counter() - started) * 1000)
+    return result, scores, stats
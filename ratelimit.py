@@ -0,0 +1,255 @@
+import os
+import re
+import time
+import logging
+import email.utils
+from typing import Any, Callable, Dict, Mapping, Optional, Tuple
+
+from cache import SqliteStore, get_app_data_dir
+
+logger = logging.getLogger('ReviewAnalyzer')
+
+# Длительность вида "2m59.56s", "7.66s", "120ms" из заголовков x-ratelimit-reset-*
+_DURATION_PATTERN = re.compile(r"(?:\d+(?:\.\d+)?(?:ms|h|m|s))+")
+_DURATION_PART_PATTERN = re.compile(r"(\d+(?:\.\d+)?)(ms|h|m|s)")
+_DURATION_UNITS = {"ms": 0.001, "s": 1.0, "m": 60.0, "h": 3600.0}
+
+
+def parse_duration(value: Any) -> Optional[float]:
+    """
+    Переводит значение заголовка ограничений в секунды: "30", "7.66s", "2m59.56s", "120ms"
+    или HTTP-дата (retry-after). None, если значения нет или оно не распознано.
+    """
+    if value is None:
+        return None
+    text = str(value).strip().lower()
+    if not text:
+        return None
+    try:
+        return max(float(text), 0.0)
+    except ValueError:
+        pass
+    if _DURATION_PATTERN.fullmatch(text):
+        return sum(float(number) * _DURATION_UNITS[unit] for number, unit in _DURATION_PART_PATTERN.findall(text))
+    try:
+        return max(email.utils.parsedate_to_datetime(str(value)).timestamp() - time.time(), 0.0)
+    except (TypeError, ValueError, IndexError, OverflowError):
+        return None
+
+
+def retry_after_from_headers(headers: Optional[Mapping[str, str]]) -> Optional[float]:
+    """Пауза до повтора из retry-after-ms / retry-after ответа 429 в секундах."""
+    if not headers:
+        return None
+    headers = _lower_headers(headers)
+    retry_after_ms = parse_duration(headers.get("retry-after-ms"))
+    if retry_after_ms is not None:
+        return retry_after_ms / 1000
+    return parse_duration(headers.get("retry-after"))
+
+
+def _lower_headers(headers: Mapping[str, str]) -> Dict[str, str]:
+    return {str(key).lower(): value for key, value in headers.items()}
+
+
+def _to_float(value: Any) -> Optional[float]:
+    try:
+        return float(value) if value is not None else None
+    except (TypeError, ValueError):
+        return None
+
+
+class ProviderRateLimiter(SqliteStore):
+    """
+    Ограничитель запросов к провайдерам LLM, общий для всех процессов приложения и сохраняемый в SQLite.
+
+    Для каждого провайдера ведутся два маркерных ведра (token bucket): запросы в минуту и токены в минуту.
+    Ведра пополняются равномерно по минутной квоте, а заголовки ответов (x-ratelimit-remaining-*,
+    x-ratelimit-reset-*, x-ratelimit-limit-tokens) уточняют остаток и квоту токенов. Ответ 429 закрывает
+    провайдера до истечения retry-after.
+
+    Предохранитель (circuit breaker): после FAILURE_THRESHOLD ошибок сервера или сети подряд провайдер
+    закрывается на OPEN_SECONDS (с каждой следующей ошибкой вдвое дольше, не более MAX_OPEN_SECONDS),
+    затем пропускается один пробный запрос; успешный ответ сбрасывает счетчик ошибок.
+
+    wait_time() позволяет выбрать провайдера до запроса, поэтому запрос не тратится на заведомый отказ 429.
+    """
+
+    DEFAULT_RETRY_AFTER = 60
+    FAILURE_THRESHOLD = 3
+    OPEN_SECONDS = 30
+    MAX_OPEN_SECONDS = 600
+
+    def __init__(self, db_path: Optional[str] = None):
+        if db_path is None:
+            db_path = os.path.join(get_app_data_dir(), "llm_limits.sqlite3")
+        # Квоты из настроек провайдеров: ключ -> (запросов в минуту, токенов в минуту); 0 - без ограничения
+        self._quotas: Dict[str, Tuple[float, float]] = {}
+        super().__init__(db_path)
+
+    def _init_db(self):
+        with self._connect() as conn:
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS provider_limits (
+                    provider TEXT PRIMARY KEY,
+                    request_level REAL NOT NULL,
+                    token_level REAL NOT NULL,
+                    token_limit REAL NOT NULL DEFAULT 0,
+                    updated_at REAL NOT NULL,
+                    blocked_until REAL NOT NULL DEFAULT 0,
+                    failures INTEGER NOT NULL DEFAULT 0,
+                    open_until REAL NOT NULL DEFAULT 0
+                )""")
+
+    def configure(self, provider: str, requests_per_minute: float = 0, tokens_per_minute: float = 0):
+        """Задает минутные квоты провайдера (0 - квота не ограничена или неизвестна)."""
+        self._quotas[provider] = (float(requests_per_minute), float(tokens_per_minute))
+
+    def _quota(self, provider: str, state: Dict[str, Any]) -> Tuple[float, float]:
+        requests_per_minute, tokens_per_minute = self._quotas.get(provider, (0.0, 0.0))
+        # Квота токенов из заголовка x-ratelimit-limit-tokens точнее настроенной
+        if state["token_limit"] > 0:
+            tokens_per_minute = state["token_limit"]
+        return requests_per_minute, tokens_per_minute
+
+    def _update(self, provider: str, action: Callable[[Dict[str, Any], float], Any]) -> Any:
+        """
+        Читает состояние провайдера, пополняет ведра на прошедшее время, применяет action(state, now)
+        и сохраняет состояние. Транзакция BEGIN IMMEDIATE не дает процессам выдать одну и ту же квоту дважды.
+        """
+        now = time.time()
+        with self._connect() as conn:
+            conn.execute("BEGIN IMMEDIATE")
+            row = conn.execute(
+                "SELECT request_level, token_level, token_limit, updated_at, blocked_until, failures, open_until "
+                "FROM provider_limits WHERE provider = ?", (provider,)
+            ).fetchone()
+            if row is None:
+                state = {"request_level": None, "token_level": None, "token_limit": 0.0, "updated_at": now,
+                         "blocked_until": 0.0, "failures": 0, "open_until": 0.0}
+            else:
+                state = dict(zip(("request_level", "token_level", "token_limit", "updated_at",
+                                  "blocked_until", "failures", "open_until"), row))
+            self._refill(provider, state, now)
+            result = action(state, now)
+            conn.execute(
+                "INSERT OR REPLACE INTO provider_limits (provider, request_level, token_level, token_limit, "
+                "updated_at, blocked_until, failures, open_until) VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                (provider, state["request_level"], state["token_level"], state["token_limit"], now,
+                 state["blocked_until"], state["failures"], state["open_until"])
+            )
+        return result
+
+    def _refill(self, provider: str, state: Dict[str, Any], now: float):
+        requests_per_minute, tokens_per_minute = self._quota(provider, state)
+        elapsed = max(now - state["updated_at"], 0.0)
+        for level_key, per_minute in (("request_level", requests_per_minute), ("token_level", tokens_per_minute)):
+            if state[level_key] is None:
+                state[level_key] = per_minute
+            elif per_minute > 0:
+                state[level_key] = min(per_minute, state[level_key] + elapsed * per_minute / 60)
+        state["updated_at"] = now
+
+    def _wait(self, provider: str, state: Dict[str, Any], now: float, tokens: float) -> float:
+        """Через сколько секунд провайдер сможет принять запрос на tokens токенов (0 - сразу)."""
+        requests_per_minute, tokens_per_minute = self._quota(provider, state)
+        wait = state["blocked_until"] - now
+        if state["failures"] >= self.FAILURE_THRESHOLD:
+            wait = max(wait, state["open_until"] - now)
+        if requests_per_minute > 0 and state["request_level"] < 1:
+            wait = max(wait, (1 - state["request_level"]) * 60 / requests_per_minute)
+        if tokens_per_minute > 0:
+            # Запрос больше минутной квоты пропускается при полном ведре
+            needed = min(tokens, tokens_per_minute)
+            if state["token_level"] < needed:
+                wait = max(wait, (needed - state["token_level"]) * 60 / tokens_per_minute)
+        return max(wait, 0.0)
+
+    def _open_seconds(self, failures: int) -> float:
+        return min(self.OPEN_SECONDS * 2 ** max(failures - self.FAILURE_THRESHOLD, 0), self.MAX_OPEN_SECONDS)
+
+    def wait_time(self, provider: str, tokens: float = 0) -> float:
+        """Через сколько секунд провайдер сможет принять запрос, не расходуя квоту."""
+        return self._update(provider, lambda state, now: self._wait(provider, state, now, tokens))
+
+    def try_acquire(self, provider: str, tokens: float = 0) -> float:
+        """
+        Пытается занять квоту на один запрос на tokens токенов. Возвращает 0, если квота занята,
+        иначе время ожидания в секундах (квота при этом не расходуется).
+        """
+        def acquire(state: Dict[str, Any], now: float) -> float:
+            wait = self._wait(provider, state, now, tokens)
+            if wait > 0:
+                return wait
+            requests_per_minute, tokens_per_minute = self._quota(provider, state)
+            if requests_per_minute > 0:
+                state["request_level"] -= 1
+            if tokens_per_minute > 0:
+                state["token_level"] -= min(tokens, tokens_per_minute)
+            if state["failures"] >= self.FAILURE_THRESHOLD:
+                # Пробный запрос после паузы предохранителя: остальные ждут его результата
+                state["open_until"] = now + self._open_seconds(state["failures"])
+            return 0.0
+        return self._update(provider, acquire)
+
+    def observe(self, provider: str, headers: Optional[Mapping[str, str]]):
+        """Уточняет остаток квот по заголовкам x-ratelimit-* ответа провайдера."""
+        if not headers:
+            return
+        headers = _lower_headers(headers)
+        if not any(key.startswith("x-ratelimit-") for key in headers):
+            return
+
+        def apply(state: Dict[str, Any], now: float):
+            token_limit = _to_float(headers.get("x-ratelimit-limit-tokens"))
+            if token_limit and token_limit > 0:
+                state["token_limit"] = token_limit
+            requests_per_minute, tokens_per_minute = self._quota(provider, state)
+            for kind, level_key, per_minute in (("requests", "request_level", requests_per_minute),
+                                                ("tokens", "token_level", tokens_per_minute)):
+                remaining = _to_float(headers.get(f"x-ratelimit-remaining-{kind}"))
+                if remaining is None:
+                    continue
+                state[level_key] = min(remaining, per_minute) if per_minute > 0 else remaining
+                reset = parse_duration(headers.get(f"x-ratelimit-reset-{kind}"))
+                if remaining < 1 and reset:
+                    state["blocked_until"] = max(state["blocked_until"], now + reset)
+        self._update(provider, apply)
+
+    def record_rate_limited(self, provider: str, retry_after: Optional[float] = None,
+                            headers: Optional[Mapping[str, str]] = None) -> float:
+        """Отмечает ответ 429: провайдер закрыт до истечения retry-after. Возвращает длительность паузы."""
+        self.observe(provider, headers)
+        if retry_after is None:
+            retry_after = retry_after_from_headers(headers)
+        if retry_after is None:
+            retry_after = self.DEFAULT_RETRY_AFTER
+
+        def apply(state: Dict[str, Any], now: float):
+            state["blocked_until"] = max(state["blocked_until"], now + retry_after)
+        self._update(provider, apply)
+        logger.warning(f"{provider}: ограничение запросов (429), следующий запрос не раньше чем через {retry_after:.1f} с")
+        return retry_after
+
+    def record_failure(self, provider: str):
+        """Отмечает ошибку сервера или сети; после FAILURE_THRESHOLD ошибок подряд предохранитель размыкается."""
+        def apply(state: Dict[str, Any], now: float):
+            state["failures"] += 1
+            if state["failures"] >= self.FAILURE_THRESHOLD:
+                state["open_until"] = now + self._open_seconds(state["failures"])
+                logger.warning(f"{provider}: {state['failures']} ошибок подряд, запросы приостановлены "
+                               f"на {self._open_seconds(state['failures']):.0f} с")
+        self._update(provider, apply)
+
+    def record_success(self, provider: str, headers: Optional[Mapping[str, str]] = None):
+        """Отмечает успешный ответ: счетчик ошибок сбрасывается, остаток квот уточняется по заголовкам."""
+        def apply(state: Dict[str, Any], now: float):
+            state["failures"] = 0
+            state["open_until"] = 0.0
+        self._update(provider, apply)
+        self.observe(provider, headers)
+
+    def state(self, provider: str) -> Dict[str, Any]:
+        """Текущее состояние провайдера (для отладки и статистики)."""
+        return self._update(provider, lambda state, now: dict(state))
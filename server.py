@@ -0,0 +1,377 @@
+# -*- coding: utf-8 -*-
+"""
+Локальный HTTP-сервис анализа отзывов на aiohttp.web.
+
+    POST /analyze  {"sku": "12345678"}            -> 202 {"job_id", "status_url", "events_url"}
+    POST /compare  {"skus": ["123...", "456..."]} -> 202 {"job_id", "status_url", "events_url"}
+    GET  /jobs/{job_id}                           -> состояние задачи и результат
+    GET  /jobs/{job_id}/events                    -> прогресс задачи в виде Server-Sent Events
+    GET  /metrics                                 -> метрики этапов в текстовом формате Prometheus (metrics.py)
+
+Задачи выполняются пулом обработчиков в одном цикле событий, поэтому пул соединений wb.py,
+клиенты LLM и кеш отзывов общие для всех запросов. Одновременные запросы одного и того же
+товара объединяются: отзывы загружаются и анализируются один раз.
+"""
+import json
+import time
+import uuid
+import asyncio
+import traceback
+from typing import Dict, List, Any, Optional
+
+from aiohttp import web
+
+from wb import WbReview, shutdown as wb_shutdown
+from ai import ReviewAnalyzer, shutdown as ai_shutdown
+from concurrency import SingleFlight
+from metrics import metrics
+
+MAX_COMPARE_PRODUCTS = 4
+MAX_FINISHED_JOBS = 1000
+DEFAULT_WORKERS = 4
+
+
+class Job:
+    """Задача анализа: входные артикулы, журнал событий прогресса и итоговый результат."""
+
+    def __init__(self, kind: str, skus: List[str]):
+        self.id = uuid.uuid4().hex
+        self.kind = kind
+        self.skus = skus
+        self.status = "queued"
+        self.progress = 0.0
+        self.message = "В очереди"
+        self.result: Optional[Dict[str, Any]] = None
+        self.error: Optional[str] = None
+        self.created_at = time.time()
+        self.finished_at: Optional[float] = None
+        self.events: List[Dict[str, Any]] = []
+        self._changed = asyncio.Event()
+
+    @property
+    def finished(self) -> bool:
+        return self.status in ("done", "error")
+
+    def put(self, message: tuple):
+        """
+        Принимает сообщения в формате очереди результатов main.py:
+        ("status_update", (progress, text)), ("result", ...), ("multi_result", ...), ("error", text), ("error_partial", text).
+        """
+        message_type, payload = message
+        if message_type == "status_update":
+            progress, text = payload
+            self.progress = max(self.progress, float(progress))
+            self.message = text
+            event = {"type": message_type, "progress": self.progress, "message": text}
+        elif message_type in ("result", "multi_result"):
+            self.status = "done"
+            self.progress = 1.0
+            self.result = payload
+            self.finished_at = time.time()
+            event = {"type": message_type, "result": payload}
+        elif message_type == "error":
+            self.status = "error"
+            self.error = payload
+            self.finished_at = time.time()
+            event = {"type": message_type, "message": payload}
+        else:
+            event = {"type": message_type, "message": payload}
+        self.events.append(event)
+        # Будим всех подписчиков SSE и сразу готовим событие для следующего ожидания
+        self._changed.set()
+        self._changed = asyncio.Event()
+
+    async def wait_for_events(self, seen: int):
+        """Ждет, пока в журнале появятся события после первых seen."""
+        if len(self.events) <= seen and not self.finished:
+            await self._changed.wait()
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            "job_id": self.id,
+            "kind": self.kind,
+            "skus": self.skus,
+            "status": self.status,
+            "progress": round(self.progress, 3),
+            "message": self.message,
+            "result": self.result,
+            "error": self.error,
+            "created_at": self.created_at,
+            "finished_at": self.finished_at,
+        }
+
+
+class AnalysisService:
+    """Очередь задач, пул обработчиков и объединение одновременных запросов одного товара."""
+
+    def __init__(self, workers: int = DEFAULT_WORKERS):
+        self.workers = max(1, workers)
+        self.jobs: Dict[str, Job] = {}
+        self._queue: Optional[asyncio.Queue] = None
+        self._worker_tasks: List[asyncio.Task] = []
+        # Товары, которые сейчас загружаются и анализируются, и задачи, ожидающие их результат
+        self._products = SingleFlight()
+        self._listeners: Dict[str, List[Job]] = {}
+
+    async def start(self):
+        self._queue = asyncio.Queue()
+        self._worker_tasks = [asyncio.create_task(self._worker()) for _ in range(self.workers)]
+
+    async def stop(self):
+        for task in self._worker_tasks:
+            task.cancel()
+        await asyncio.gather(*self._worker_tasks, return_exceptions=True)
+        self._worker_tasks = []
+        await asyncio.gather(wb_shutdown(), ai_shutdown())
+
+    def submit(self, kind: str, skus: List[str]) -> Job:
+        job = Job(kind, skus)
+        self.jobs[job.id] = job
+        self._queue.put_nowait(job)
+        self._forget_old_jobs()
+        return job
+
+    def _forget_old_jobs(self):
+        finished = [job for job in self.jobs.values() if job.finished]
+        if len(finished) <= MAX_FINISHED_JOBS:
+            return
+        finished.sort(key=lambda job: job.finished_at)
+        for job in finished[:len(finished) - MAX_FINISHED_JOBS]:
+            del self.jobs[job.id]
+
+    async def _worker(self):
+        while True:
+            job = await self._queue.get()
+            job.status = "running"
+            try:
+                if job.kind == "analyze":
+                    await self._run_analyze(job)
+                else:
+                    await self._run_compare(job)
+            except Exception as e:
+                print(f"SERVER.PY: Ошибка задачи {job.id}: {type(e).__name__}: {e}")
+                traceback.print_exc()
+                job.put(("error", f"Критическая ошибка задачи: {type(e).__name__}: {e}"))
+            finally:
+                self._queue.task_done()
+
+    def _notify(self, sku: str, message: tuple):
+        for job in self._listeners.get(sku, ()):
+            job.put(message)
+
+    async def _product_analysis(self, sku: str, job: Job) -> Dict[str, Any]:
+        """
+        Загружает отзывы и анализ товара. Если этот товар уже обрабатывается для другой задачи,
+        подписывает job на ее прогресс и ждет общий результат вместо повторной загрузки и запроса к LLM.
+        """
+        self._listeners.setdefault(sku, []).append(job)
+        if self._products.in_flight(sku):
+            job.put(("status_update", (job.progress, f"Товар {sku} уже обрабатывается, ожидаем общий результат...")))
+        try:
+            return await self._products.do(sku, lambda: self._fetch_and_analyze(sku))
+        finally:
+            listeners = self._listeners.get(sku, [])
+            if job in listeners:
+                listeners.remove(job)
+            if not listeners:
+                self._listeners.pop(sku, None)
+
+    async def _fetch_and_analyze(self, sku: str) -> Dict[str, Any]:
+        """Загружает отзывы и выполняет анализ одного товара. Ошибки возвращаются в поле error."""
+        product = {"product_id": sku, "product_name": f"Товар {sku}", "review_count": 0, "analysis": None, "error": None}
+        try:
+            wb_review = WbReview(sku)
+            await wb_review._init_product_info()
+            if wb_review.product_name:
+                product["product_name"] = wb_review.product_name
+            self._notify(sku, ("status_update", (0.1, f"Получаем отзывы для {product['product_name']}...")))
+            reviews = await wb_review.parse(only_this_variation=True, limit=ReviewAnalyzer.REVIEWS_LIMIT)
+            product["review_count"] = len(reviews)
+        except ValueError as ve:
+            product["error"] = f"Ошибка входных данных для товара (возможно, неверный артикул '{sku}'): {ve}"
+            return product
+        except Exception as e:
+            print(f"SERVER.PY: Ошибка при получении данных для товара {sku}: {type(e).__name__}: {e}")
+            product["error"] = f"Ошибка при получении данных для товара {sku}: {type(e).__name__} - {e}"
+            return product
+
+        product_name = product["product_name"]
+        if not reviews:
+            product["analysis"] = f"На текущий момент для товара «{product_name}» (арт. {sku}) не найдено отзывов. К сожалению, без них анализ провести невозможно. Попробуйте проверить позже, возможно, они появятся!"
+            return product
+
+        self._notify(sku, ("status_update", (0.7, f"Анализируем отзывы для '{product_name}' ({len(reviews)} шт.)...")))
+        try:
+            analysis = await ReviewAnalyzer.analyze_reviews_async(reviews, product_name)
+        except Exception as e:
+            product["error"] = f"Ошибка ИИ-анализа для {product_name} ({sku}): {e}"
+            return product
+        if ReviewAnalyzer._is_error_response(analysis):
+            product["error"] = f"Ошибка при анализе товара '{product_name}': {analysis}"
+        product["analysis"] = analysis
+        return product
+
+    async def _run_analyze(self, job: Job):
+        sku = job.skus[0]
+        job.put(("status_update", (0.05, f"Запрос данных для товара {sku}...")))
+        product = await self._product_analysis(sku, job)
+        if product["error"] and product["analysis"] is None:
+            job.put(("error", product["error"]))
+            return
+        if product["error"]:
+            job.put(("error_partial", product["error"]))
+        job.put(("status_update", (1.0, "Завершение анализа...")))
+        job.put(("result", {"product_name": product["product_name"], "review_count": product["review_count"],
+                            "analysis": product["analysis"]}))
+
+    async def _run_compare(self, job: Job):
+        total = len(job.skus)
+        job.put(("status_update", (0.05, f"Запрос данных для {total} товаров...")))
+        finished = [0]
+
+        async def analyze_product(sku):
+            product = await self._product_analysis(sku, job)
+            finished[0] += 1
+            if product["error"]:
+                job.put(("error_partial", product["error"]))
+            job.put(("status_update", (0.05 + finished[0] / total * 0.85,
+                                       f"Готов анализ для '{product['product_name']}' ({finished[0]}/{total})...")))
+            return product
+
+        products = await asyncio.gather(*(analyze_product(sku) for sku in job.skus))
+        individual_analyses = [p for p in products if p["analysis"] is not None]
+        successful = [p for p in individual_analyses
+                      if not p["error"] and p["review_count"] and not ReviewAnalyzer._is_error_response(p["analysis"])]
+        title = f"Сравнение: {', '.join(p['product_name'] for p in products)}"
+
+        if len(successful) < 2:
+            overall = (f"Сравнение не удалось: Не удалось получить достаточно успешных индивидуальных анализов "
+                       f"для сравнения (нужно минимум 2, получено {len(successful)}).")
+            job.put(("multi_result", {"title": f"{title} (неполное)", "products": products, "overall": overall}))
+            return
+
+        job.put(("status_update", (0.95, "Подготовка общего вывода...")))
+        comparison_prompt = ReviewAnalyzer._generate_comparison_prompt(successful)
+        overall = await ReviewAnalyzer._get_ai_response_async(comparison_prompt)
+        job.put(("status_update", (1.0, "Завершение сравнения...")))
+        job.put(("multi_result", {"title": title, "products": products, "overall": overall}))
+
+
+# --- HTTP-обработчики ---
+
+SERVICE_KEY = web.AppKey("service", AnalysisService)
+
+
+def _normalize_sku(value: Any) -> str:
+    """Приводит артикул или URL к числовому артикулу; ValueError для некорректных значений."""
+    if not isinstance(value, (str, int)):
+        raise ValueError(f"Ожидался артикул или URL, получено: {value!r}")
+    return WbReview.get_sku(str(value))
+
+
+async def _read_json(request: web.Request) -> Dict[str, Any]:
+    try:
+        body = await request.json()
+    except (json.JSONDecodeError, UnicodeDecodeError):
+        raise web.HTTPBadRequest(text=json.dumps({"error": "Тело запроса должно быть JSON"}, ensure_ascii=False),
+                                 content_type="application/json")
+    if not isinstance(body, dict):
+        raise web.HTTPBadRequest(text=json.dumps({"error": "Ожидался JSON-объект"}, ensure_ascii=False),
+                                 content_type="application/json")
+    return body
+
+
+def _bad_request(message: str) -> web.Response:
+    return web.json_response({"error": message}, status=400, dumps=lambda obj: json.dumps(obj, ensure_ascii=False))
+
+
+def _accepted(request: web.Request, job: Job) -> web.Response:
+    return web.json_response({
+        "job_id": job.id,
+        "status_url": str(request.app.router["job"].url_for(job_id=job.id)),
+        "events_url": str(request.app.router["job_events"].url_for(job_id=job.id)),
+    }, status=202)
+
+
+async def handle_analyze(request: web.Request) -> web.Response:
+    body = await _read_json(request)
+    try:
+        sku = _normalize_sku(body.get("sku"))
+    except ValueError as e:
+        return _bad_request(str(e))
+    return _accepted(request, request.app[SERVICE_KEY].submit("analyze", [sku]))
+
+
+async def handle_compare(request: web.Request) -> web.Response:
+    body = await _read_json(request)
+    raw_skus = body.get("skus")
+    if not isinstance(raw_skus, list):
+        return _bad_request("Поле skus должно быть списком артикулов или URL")
+    try:
+        skus = list(dict.fromkeys(_normalize_sku(value) for value in raw_skus))
+    except ValueError as e:
+        return _bad_request(str(e))
+    if not 2 <= len(skus) <= MAX_COMPARE_PRODUCTS:
+        return _bad_request(f"Для сравнения нужно от 2 до {MAX_COMPARE_PRODUCTS} разных товаров")
+    return _accepted(request, request.app[SERVICE_KEY].submit("compare", skus))
+
+
+def _get_job(request: web.Request) -> Job:
+    job = request.app[SERVICE_KEY].jobs.get(request.match_info["job_id"])
+    if job is None:
+        raise web.HTTPNotFound(text=json.dumps({"error": "Задача не найдена"}, ensure_ascii=False),
+                               content_type="application/json")
+    return job
+
+
+async def handle_job(request: web.Request) -> web.Response:
+    return web.json_response(_get_job(request).to_dict(), dumps=lambda obj: json.dumps(obj, ensure_ascii=False))
+
+
+async def handle_job_events(request: web.Request) -> web.StreamResponse:
+    """Отдает журнал событий задачи и новые события по мере появления (Server-Sent Events)."""
+    job = _get_job(request)
+    response = web.StreamResponse(headers={"Content-Type": "text/event-stream", "Cache-Control": "no-cache"})
+    await response.prepare(request)
+    seen = 0
+    while True:
+        while seen < len(job.events):
+            event = job.events[seen]
+            seen += 1
+            data = json.dumps(event, ensure_ascii=False)
+            await response.write(f"event: {event['type']}\ndata: {data}\n\n".encode("utf-8"))
+        if job.finished:
+            break
+        await job.wait_for_events(seen)
+    await response.write_eof()
+    return response
+
+
+async def handle_metrics(request: web.Request) -> web.Response:
+    return web.Response(text=metrics.render_prometheus(), content_type="text/plain", charset="utf-8",
+                        headers={"X-Prometheus-Version": "0.0.4"})
+
+
+def create_app(workers: int = DEFAULT_WORKERS) -> web.Application:
+    app = web.Application()
+    service = AnalysisService(workers)
+    app[SERVICE_KEY] = service
+
+    async def on_startup(app):
+        await service.start()
+
+    async def on_cleanup(app):
+        await service.stop()
+
+    app.on_startup.append(on_startup)
+    app.on_cleanup.append(on_cleanup)
+    app.router.add_post("/analyze", handle_analyze)
+    app.router.add_post("/compare", handle_compare)
+    app.router.add_get("/jobs/{job_id}", handle_job, name="job")
+    app.router.add_get("/jobs/{job_id}/events", handle_job_events, name="job_events")
+    app.router.add_get("/metrics", handle_metrics)
+    return app
+
+
+def run(host: str = "127.0.0.1", port: int = 8080, workers: int = DEFAULT_WORKERS):
+    web.run_app(create_app(workers), host=host, port=port)
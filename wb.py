@@ -1,33 +1,252 @@
+import os
 import re
 import json
+import random
 import asyncio
 import aiohttp
-from typing import List, Dict, Optional, Any
+import email.utils
+import time
+from urllib.parse import urlsplit
+from typing import List, Dict, Optional, Any, Callable, AsyncIterator, Tuple
+
+from cache import ReviewCache, ProductInfoCache
+from concurrency import SingleFlight, CancellationToken, cancellable
+from metrics import metrics
+from models import Review
+
+class RetryPolicy:
+    """
+    Повторы запросов к Wildberries при ограничении (429), ошибках сервера (5xx), таймаутах и обрывах соединения.
+    Пауза растет экспоненциально со случайным разбросом (full jitter), Retry-After сервера имеет приоритет.
+    Бюджет повторов: каждый запрос добавляет budget_ratio кредита (не больше budget_burst), повтор расходует
+    один кредит, поэтому при длительном сбое WB повторы не умножают нагрузку на сервер.
+    """
+
+    RETRY_STATUSES = frozenset({429, 500, 502, 503, 504})
+
+    def __init__(self, max_attempts: int = 4, base_delay: float = 0.5, max_delay: float = 8.0,
+                 max_retry_after: float = 30.0, budget_ratio: float = 0.2, budget_burst: float = 10.0):
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.max_retry_after = max_retry_after
+        self.budget_ratio = budget_ratio
+        self.budget_burst = budget_burst
+        self._credit = budget_burst
+        self.retries = 0
+
+    def note_request(self):
+        self._credit = min(self.budget_burst, self._credit + self.budget_ratio)
+
+    def retry_delay(self, attempt: int, retry_after: Optional[float] = None) -> Optional[float]:
+        """
+        Пауза перед повтором после попытки attempt (с нуля) или None, если повторять не следует:
+        попытки или бюджет исчерпаны, либо сервер просит ждать дольше max_retry_after.
+        """
+        if attempt + 1 >= self.max_attempts:
+            return None
+        if retry_after is not None and retry_after > self.max_retry_after:
+            return None
+        if self._credit < 1:
+            return None
+        self._credit -= 1
+        self.retries += 1
+        if retry_after is not None:
+            return retry_after
+        return random.uniform(0, min(self.max_delay, self.base_delay * 2 ** attempt))
+
+    @staticmethod
+    def parse_retry_after(value: Optional[str]) -> Optional[float]:
+        """Retry-After в секундах: число секунд или HTTP-дата."""
+        if not value:
+            return None
+        try:
+            return max(float(value), 0.0)
+        except ValueError:
+            pass
+        try:
+            return max(email.utils.parsedate_to_datetime(value).timestamp() - time.time(), 0.0)
+        except (TypeError, ValueError, IndexError, OverflowError):
+            return None
+
+
+class WbSessionManager:
+    """
+    Общий пул соединений aiohttp для всех экземпляров WbReview.
+    Держит одну сессию на цикл событий с keep-alive, ограничением соединений на хост и кешем DNS,
+    поэтому запросы к страницам товара, card.wb.ru и feedbacks.wildberries.ru переиспользуют соединения.
+    Запросы через request() повторяются по правилам retry_policy, одновременно к одному хосту
+    выполняется не более limit_per_host запросов.
+    """
+
+    def __init__(self, headers: Optional[Dict[str, str]] = None, limit: int = 100, limit_per_host: int = 8,
+                 ttl_dns_cache: int = 300, keepalive_timeout: float = 30.0, total_timeout: float = 15.0,
+                 retry_policy: Optional[RetryPolicy] = None):
+        self.headers = headers or {}
+        self.limit = limit
+        self.limit_per_host = limit_per_host
+        self.ttl_dns_cache = ttl_dns_cache
+        self.keepalive_timeout = keepalive_timeout
+        self.total_timeout = total_timeout
+        self.retry_policy = retry_policy or RetryPolicy()
+        self._session: Optional[aiohttp.ClientSession] = None
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._host_semaphores: Dict[str, asyncio.Semaphore] = {}
+
+    async def get_session(self) -> aiohttp.ClientSession:
+        """Возвращает общую сессию для текущего цикла событий, создавая ее при необходимости."""
+        loop = asyncio.get_running_loop()
+        if self._session is not None and not self._session.closed and self._loop is loop:
+            return self._session
+
+        if self._session is not None and not self._session.closed and self._loop is not loop:
+            # Сессия привязана к другому циклу событий и не может быть в нем использована
+            print("WB.PY: Общая сессия принадлежит другому циклу событий, закрываем ее и создаем новую.")
+            await self._close_stale_session(self._session, self._loop)
+
+        connector = aiohttp.TCPConnector(
+            limit=self.limit,
+            limit_per_host=self.limit_per_host,
+            ttl_dns_cache=self.ttl_dns_cache,
+            keepalive_timeout=self.keepalive_timeout,
+        )
+        self._session = aiohttp.ClientSession(
+            headers=self.headers,
+            connector=connector,
+            timeout=aiohttp.ClientTimeout(total=self.total_timeout),
+        )
+        self._loop = loop
+        self._host_semaphores = {}
+        return self._session
+
+    @staticmethod
+    async def _close_stale_session(session: aiohttp.ClientSession, loop: Optional[asyncio.AbstractEventLoop]):
+        """
+        Закрывает сессию другого цикла событий, чтобы не оставлять открытые соединения.
+        Если тот цикл работает в другом потоке, сессия закрывается в нем; иначе коннектор отсоединяется
+        от сессии и закрывается здесь (у закрытого цикла соединения уже разорваны, закрытие только
+        освобождает коннектор).
+        """
+        if loop is not None and loop.is_running():
+            asyncio.run_coroutine_threadsafe(session.close(), loop)
+            return
+        connector = session.connector
+        session.detach()
+        if connector is None or connector.closed:
+            return
+        try:
+            await connector.close()
+        except RuntimeError:
+            # Ожидание закрытия соединений привязано к незапущенному циклу; соединения уже закрываются
+            pass
+
+    async def request(self, method: str, url: str, **kwargs: Any) -> aiohttp.ClientResponse:
+        """
+        Выполняет запрос с повторами и возвращает ответ с уже прочитанным телом
+        (response.json() и response.text() доступны после освобождения соединения).
+        Таймаут или обрыв на чтении тела тоже повторяются. Если повторы исчерпаны, возвращается
+        последний ответ с ошибочным статусом или поднимается последнее исключение сети.
+        """
+        session = await self.get_session()
+        host = urlsplit(url).hostname or ""
+        semaphore = self._host_semaphores.get(host)
+        if semaphore is None:
+            semaphore = self._host_semaphores[host] = asyncio.Semaphore(max(1, self.limit_per_host))
+        policy = self.retry_policy
+        policy.note_request()
+
+        attempt = 0
+        while True:
+            async with semaphore:
+                started = time.perf_counter()
+                try:
+                    async with session.request(method, url, **kwargs) as response:
+                        await response.read()
+                except (aiohttp.ClientConnectionError, aiohttp.ClientPayloadError, asyncio.TimeoutError) as e:
+                    metrics.inc("wb_http_requests", host=host, status=type(e).__name__)
+                    delay = policy.retry_delay(attempt)
+                    if delay is None:
+                        raise
+                    print(f"WB.PY: {type(e).__name__} при запросе {url}, повтор через {delay:.1f} с (попытка {attempt + 2})")
+                else:
+                    metrics.inc("wb_http_requests", host=host, status=response.status)
+                    metrics.observe("wb_http_request_seconds", time.perf_counter() - started, host=host)
+                    if response.status not in policy.RETRY_STATUSES:
+                        return response
+                    delay = policy.retry_delay(attempt, policy.parse_retry_after(response.headers.get("Retry-After")))
+                    if delay is None:
+                        return response
+                    print(f"WB.PY: {url} вернул статус {response.status}, повтор через {delay:.1f} с (попытка {attempt + 2})")
+            metrics.inc("wb_http_retries", host=host)
+            await asyncio.sleep(delay)
+            attempt += 1
+
+    async def close(self):
+        """Закрывает общую сессию и все соединения пула. Должен вызываться в том же цикле событий."""
+        session, self._session = self._session, None
+        self._loop = None
+        if session is not None and not session.closed:
+            await session.close()
+
+
+def _sku_span_attrs(self: "WbReview", *args: Any, **kwargs: Any) -> Dict[str, Any]:
+    return {"sku": self.sku}
+
+
+# Если задан WB_BASE_URL (например, локальный mock_server.py), все запросы к Wildberries идут на этот адрес с теми же путями
+_WB_BASE_URL = os.environ.get("WB_BASE_URL", "").rstrip("/")
+
 
 class WbReview:
     HEADERS = {
         'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/126.0.0.0 Safari/537.36',
     }
 
-    def __init__(self, string: str):
+    # Шаблоны адресов страницы товара, API карточки и API отзывов
+    PRODUCT_PAGE_URL = (_WB_BASE_URL or "https://www.wildberries.ru") + "/catalog/{sku}/detail.aspx"
+    CARD_API_URL = (_WB_BASE_URL or "https://card.wb.ru") + "/cards/v2/detail?appType=1&curr=rub&dest=-1257786&spp=30&nm={sku}"
+    FEEDBACKS_URL = (_WB_BASE_URL or "https://feedbacks.wildberries.ru") + "/api/v1/feedbacks?imtId={root_id}&take={take}&skip={skip}"
+
+    # Кеш отзывов по умолчанию, создается при первом обращении
+    _default_review_cache: Optional[ReviewCache] = None
+    # Кеш информации о товарах (SKU -> root_id, название, бренд, цвет); отключение - WB_PRODUCT_INFO_CACHE_ENABLED=0
+    _product_info_cache: Optional[ProductInfoCache] = None
+    _product_info_cache_enabled: bool = os.environ.get("WB_PRODUCT_INFO_CACHE_ENABLED", "1") != "0"
+
+    # Сколько артикулов запрашивается в API карточек одним запросом (init_product_info_many)
+    CARD_BATCH_SIZE = 50
+
+    # Объединение одновременных запросов: информация о товаре по SKU, parse по SKU и параметрам
+    _product_info_flight = SingleFlight()
+    _parse_flight = SingleFlight()
+
+    def __init__(self, string: str, session_manager: Optional[WbSessionManager] = None,
+                 review_cache: Optional[ReviewCache] = None):
         self.sku: str = self.get_sku(string=string)
         self.product_name: str = ""
         self.color: str = ""
+        self.brand: str = ""
         self.root_id: Optional[str] = None
-        self._session: Optional[aiohttp.ClientSession] = None
+        self._session_manager: Optional[WbSessionManager] = session_manager
+        self._review_cache: Optional[ReviewCache] = review_cache
+        self._feedbacks_exhausted: bool = False
         
     async def _get_session(self) -> aiohttp.ClientSession:
-        """Получает или создает сессию aiohttp."""
-        if self._session is None or self._session.closed:
-            timeout = aiohttp.ClientTimeout(total=15)
-            self._session = aiohttp.ClientSession(headers=self.HEADERS, timeout=timeout)
-        return self._session
+        """Получает общую сессию aiohttp из пула соединений."""
+        manager = self._session_manager or session_manager
+        return await manager.get_session()
+
+    async def _get(self, url: str, **kwargs: Any) -> aiohttp.ClientResponse:
+        """GET через общий пул соединений с повторами при временных сбоях WB (см. WbSessionManager.request)."""
+        manager = self._session_manager or session_manager
+        return await manager.request("GET", url, **kwargs)
 
     async def close_session(self):
-        """Закрывает сессию aiohttp, если она была создана."""
-        if self._session and not self._session.closed:
-            await self._session.close()
-            self._session = None
+        """
+        Оставлено для совместимости: сессия общая для всех экземпляров
+        и закрывается один раз через shutdown().
+        """
+        return None
 
     @staticmethod
     def get_sku(string: str) -> str:
@@ -51,22 +270,25 @@ class WbReview:
         else:
             raise ValueError(f"Некорректный формат для SKU: '{string}'. Ожидался URL Wildberries (например, 'https://www.wildberries.ru/catalog/1234567/detail.aspx') или числовой артикул (7-15 цифр).")
 
-    async def _get_product_name_from_page(self) -> Optional[str]:
-        """Асинхронно получает название товара непосредственно со страницы товара."""
-        if not self.sku: return None
+    @metrics.timed("wb.product_page", attrs=_sku_span_attrs)
+    async def _get_product_name_from_page(self) -> Tuple[Optional[str], bool]:
+        """
+        Асинхронно получает название товара непосредственно со страницы товара.
+        Возвращает (название или None, True, если страница ответила 404 - товара нет на Wildberries).
+        """
+        if not self.sku: return None, False
         try:
-            session = await self._get_session()
-            url = f"https://www.wildberries.ru/catalog/{self.sku}/detail.aspx"
-            async with session.get(url, allow_redirects=True, timeout=aiohttp.ClientTimeout(total=20)) as response:
-                if response.status != 200:
-                    print(f"WB.PY: Запрос страницы товара {self.sku} вернул статус {response.status}. URL: {url}")
-                    if response.history:
-                        final_url = str(response.url)
-                        if f"/catalog/{self.sku}/" not in final_url:
-                            print(f"WB.PY: Обнаружен редирект на другой товар при запросе {url}, финальный URL: {final_url}. Имя текущего SKU ({self.sku}) получить не удастся.")
-                    return None
-                
-                html_content = await response.text()
+            url = self.PRODUCT_PAGE_URL.format(sku=self.sku)
+            response = await self._get(url, allow_redirects=True, timeout=aiohttp.ClientTimeout(total=20))
+            if response.status != 200:
+                print(f"WB.PY: Запрос страницы товара {self.sku} вернул статус {response.status}. URL: {url}")
+                if response.history:
+                    final_url = str(response.url)
+                    if f"/catalog/{self.sku}/" not in final_url:
+                        print(f"WB.PY: Обнаружен редирект на другой товар при запросе {url}, финальный URL: {final_url}. Имя текущего SKU ({self.sku}) получить не удастся.")
+                return None, response.status == 404
+            
+            html_content = await response.text()
             
             title_pattern = r'<h1\s+class="product-page__title"[^>]*>(.*?)</h1>'
             title_match = re.search(title_pattern, html_content, re.DOTALL)
@@ -74,7 +296,7 @@ class WbReview:
             if title_match:
                 title = re.sub(r'<[^>]+>', '', title_match.group(1)).strip()
                 title = re.sub(r'<!--.*?-->', '', title)
-                return title if title else None
+                return (title if title else None), False
             
             title_pattern2 = r'<span\s+data-link="text{:selectedNomenclature.naming}"[^>]*>(.*?)</span>'
             title_match2 = re.search(title_pattern2, html_content, re.DOTALL)
@@ -82,202 +304,520 @@ class WbReview:
             if title_match2:
                 title = re.sub(r'<[^>]+>', '', title_match2.group(1)).strip()
                 title = re.sub(r'<!--.*?-->', '', title)
-                return title if title else None
+                return (title if title else None), False
             
             print(f"WB.PY: Не удалось найти имя товара на странице для SKU {self.sku}")
-            return None
+            return None, False
         except aiohttp.ClientError as e:
             print(f"WB.PY: Ошибка сети (aiohttp) при получении названия товара {self.sku}: {type(e).__name__} - {e}")
-            return None
+            return None, False
         except asyncio.TimeoutError:
             print(f"WB.PY: Таймаут при получении названия товара {self.sku} со страницы.")
-            return None
+            return None, False
         except Exception as e:
             print(f"WB.PY: Неожиданная ошибка при получении названия товара {self.sku} со страницы: {type(e).__name__} - {e}")
-            return None
+            return None, False
 
+    @metrics.timed("wb.product_info", attrs=_sku_span_attrs)
     async def _init_product_info(self):
         """
         Асинхронно инициализирует информацию о товаре: root_id, название, бренд и цвет.
         Вызывается перед операциями, требующими этих данных.
+        Одновременные вызовы для одного SKU (из разных экземпляров) выполняют запросы один раз.
+        Информация, сохраненная в кеше информации о товарах, берется без сетевых запросов.
         """
         if self.root_id is not None and self.product_name:
             return
+        self.root_id, self.product_name, self.color, self.brand = await self._product_info_flight.do(
+            self.sku, self._load_product_info)
 
-        page_title = await self._get_product_name_from_page()
-        if page_title:
-            self.product_name = page_title
-        
+    async def _load_product_info(self) -> Tuple[Optional[str], str, str, str]:
+        """
+        Берет информацию о товаре из кеша или загружает ее из API карточки (и при необходимости со страницы)
+        и сохраняет в кеш. Возвращает (root_id, product_name, color, brand).
+        """
+        cache = self._get_product_info_cache()
+        entry = None
+        if cache is not None:
+            try:
+                entry = cache.get(self.sku)
+            except Exception as e:
+                print(f"WB.PY: Кеш информации о товарах недоступен ({type(e).__name__} - {e}), запрашиваем API.")
+        if entry is not None:
+            metrics.inc("wb_product_info_cache", result="hit" if entry["found"] else "negative_hit")
+            self._apply_cached_product_info(entry)
+        else:
+            metrics.inc("wb_product_info_cache", result="miss")
+            found = await self._fill_product_info()
+            self._save_product_info(cache, found)
+        return self.root_id, self.product_name, self.color, self.brand
+
+    @classmethod
+    def _get_product_info_cache(cls) -> Optional[ProductInfoCache]:
+        """Общий кеш информации о товарах или None, если он отключен или недоступен."""
+        if WbReview._product_info_cache is None and WbReview._product_info_cache_enabled:
+            try:
+                WbReview._product_info_cache = ProductInfoCache()
+            except Exception as e:
+                print(f"WB.PY: Не удалось открыть кеш информации о товарах: {type(e).__name__} - {e}")
+                WbReview._product_info_cache_enabled = False
+        return WbReview._product_info_cache
+
+    def _apply_cached_product_info(self, entry: Dict[str, Any]):
+        """Заполняет информацию о товаре из записи кеша; для отсутствующего товара - значения по умолчанию."""
+        if entry["found"]:
+            self.root_id = entry["root_id"] or self.sku
+            self.product_name = entry["product_name"] or f"Товар {self.sku}"
+            self.color = entry["color"]
+            self.brand = entry["brand"]
+        else:
+            self._apply_product_info(None)
+
+    def _save_product_info(self, cache: Optional[ProductInfoCache], found: Optional[bool]):
+        """
+        Сохраняет информацию о товаре в кеш: found=True - товар найден, False - товара нет на Wildberries
+        (отрицательная запись), None - результат неизвестен из-за ошибки запроса, кеш не меняется.
+        """
+        if cache is None or found is None:
+            return
         try:
-            session = await self._get_session()
-            api_url = f'https://card.wb.ru/cards/v2/detail?appType=1&curr=rub&dest=-1257786&spp=30&nm={self.sku}'
-            async with session.get(api_url) as response:
-                if response.status != 200:
-                    print(f"WB.PY: Ошибка API {response.status} при получении данных для SKU {self.sku} с {api_url}")
-                    if not self.product_name:
-                        self.product_name = f"Товар {self.sku}"
-                    self.root_id = self.sku
-                    return
+            if found:
+                cache.put(self.sku, self.root_id, self.product_name, self.brand, self.color)
+            else:
+                cache.put_missing(self.sku)
+        except Exception as e:
+            print(f"WB.PY: Не удалось сохранить информацию о товаре {self.sku} в кеш: {type(e).__name__} - {e}")
 
-                product_data_json = await response.json()
+    async def _fill_product_info(self) -> Optional[bool]:
+        """
+        Основной источник - JSON API карточки: root_id, название, бренд и цвет за один небольшой запрос.
+        Страница товара запрашивается только если API не вернул название или запрос к нему не удался.
+        Возвращает True, если товар найден, False, если товара точно нет на Wildberries (API карточек
+        вернуло корректный ответ без этого артикула и страница ответила 404), None - если это неизвестно
+        (ошибки запросов, неожиданная структура ответа API, страница без названия).
+        """
+        product_info = await self._get_card_info()
+        page_title, page_missing = None, False
+        if not (product_info and product_info.get("name")):
+            page_title, page_missing = await self._get_product_name_from_page()
+        self._apply_product_info(product_info, page_title)
+        if product_info or page_title:
+            return True
+        # Отрицательная запись кеша - только если оба источника подтвердили, что товара нет
+        return False if product_info == {} and page_missing else None
 
-            if not product_data_json.get("data") or not product_data_json["data"].get("products"):
-                print(f"WB.PY: Структура ответа API (v2) изменилась или не содержит данных для SKU {self.sku}. URL: {api_url}")
-                if not self.product_name: self.product_name = f"Товар {self.sku}"
-                self.root_id = self.sku
-                return
+    @metrics.timed("wb.card_info", attrs=_sku_span_attrs)
+    async def _get_card_info(self) -> Optional[Dict[str, Any]]:
+        """
+        Запрашивает карточку товара в API card.wb.ru. Возвращает описание товара, пустой словарь,
+        если в корректном ответе API нет такого товара, или None при ошибке запроса или неожиданной
+        структуре ответа.
+        """
+        infos = await self._get_card_infos([self.sku], self._session_manager)
+        return infos.get(self.sku, {}) if infos is not None else None
 
-            product_info = product_data_json["data"]["products"][0]
-            self.root_id = str(product_info.get("id", self.sku))
+    @classmethod
+    async def _get_card_infos(cls, skus: List[str],
+                              manager: Optional[WbSessionManager] = None) -> Optional[Dict[str, Dict[str, Any]]]:
+        """
+        Запрашивает карточки нескольких товаров одним запросом к API card.wb.ru (nm=a;b;c).
+        Возвращает описания найденных товаров по SKU (товаров, которых нет в ответе, нет и в словаре);
+        при ошибке запроса или неожиданной структуре ответа - None.
+        """
+        skus_label = ", ".join(skus)
+        api_url = cls.CARD_API_URL.format(sku=";".join(skus))
+        try:
+            response = await (manager or session_manager).request("GET", api_url)
+            if response.status != 200:
+                print(f"WB.PY: Ошибка API {response.status} при получении данных для SKU {skus_label} с {api_url}")
+                return None
 
-            api_name = product_info.get("name")
-            if not self.product_name or self.product_name == self.sku:
-                if api_name and api_name != self.sku :
-                     self.product_name = api_name
-                if not self.product_name or self.product_name == self.sku:
-                    self.product_name = f"Товар {self.sku}"
-
-            if "brand" in product_info and product_info["brand"]:
-                brand = product_info["brand"]
-                if brand.lower() not in self.product_name.lower():
-                    self.product_name = f"{brand} / {self.product_name}"
-            
-            if "colors" in product_info and isinstance(product_info["colors"], list) and len(product_info["colors"]) > 0:
-                current_color_name = ""
-                for color_option in product_info["colors"]:
-                    if isinstance(color_option, dict) and str(color_option.get("id")) == self.sku :
-                        option_found = False
-                        if "options" in color_option and isinstance(color_option["options"], list):
-                            for opt in color_option["options"]:
-                                if isinstance(opt, dict) and str(opt.get("id")) == self.sku:
-                                    current_color_name = opt.get("name", "")
-                                    option_found = True
-                                    break
-                        if option_found and current_color_name:
-                            break
-                        if not current_color_name and not option_found:
-                             current_color_name = color_option.get("name","")
-
-                self.color = current_color_name if current_color_name else product_info["colors"][0].get("name", "")
-
-            elif "options" in product_info and isinstance(product_info["options"], list):
-                 for option in product_info["options"]:
-                     if isinstance(option, dict) and str(option.get("id")) == self.sku:
-                         self.color = option.get("name", "")
-                         break
-            
-            if self.root_id is None: self.root_id = self.sku
+            product_data_json = await response.json()
+
+            data = product_data_json.get("data") if isinstance(product_data_json, dict) else None
+            if not isinstance(data, dict) or not isinstance(data.get("products"), list):
+                print(f"WB.PY: Структура ответа API (v2) изменилась для SKU {skus_label}. URL: {api_url}")
+                return None
+
+            products = data["products"]
+            infos = {str(product.get("id")): product for product in products if isinstance(product, dict)}
+            if len(skus) == 1 and skus[0] not in infos and products and isinstance(products[0], dict):
+                # Для одного артикула API может вернуть карточку с другим id (например, склейку)
+                infos[skus[0]] = products[0]
+            return {sku: infos[sku] for sku in skus if sku in infos}
 
         except aiohttp.ClientError as e:
-            print(f"WB.PY: Ошибка сети (aiohttp) при получении информации о товаре {self.sku} из API: {type(e).__name__} - {e}")
-            if not self.product_name: self.product_name = f"Товар {self.sku}"
-            if self.root_id is None: self.root_id = self.sku
+            print(f"WB.PY: Ошибка сети (aiohttp) при получении информации о товаре {skus_label} из API: {type(e).__name__} - {e}")
         except asyncio.TimeoutError:
-            print(f"WB.PY: Таймаут при получении информации о товаре {self.sku} из API.")
-            if not self.product_name: self.product_name = f"Товар {self.sku}"
-            if self.root_id is None: self.root_id = self.sku
+            print(f"WB.PY: Таймаут при получении информации о товаре {skus_label} из API.")
         except json.JSONDecodeError as e:
-            print(f"WB.PY: Ошибка декодирования JSON от API для товара {self.sku}: {e}")
-            if not self.product_name: self.product_name = f"Товар {self.sku}"
-            if self.root_id is None: self.root_id = self.sku
+            print(f"WB.PY: Ошибка декодирования JSON от API для товара {skus_label}: {e}")
         except Exception as e:
-            print(f"WB.PY: Неожиданная ошибка при инициализации информации о товаре {self.sku}: {type(e).__name__} - {e}")
+            print(f"WB.PY: Неожиданная ошибка при инициализации информации о товаре {skus_label}: {type(e).__name__} - {e}")
             import traceback
             traceback.print_exc()
-            if not self.product_name: self.product_name = f"Товар {self.sku}"
-            if self.root_id is None: self.root_id = self.sku
+        return None
+
+    @classmethod
+    async def init_product_info_many(cls, instances: List["WbReview"], chunk_size: Optional[int] = None):
+        """
+        Заполняет root_id, название и цвет сразу для нескольких товаров: артикулы без информации делятся
+        на части по chunk_size (по умолчанию CARD_BATCH_SIZE), на каждую часть - один запрос к API карточек,
+        части запрашиваются одновременно. Товары из кеша информации о товарах не запрашиваются,
+        полученные из API сохраняются в кеш. Товары, которых нет в ответах API, дозаполняются обычным
+        _init_product_info (в том числе со страницы товара).
+        """
+        pending: Dict[str, List["WbReview"]] = {}
+        for instance in instances:
+            if instance.root_id is None or not instance.product_name:
+                pending.setdefault(instance.sku, []).append(instance)
+        cache = cls._get_product_info_cache()
+        if pending and cache is not None:
+            try:
+                cached = cache.get_many(list(pending))
+            except Exception as e:
+                print(f"WB.PY: Кеш информации о товарах недоступен ({type(e).__name__} - {e}), запрашиваем API.")
+                cached = {}
+            for sku, entry in cached.items():
+                metrics.inc("wb_product_info_cache", result="hit" if entry["found"] else "negative_hit")
+                for instance in pending.pop(sku):
+                    instance._apply_cached_product_info(entry)
+        if not pending:
+            return
+        chunk_size = max(1, chunk_size or cls.CARD_BATCH_SIZE)
+        skus = list(pending)
+        chunks = [skus[i:i + chunk_size] for i in range(0, len(skus), chunk_size)]
+        manager = next((instance._session_manager for instance in instances if instance._session_manager), None)
+        with metrics.span("wb.card_info_batch", skus=len(skus), requests=len(chunks)):
+            found: Dict[str, Dict[str, Any]] = {}
+            for infos in await asyncio.gather(*(cls._get_card_infos(chunk, manager) for chunk in chunks)):
+                found.update(infos or {})
+
+        missing = []
+        for sku, group in pending.items():
+            product_info = found.get(sku)
+            for instance in group:
+                if product_info is not None and product_info.get("name"):
+                    instance._apply_product_info(product_info)
+                    instance._save_product_info(cache, True)
+                else:
+                    missing.append(instance)
+        if missing:
+            print(f"WB.PY: API карточек не вернуло данных для {len(missing)} из {len(skus)} товаров, запрашиваем их по одному.")
+            await asyncio.gather(*(instance._init_product_info() for instance in missing))
 
-    async def get_review_data(self) -> Optional[Dict[str, Any]]:
-        """Асинхронно получает данные отзывов. Гарантирует, что root_id инициализирован."""
+    def _apply_product_info(self, product_info: Optional[Dict[str, Any]], page_title: Optional[str] = None):
+        """
+        Заполняет root_id, название и цвет по описанию товара из API карточки; page_title (название
+        со страницы товара) используется, только если API не вернул названия.
+        """
+        if product_info:
+            self.root_id = str(product_info.get("id", self.sku))
+            self.brand = product_info.get("brand") or ""
+            api_name = product_info.get("name")
+            if api_name and api_name != self.sku:
+                self.product_name = api_name
+        if (not self.product_name or self.product_name == self.sku) and page_title:
+            self.product_name = page_title
+        if not self.product_name or self.product_name == self.sku:
+            self.product_name = f"Товар {self.sku}"
+        if self.root_id is None:
+            self.root_id = self.sku
+        if not product_info:
+            return
+
+        if "brand" in product_info and product_info["brand"]:
+            brand = product_info["brand"]
+            if brand.lower() not in self.product_name.lower():
+                self.product_name = f"{brand} / {self.product_name}"
+        
+        if "colors" in product_info and isinstance(product_info["colors"], list) and len(product_info["colors"]) > 0:
+            current_color_name = ""
+            for color_option in product_info["colors"]:
+                if isinstance(color_option, dict) and str(color_option.get("id")) == self.sku :
+                    option_found = False
+                    if "options" in color_option and isinstance(color_option["options"], list):
+                        for opt in color_option["options"]:
+                            if isinstance(opt, dict) and str(opt.get("id")) == self.sku:
+                                current_color_name = opt.get("name", "")
+                                option_found = True
+                                break
+                    if option_found and current_color_name:
+                        break
+                    if not current_color_name and not option_found:
+                         current_color_name = color_option.get("name","")
+
+            self.color = current_color_name if current_color_name else product_info["colors"][0].get("name", "")
+
+        elif "options" in product_info and isinstance(product_info["options"], list):
+             for option in product_info["options"]:
+                 if isinstance(option, dict) and str(option.get("id")) == self.sku:
+                     self.color = option.get("name", "")
+                     break
+
+    async def iter_feedback_pages(self, page_size: int = 100, skip: int = 0,
+                                  max_items: int = 5000) -> AsyncIterator[List[Dict[str, Any]]]:
+        """
+        Асинхронный генератор страниц сырых отзывов (skip/take) от новых к старым.
+        Каждая страница декодируется отдельно, поэтому в памяти одновременно держится одна страница.
+        При ошибке сети или сервера генерация прекращается; self._feedbacks_exhausted становится True,
+        только если сервер вернул последнюю (неполную или пустую) страницу.
+        """
+        self._feedbacks_exhausted = False
         if self.root_id is None:
-            await self._init_product_info() 
+            await self._init_product_info()
             if self.root_id is None:
                 print(f"WB.PY: Не удалось инициализировать root_id для SKU {self.sku}, отзывы не могут быть загружены.")
-                return None
-        
-        session = await self._get_session()
-        url_feedbacks = f"https://feedbacks.wildberries.ru/api/v1/feedbacks?imtId={self.root_id}&take=5000&skip=0"
+                return
 
-        try:
-            async with session.get(url_feedbacks) as response:
-                if response.status == 200:
+        while skip < max_items:
+            take = min(page_size, max_items - skip)
+            url = self.FEEDBACKS_URL.format(root_id=self.root_id, take=take, skip=skip)
+            try:
+                # Интервал охватывает только запрос и декодирование страницы, но не обработку у потребителя
+                with metrics.span("wb.feedback_page", sku=self.sku, skip=skip, take=take):
+                    response = await self._get(url)
+                    if response.status != 200:
+                        print(f"WB.PY: Сервер отзывов ({url}) не вернул успешный ответ ({response.status}) для root_id {self.root_id}.")
+                        return
                     data = await response.json()
-                    if isinstance(data, dict) and data.get("feedbacks") is not None:
-                         return data
-                    elif isinstance(data, list):
-                         return {"feedbacks": data}
-                    elif isinstance(data, dict) and not data.get("feedbacks") and not data:
-                         print(f"WB.PY: Получен пустой объект {{}} в качестве ответа по отзывам для root_id {self.root_id}. Считаем, что отзывов нет.")
-                         return {"feedbacks": []}
-                    else:
-                         print(f"WB.PY: Неожиданный формат данных отзывов для root_id {self.root_id}. Ответ: {str(data)[:200]}")
-                         return {"feedbacks": []}
+            except (aiohttp.ClientError, asyncio.TimeoutError, json.JSONDecodeError) as e:
+                print(f"WB.PY: Ошибка при запросе страницы отзывов {url} для root_id {self.root_id}: {type(e).__name__} - {e}")
+                return
 
-                else:
-                    print(f"WB.PY: Сервер отзывов ({url_feedbacks}) не вернул успешный ответ ({response.status}) для root_id {self.root_id}. Ответ: {await response.text()[:200]}")
-        except aiohttp.ClientError as e:
-            print(f"WB.PY: Ошибка сети (aiohttp) при запросе отзывов с {url_feedbacks} для root_id {self.root_id}: {type(e).__name__} - {e}")
-        except asyncio.TimeoutError:
-            print(f"WB.PY: Таймаут при запросе отзывов с {url_feedbacks} для root_id {self.root_id}.")
-        except json.JSONDecodeError as e:
-            response_text_sample = ""
-            if 'response' in locals() and hasattr(response, 'text'):
-                try:
-                    response_text_sample = (await response.text())[:200]
-                except: pass
-            print(f"WB.PY: Ошибка декодирования JSON с {url_feedbacks} для root_id {self.root_id}: {e}. Фрагмент ответа: '{response_text_sample}'")
-        except Exception as e:
-            print(f"WB.PY: Неожиданная ошибка при запросе отзывов с {url_feedbacks} для root_id {self.root_id}: {type(e).__name__} - {e}")
-            import traceback
-            traceback.print_exc()
-        
-        return None
+            page = data.get("feedbacks") if isinstance(data, dict) else data
+            if not isinstance(page, list) or not page:
+                self._feedbacks_exhausted = True
+                return
 
-    async def parse(self, only_this_variation: bool = True, limit: int = 300) -> List[Dict[str, str]]:
+            page = [feedback for feedback in page if isinstance(feedback, dict)]
+            yield page
+
+            if len(page) < take:
+                self._feedbacks_exhausted = True
+                return
+            skip += take
+
+    def _matches_variation(self, feedback_item: Dict[str, Any], only_this_variation: bool) -> bool:
+        """Проверяет, относится ли отзыв к текущей вариации товара (nmId == sku)."""
+        if not only_this_variation:
+            return True
+        feedback_nm_id = feedback_item.get("nmId")
+        return feedback_nm_id is not None and str(feedback_nm_id) == self.sku
+
+    @staticmethod
+    def _parse_feedback(feedback_item: Dict[str, Any]) -> Review:
+        """Преобразует сырой отзыв в запись Review с оценкой, датой и вариацией."""
+        return Review.from_feedback(feedback_item)
+
+    async def iter_feedbacks(self, only_this_variation: bool = True, limit: int = 300,
+                             page_size: int = 100) -> AsyncIterator[Review]:
+        """
+        Асинхронный генератор разобранных отзывов.
+        Запрашивает страницы по page_size и останавливается, как только набрано limit подходящих отзывов,
+        поэтому расход памяти и трафика зависит от limit, а не от общего числа отзывов товара.
+        """
+        count = 0
+        async for page in self.iter_feedback_pages(page_size=page_size):
+            for feedback_item in page:
+                if not self._matches_variation(feedback_item, only_this_variation):
+                    continue
+                yield self._parse_feedback(feedback_item)
+                count += 1
+                if count >= limit:
+                    return
+
+    async def get_new_review_data(self, newest_date: str, known_ids: set, page_size: int = 100,
+                                  max_items: int = 5000) -> Optional[List[Dict[str, Any]]]:
+        """
+        Асинхронно получает только отзывы новее newest_date, постранично через skip/take.
+        Останавливается на первой странице, где встречается уже известный отзыв.
+        Возвращает None, если не удалось получить ни одной страницы.
+        """
+        new_feedbacks: List[Dict[str, Any]] = []
+        got_page = False
+        async for page in self.iter_feedback_pages(page_size=page_size, max_items=max_items):
+            got_page = True
+            reached_known = False
+            for feedback in page:
+                created_date = str(feedback.get("createdDate") or "")
+                if ReviewCache._feedback_key(feedback) in known_ids or (newest_date and created_date and created_date <= newest_date):
+                    reached_known = True
+                    continue
+                new_feedbacks.append(feedback)
+            if reached_known:
+                break
+
+        if not got_page and not self._feedbacks_exhausted:
+            return None
+        return new_feedbacks
+
+    def _get_review_cache(self) -> ReviewCache:
+        """Возвращает кеш отзывов экземпляра или общий кеш по умолчанию."""
+        if self._review_cache is None:
+            if WbReview._default_review_cache is None:
+                WbReview._default_review_cache = ReviewCache()
+            self._review_cache = WbReview._default_review_cache
+        return self._review_cache
+
+    async def get_cached_review_data(self, only_this_variation: bool = True,
+                                     limit: int = 300) -> Optional[List[Dict[str, Any]]]:
+        """
+        Получает сырые отзывы из локального кеша:
+        свежая запись отдается как есть, устаревшая дополняется только новыми отзывами.
+        Возвращает None при промахе, а также если кеш заполнен не до конца
+        и в нем меньше limit подходящих отзывов.
+        """
+        cache = self._get_review_cache()
+        state = cache.get_state(self.root_id)
+        if state is None:
+            return None
+
+        if not state["fresh"]:
+            new_feedbacks = await self.get_new_review_data(state["newest_date"], cache.known_ids(self.root_id))
+            if new_feedbacks is not None:
+                cache.store(self.root_id, new_feedbacks)
+        else:
+            new_feedbacks = []
+
+        feedbacks = cache.load(self.root_id)
+        if not state["complete"]:
+            matching = sum(1 for feedback in feedbacks if self._matches_variation(feedback, only_this_variation))
+            if matching < limit:
+                print(f"WB.PY: В кеше для root_id {self.root_id} недостаточно отзывов ({matching} из {limit}), загружаем заново.")
+                return None
+
+        downloaded = len(new_feedbacks) if new_feedbacks else 0
+        if state["fresh"]:
+            cache.record(hits=1, served_from_cache=len(feedbacks))
+            print(f"WB.PY: Отзывы для root_id {self.root_id} взяты из кеша ({len(feedbacks)} шт.).")
+        else:
+            cache.record(refreshes=1, downloaded=downloaded, served_from_cache=len(feedbacks) - downloaded)
+            print(f"WB.PY: Кеш отзывов для root_id {self.root_id} обновлен: новых отзывов {downloaded}, всего {len(feedbacks)}.")
+        return feedbacks
+
+    @metrics.timed("wb.parse", attrs=_sku_span_attrs)
+    async def parse(self, only_this_variation: bool = True, limit: int = 300, use_cache: bool = True,
+                    page_size: int = 100) -> List[Review]:
         """
         Асинхронный парсинг отзывов.
         Гарантирует, что информация о товаре (root_id, product_name) загружена перед парсингом.
+        При use_cache=True отзывы сначала ищутся в локальном кеше; при промахе они загружаются
+        постранично до набора limit подходящих отзывов и попутно сохраняются в кеш.
+        Одновременные вызовы с одинаковыми SKU и параметрами разделяют одну загрузку.
         """
+        key = (self.sku, only_this_variation, limit, use_cache, page_size)
+        reviews = await self._parse_flight.do(key, lambda: self._parse(only_this_variation, limit, use_cache, page_size))
+        return list(reviews)
+
+    async def _parse(self, only_this_variation: bool, limit: int, use_cache: bool, page_size: int) -> List[Review]:
         if self.root_id is None or not self.product_name:
             await self._init_product_info()
             if self.root_id is None:
                  print(f"WB.PY: Критическая ошибка: не удалось получить root_id для SKU {self.sku}. Парсинг отзывов невозможен.")
                  return []
 
-        json_feedbacks_data = await self.get_review_data()
-        
-        if not json_feedbacks_data or json_feedbacks_data.get("feedbacks") is None:
+        if not use_cache:
+            return [feedback async for feedback in self.iter_feedbacks(only_this_variation, limit, page_size)]
+
+        cache = None
+        try:
+            cache = self._get_review_cache()
+            cached_feedbacks = await self.get_cached_review_data(only_this_variation, limit)
+        except Exception as e:
+            print(f"WB.PY: Кеш отзывов недоступен ({type(e).__name__} - {e}), загружаем отзывы из сети.")
+            cache = None
+            cached_feedbacks = None
+
+        parsed_feedbacks: List[Review] = []
+        if cached_feedbacks is not None:
+            for feedback_item in cached_feedbacks:
+                if self._matches_variation(feedback_item, only_this_variation):
+                    parsed_feedbacks.append(self._parse_feedback(feedback_item))
+                    if len(parsed_feedbacks) >= limit:
+                        break
+            return parsed_feedbacks
+
+        downloaded = 0
+        first_page = True
+        async for page in self.iter_feedback_pages(page_size=page_size):
+            downloaded += len(page)
+            if cache is not None:
+                cache.store(self.root_id, page, replace=first_page)
+                first_page = False
+            for feedback_item in page:
+                if self._matches_variation(feedback_item, only_this_variation):
+                    parsed_feedbacks.append(self._parse_feedback(feedback_item))
+                    if len(parsed_feedbacks) >= limit:
+                        break
+            if len(parsed_feedbacks) >= limit:
+                break
+
+        if cache is not None and not first_page:
+            cache.mark_complete(self.root_id, self._feedbacks_exhausted)
+            cache.record(misses=1, downloaded=downloaded)
+
+        if not parsed_feedbacks:
             print(f"WB.PY: Отзывы не найдены или не удалось загрузить для root_id: {self.root_id} (SKU: {self.sku})")
-            return []
+        return parsed_feedbacks
 
-        actual_feedbacks_list = json_feedbacks_data.get("feedbacks", [])
-        if not isinstance(actual_feedbacks_list, list) or not actual_feedbacks_list:
-            if actual_feedbacks_list is not None:
-                 print(f"WB.PY: Поле 'feedbacks' содержит неожиданный тип данных ({type(actual_feedbacks_list)}) или пусто для root_id: {self.root_id}. Ожидался список.")
-            return []
+    @classmethod
+    async def fetch_many(cls, skus: List[str], only_this_variation: bool = True, limit: int = 300,
+                         concurrency: int = 4,
+                         on_done: Optional[Callable[[Dict[str, Any]], None]] = None,
+                         cancel_token: Optional[CancellationToken] = None) -> List[Dict[str, Any]]:
+        """
+        Асинхронно получает информацию о товарах и отзывы сразу для нескольких SKU в одном цикле событий.
+        Информация о товарах запрашивается заранее пакетными запросами (init_product_info_many),
+        отзывы - одновременно не более чем для `concurrency` товаров.
 
-        parsed_feedbacks: List[Dict[str, str]] = []
-        for feedback_item in actual_feedbacks_list:
-            if not isinstance(feedback_item, dict): continue
+        Для каждого SKU возвращается словарь {"sku", "instance", "reviews", "error"} в порядке входного списка.
+        `on_done` вызывается с этим словарем сразу после завершения обработки очередного товара.
+        При отмене `cancel_token` незавершенные запросы прерываются и поднимается asyncio.CancelledError.
+        """
+        semaphore = asyncio.Semaphore(max(1, concurrency))
 
-            text_content = feedback_item.get("text", "") or feedback_item.get("productValuation", "")
-            
-            can_add = False
-            if only_this_variation:
-                feedback_nm_id = feedback_item.get("nmId")
-                if feedback_nm_id is not None:
-                    if str(feedback_nm_id) == self.sku:
-                        can_add = True
-                else:
-                    pass
-            else:
-                can_add = True
-
-            if can_add:
-                parsed_feedbacks.append({
-                    "text": text_content,
-                    "pros": feedback_item.get("pros", ""),
-                    "cons": feedback_item.get("cons", "")
-                })
-        
-        return parsed_feedbacks[:limit]
\ No newline at end of file
+        # Информация о всех товарах запрашивается заранее пакетами, по запросу на CARD_BATCH_SIZE артикулов
+        instances: Dict[str, WbReview] = {}
+        for sku in skus:
+            try:
+                instances[sku] = cls(sku)
+            except ValueError:
+                pass
+        await cancellable(cls.init_product_info_many(list(instances.values())), cancel_token)
+
+        async def fetch_one(sku: str) -> Dict[str, Any]:
+            result: Dict[str, Any] = {"sku": sku, "instance": None, "reviews": [], "error": None}
+            try:
+                wb_review = instances.get(sku) or cls(sku)
+                result["instance"] = wb_review
+                async with semaphore:
+                    await wb_review._init_product_info()
+                    result["reviews"] = await wb_review.parse(only_this_variation=only_this_variation, limit=limit)
+            except ValueError as e:
+                result["error"] = e
+            except Exception as e:
+                print(f"WB.PY: Ошибка при пакетной обработке товара {sku}: {type(e).__name__} - {e}")
+                result["error"] = e
+            if on_done:
+                on_done(result)
+            return result
+
+        return list(await cancellable(asyncio.gather(*(fetch_one(sku) for sku in skus)), cancel_token))
+
+
+# Общий для модуля пул соединений, который разделяют все экземпляры WbReview
+session_manager = WbSessionManager(headers=WbReview.HEADERS)
+
+
+async def shutdown():
+    """
+    Закрывает общий пул соединений wb.py и выводит накопленную статистику кеша отзывов, если он использовался.
+    Вызывается один раз при завершении работы.
+    """
+    await session_manager.close()
+    if WbReview._default_review_cache is not None:
+        try:
+            print(f"WB.PY: Кеш отзывов (всего): {WbReview._default_review_cache.summary()}")
+        except Exception as e:
+            print(f"WB.PY: Не удалось прочитать статистику кеша отзывов: {type(e).__name__} - {e}")